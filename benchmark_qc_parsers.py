@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+"""
+Benchmark for the report parsing of multiqc_extra_stats_qc.py.
+
+Writes synthetic Sarek results/reports trees (mosdepth summary and region.dist, samtools
+stats and snpEff CSV) for a number of samples, then times find_reports, collect_data,
+check_qc and the YAML output for each size in a fresh process, and records wall time and
+peak RSS as JSON so runs can be compared across commits.
+
+Usage:
+    benchmark_qc_parsers.py --sizes 10,100,1000,5000 --output benchmark.json
+    benchmark_qc_parsers.py --generate /path/to/analysis_dir --samples 100   # only write reports
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+chroms = [f"chr{x}" for x in range(1, 23)] + ["chrX", "chrY", "chrM"]
+chrom_lengths = {
+    "chr1": 248956422, "chr2": 242193529, "chr3": 198295559, "chr4": 190214555,
+    "chr5": 181538259, "chr6": 170805979, "chr7": 159345973, "chr8": 145138636,
+    "chr9": 138394717, "chr10": 133797422, "chr11": 135086622, "chr12": 133275309,
+    "chr13": 114364328, "chr14": 107043718, "chr15": 101991189, "chr16": 90338345,
+    "chr17": 83257441, "chr18": 80373285, "chr19": 58617616, "chr20": 64444167,
+    "chr21": 46709983, "chr22": 50818468, "chrX": 156040895, "chrY": 57227415,
+    "chrM": 16569,
+}
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the report parsing of multiqc_extra_stats_qc.py on synthetic Sarek reports"
+    )
+    parser.add_argument(
+        "--sizes",
+        default="10,100,1000,5000",
+        help="Comma separated numbers of samples to benchmark (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Workers passed to collect_data (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--workdir",
+        help="Folder for the synthetic reports, kept between runs (default: a temporary folder)",
+    )
+    parser.add_argument("--output", help="Write the results as JSON to this file (default: stdout)")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed (default: %(default)s)")
+    parser.add_argument(
+        "--generate",
+        metavar="ANALYSIS_DIR",
+        help="Only write synthetic reports for --samples samples to ANALYSIS_DIR",
+    )
+    parser.add_argument("--samples", type=int, default=10, help="Samples for --generate (default: %(default)s)")
+    parser.add_argument("--measure", metavar="ANALYSIS_DIR", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def write_mosdepth(report_dir, sample, rng, sex):
+    coverage = rng.gauss(35, 4)
+    ratios = {"chrX": 1.0 if sex == "female" else 0.5, "chrY": 0.02 if sex == "female" else 0.5, "chrM": 150}
+    with open(os.path.join(report_dir, f"{sample}.md.mosdepth.summary.txt"), "w") as fout:
+        fout.write("chrom\tlength\tbases\tmean\tmin\tmax\n")
+        total_length, total_bases = 0, 0
+        for chrom in chroms:
+            length = chrom_lengths[chrom]
+            mean = coverage * ratios.get(chrom, 1.0) * rng.uniform(0.95, 1.05)
+            bases = int(length * mean)
+            total_length += length
+            total_bases += bases
+            fout.write(f"{chrom}\t{length}\t{bases}\t{mean:.2f}\t0\t{int(mean * 20)}\n")
+        fout.write(f"total\t{total_length}\t{total_bases}\t{total_bases / total_length:.2f}\t0\t8000\n")
+
+    with open(os.path.join(report_dir, f"{sample}.md.mosdepth.region.dist.txt"), "w") as fout:
+        for region in chroms + ["total"]:
+            mean = coverage * ratios.get(region, 1.0)
+            for cov in range(int(mean * 3), -1, -1):
+                # proportion of the region with at least cov coverage, a smooth sigmoid around the mean
+                proportion = 1 / (1 + 2.718281828 ** ((cov - mean) / (mean * 0.1 + 0.1)))
+                fout.write(f"{region}\t{cov}\t{min(1.0, proportion * 1.02):.2f}\n")
+
+
+def write_samtools_stats(report_dir, sample, rng):
+    reads = rng.randint(600000000, 900000000)
+    mapped = int(reads * rng.uniform(0.97, 0.995))
+    insert = rng.gauss(370, 15)
+    with open(os.path.join(report_dir, f"{sample}.md.cram.stats"), "w") as fout:
+        fout.write(f"# This file was produced by samtools stats (synthetic) for {sample}\n")
+        sn = {
+            "raw total sequences": reads, "filtered sequences": 0, "sequences": reads,
+            "is sorted": 1, "1st fragments": reads // 2, "last fragments": reads // 2,
+            "reads mapped": mapped, "reads mapped and paired": mapped - 1000,
+            "reads unmapped": reads - mapped, "reads properly paired": int(mapped * 0.97),
+            "reads paired": reads, "reads duplicated": int(reads * 0.08),
+            "reads MQ0": int(reads * 0.02), "reads QC failed": 0, "non-primary alignments": 0,
+            "supplementary alignments": int(reads * 0.005), "total length": reads * 150,
+            "total first fragment length": reads * 75, "total last fragment length": reads * 75,
+            "bases mapped": mapped * 150, "bases mapped (cigar)": mapped * 149,
+            "bases trimmed": 0, "bases duplicated": int(reads * 0.08) * 150, "mismatches": reads // 2,
+            "error rate": 3.5e-03, "average length": 150, "average first fragment length": 150,
+            "average last fragment length": 150, "maximum length": 151,
+            "maximum first fragment length": 151, "maximum last fragment length": 151,
+            "average quality": 36.1, "insert size average": round(insert, 1),
+            "insert size standard deviation": 90.2, "inward oriented pairs": reads // 2 - 2000,
+            "outward oriented pairs": 1200, "pairs with other orientation": 30,
+            "pairs on different chromosomes": 800, "percentage of properly paired reads (%)": 97.0,
+        }
+        for field, value in sn.items():
+            fout.write(f"SN\t{field}:\t{value}\n")
+        for cycle in range(1, 152):
+            fout.write(f"RL\t{cycle}\t{rng.randint(0, 1000)}\n")
+        # GC content of first and last fragments, adding up to the number of reads
+        gc_weights = [2.718281828 ** (-((gc - 41) ** 2) / 60) for gc in range(0, 101)]
+        for section in ["GCF", "GCL"]:
+            for gc, weight in enumerate(gc_weights):
+                count = int(reads / 2 * weight / sum(gc_weights))
+                fout.write(f"{section}\t{gc + 0.25:.2f}\t{count}\n")
+        for size in range(0, 1001):
+            pairs = int(reads / 2 * 2.718281828 ** (-((size - insert) ** 2) / (2 * 90 ** 2)) / 226)
+            fout.write(f"IS\t{size}\t{pairs}\t{pairs - pairs // 100}\t{pairs // 200}\t{pairs // 200}\n")
+        for cov in range(1, 1001):
+            fout.write(f"COV\t[{cov}-{cov}]\t{cov}\t{int(1e8 * 2.718281828 ** (-((cov - 35) ** 2) / 200))}\n")
+        for gc in range(0, 200):
+            fout.write(f"GCD\t{gc / 2:.1f}\t{gc / 2:.3f}\t{rng.random():.3f}\t{rng.random():.3f}"
+                       f"\t{rng.random():.3f}\t{rng.random():.3f}\t{rng.random():.3f}\n")
+
+
+def write_snpeff(report_dir, sample, rng):
+    variants = rng.randint(4900000, 5200000)
+    with open(os.path.join(report_dir, f"{sample}_snpEff.csv"), "w") as fout:
+        fout.write("# Summary table\n")
+        fout.write("Name, Value\n")
+        fout.write("Genome, GRCh38.105\n")
+        fout.write("Date, 2026-01-01 00:00\n")
+        fout.write(f"Number_of_lines_in_input_file, {variants}\n")
+        fout.write(f"Number_of_variants_before_filter, {variants}\n")
+        fout.write("Number_of_not_variants, 0\n")
+        fout.write(f"Number_of_variants_processed, {variants}\n")
+        fout.write("\n# Change rate by chromosome\nChromosome, Length, Changes, Change_rate\n")
+        for chrom in chroms:
+            fout.write(f"{chrom}, {chrom_lengths[chrom]}, {variants // 25}, {chrom_lengths[chrom] // (variants // 25)}\n")
+        fout.write("\n# Effects by impact\nType , Count , Percent\n")
+        for impact in ["HIGH", "LOW", "MODERATE", "MODIFIER"]:
+            fout.write(f"{impact} , {rng.randint(1000, 10000000)} , {rng.random() * 100:.3f}%\n")
+
+
+def generate_reports(analysis_dir, n_samples, seed=1):
+    """
+    Writes a synthetic Sarek results/reports tree.
+
+    Args:
+        analysis_dir (str): Analysis folder to write results/reports in
+        n_samples (int): Number of samples
+        seed (int): Random seed, the same seed gives the same reports
+    """
+    rng = random.Random(seed)
+    report_folder = os.path.join(analysis_dir, "results", "reports")
+    for i in range(n_samples):
+        sample = f"P{seed:05d}_{i + 1:04d}"
+        sex = rng.choice(["female", "male"])
+        dirs = {
+            "mosdepth": os.path.join(report_folder, "mosdepth", sample),
+            "samtools": os.path.join(report_folder, "samtools", sample),
+            "snpeff": os.path.join(report_folder, "snpeff", "haplotypecaller", sample),
+        }
+        for path in dirs.values():
+            os.makedirs(path, exist_ok=True)
+        write_mosdepth(dirs["mosdepth"], sample, rng, sex)
+        write_samtools_stats(dirs["samtools"], sample, rng)
+        write_snpeff(dirs["snpeff"], sample, rng)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(max(self_rss, children_rss) / 1024, 1)
+
+
+def measure(analysis_dir, workers):
+    """
+    Times the steps of multiqc_extra_stats_qc.py on an analysis folder. Run in a
+    fresh process, so that the peak RSS belongs to this size only.
+
+    Returns:
+        dict: Step (key), dict of wall time in seconds and peak RSS in MB so far (value)
+    """
+    sys.path.insert(0, script_dir)
+    import multiqc_extra_stats_qc as qc_script
+
+    steps = {}
+
+    def timed(step, fn):
+        start = time.perf_counter()
+        result = fn()
+        steps[step] = {"seconds": round(time.perf_counter() - start, 4), "peak_rss_mb": peak_rss_mb()}
+        return result
+
+    reports = timed("find_reports", lambda: qc_script.find_reports(analysis_dir))
+    data = timed("collect_data", lambda: qc_script.collect_data(reports, workers=workers))
+    qc = qc_script.QC()
+    qc_fail = timed("check_qc", lambda: qc_script.check_qc(data, qc))
+
+    def write_yaml():
+        with tempfile.TemporaryDirectory() as outdir:
+            qc_out = qc_script.QC_out(qc_fail, qc)
+            extra_genstats = qc_script.extra_genstats_out(data)
+            qc_script.write_atomic(
+                os.path.join(outdir, "QC_list_mqc.yaml"), lambda fout: yaml.dump(qc_out, fout))
+            qc_script.write_atomic(
+                os.path.join(outdir, "extra_stats.yaml"), lambda fout: yaml.dump(extra_genstats, fout))
+    timed("yaml_output", write_yaml)
+    return steps
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "-C", script_dir, "rev-parse", "HEAD"],
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(workdir, sizes, workers, seed):
+    """
+    Benchmarks each size in a fresh process, generating the synthetic reports in
+    workdir unless they are already there.
+
+    Returns:
+        dict: Run details and the wall time and peak RSS of each step per size
+    """
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "host": platform.node(),
+        "cpus": os.cpu_count(),
+        "workers": workers,
+        "seed": seed,
+        "sizes": {},
+    }
+    for size in sizes:
+        analysis_dir = os.path.join(workdir, f"samples_{size}_seed_{seed}")
+        if not os.path.exists(os.path.join(analysis_dir, "results")):
+            print(f"Generating reports for {size} samples in {analysis_dir}", file=sys.stderr)
+            generate_reports(analysis_dir, size, seed)
+        print(f"Benchmarking {size} samples", file=sys.stderr)
+        start = time.perf_counter()
+        try:
+            out = subprocess.run(
+                [sys.executable, os.path.realpath(__file__), "--measure", analysis_dir,
+                 "--workers", str(workers)],
+                capture_output=True, text=True, check=True).stdout
+        except subprocess.CalledProcessError as e:
+            sys.exit(f"Benchmark of {size} samples failed:\n{e.stderr}")
+        steps = json.loads(out)
+        results["sizes"][str(size)] = {
+            "steps": steps,
+            "total_seconds": round(time.perf_counter() - start, 4),
+            "peak_rss_mb": max(step["peak_rss_mb"] for step in steps.values()),
+        }
+    return results
+
+
+def main():
+    args = parse_arguments()
+    if args.measure:
+        # stdout is reserved for the result, progress from the QC script goes to stderr
+        real_stdout, sys.stdout = sys.stdout, sys.stderr
+        steps = measure(args.measure, args.workers)
+        json.dump(steps, real_stdout)
+        return
+    if args.generate:
+        generate_reports(args.generate, args.samples, args.seed)
+        return
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    if args.workdir:
+        results = run_benchmarks(args.workdir, sizes, args.workers, args.seed)
+    else:
+        # the synthetic reports of a temporary folder are removed after the run
+        with tempfile.TemporaryDirectory(prefix="benchmark_qc_parsers.") as workdir:
+            results = run_benchmarks(workdir, sizes, args.workers, args.seed)
+
+    if args.output:
+        with open(args.output, "w") as fout:
+            json.dump(results, fout, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print("")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+Check if all available sequence data for a project has been properly organized.
+
+For every sample sheet row of the project in a flowcell in incoming, the organized path
+DATA/<project>/<sample name>/<library name>/<flowcell> is expected to exist. Rows without
+a LIBRARY_NAME in their description are not organized, and are reported separately.
+
+Usage:
+    find_unorganized_flowcells.py P1234 [SAMPLE_NAME] [--json]
+"""
+
+import argparse
+import json
+import os
+import sys
+
+from samplesheet import SampleSheetCache, find_samplesheets
+
+seq_dir = "/proj/ngi2016001/incoming"
+data_dir = "/proj/ngi2016001/nobackup/NGI/DATA"
+
+
+def expected_paths(project, sample=None, search_dir=seq_dir):
+    """
+    Organized paths expected from the sample sheets in search_dir, in flowcell order.
+
+    Returns:
+        ({(sample_name, library_name, flowcell): expected organized path},
+         [(sample_name, flowcell)] of rows with no library name)
+    """
+    expected = {}
+    no_library = {}
+    for row in SampleSheetCache().project_rows([project], find_samplesheets(search_dir)):
+        if sample is not None and row.sample_name != sample:
+            continue
+        flowcell = os.path.basename(row.runfolder)
+        if not row.library_name:
+            # organize_flowcell.py skips these rows, so there is no path to expect
+            no_library.setdefault((row.sample_name, flowcell))
+            continue
+        key = (row.sample_name, row.library_name, flowcell)
+        expected.setdefault(
+            key, os.path.join(data_dir, project, row.sample_name, row.library_name, flowcell))
+    return expected, list(no_library)
+
+
+def missing_paths(project, expected):
+    """
+    Checks the expected paths with one listing per sample folder, and per library
+    folder that exists, instead of one stat per path.
+
+    Returns:
+        {(sample_name, library_name, flowcell): expected organized path} of missing paths
+    """
+    listings = {}
+
+    def listing(path):
+        if path not in listings:
+            try:
+                listings[path] = set(os.listdir(path))
+            except OSError:
+                listings[path] = set()
+        return listings[path]
+
+    missing = {}
+    for key, organized_path in expected.items():
+        sample_name, library_name, flowcell = key
+        sample_path = os.path.join(data_dir, project, sample_name)
+        if (library_name not in listing(sample_path)
+                or flowcell not in listing(os.path.join(sample_path, library_name))):
+            missing[key] = organized_path
+    return missing
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check that the organized project folder under DATA contains all flowcells "
+        "in incoming with data from the project.")
+    parser.add_argument("project", help="Project ID")
+    parser.add_argument("sample", nargs="?", help="Only check this sample name")
+    parser.add_argument(
+        "--json", action="store_true", help="Print the missing paths and counts as JSON")
+    args = parser.parse_args()
+
+    project = args.project
+    expected, no_library = expected_paths(project, args.sample)
+    missing = missing_paths(project, expected)
+
+    if args.json:
+        json.dump({
+            "project": project,
+            "sample": args.sample,
+            "expected": len(expected),
+            "missing": len(missing),
+            "flowcells": len({flowcell for _, _, flowcell in expected}),
+            "unorganized_flowcells": sorted({flowcell for _, _, flowcell in missing}),
+            "missing_paths": [
+                {"sample": sample, "library": library, "flowcell": flowcell, "path": path}
+                for (sample, library, flowcell), path in missing.items()],
+            "no_library": [
+                {"sample": sample, "flowcell": flowcell} for sample, flowcell in no_library],
+        }, sys.stdout, indent=2)
+        print("")
+        return
+
+    for (sample, library, flowcell), organized_path in missing.items():
+        print(f"Expected organized path {organized_path} is missing ==> flowcell {flowcell} may not "
+              f"have been properly organized for project {project} and sample {sample}")
+    for sample, flowcell in no_library:
+        print(f"No library in sample sheet for sample {sample} in flowcell {flowcell} ==> "
+              f"it can not be organized")
+    print(f"{len(missing)} of {len(expected)} expected organized paths are missing "
+          f"({len({flowcell for _, _, flowcell in missing})} flowcells), "
+          f"{len(no_library)} without a library in the sample sheet", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
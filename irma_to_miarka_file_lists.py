@@ -1,30 +1,279 @@
 import argparse
+import concurrent.futures
+import contextlib
 import datetime
+import functools
+import glob
+import gzip
+import heapq
+import json
 import os
 import pprint
-import string
+import sqlite3
+import sys
 import tempfile
+import time
 
 
-from typing import List, Callable, Tuple, Optional
+from typing import List, Callable, Tuple, Optional, Dict, Iterator, NamedTuple, Iterable
 
 min_access_time = datetime.datetime(year=2016, month=1, day=1)
+# the walk is bound by metadata round-trips to the Lustre MDS rather than by CPU, so use many
+# more threads than cores
+scan_workers = 32
+# the plan listing what objects each scan shard should process
+shard_plan_file = "irma_to_miarka.shard_plan.tsv"
+
+
+# the file access ages, in months, that the access histograms are binned by
+atime_age_bins = [(0, 3), (3, 6), (6, 12), (12, 24), (24, 36), (36, None)]
+
+
+class DirectoryScan(NamedTuple):
+    # the scan result for the entries directly in a directory. atime_months holds the number of
+    # files last accessed in each month, keyed by year * 12 + month - 1
+    parent: str
+    mtime_ns: int
+    max_atime: float
+    n_files: int
+    n_dirs: int
+    allocated_bytes: int
+    apparent_bytes: int
+    scanned_at: float
+    atime_months: Dict[int, int]
+
+
+class ObjectStats(NamedTuple):
+    # the size, file count and access histogram aggregated for everything under an object
+    last_access: datetime.datetime
+    allocated_bytes: int
+    apparent_bytes: int
+    n_files: int
+    n_dirs: int
+    atime_months: Dict[int, int]
+
+
+def _atime_month(atime: float) -> int:
+    t = time.localtime(atime)
+    return t.tm_year * 12 + t.tm_mon - 1
+
+
+class AccessTimeCache:
+    # sqlite-backed cache of the per-directory scan results for the objects under a path. The
+    # sizes, counts and access histograms are used for the stats tables, shard plans and transfer
+    # batches. Reading or rewriting a file changes its atime but not the mtime of its directory,
+    # so the cached access times of a directory can only be reused for a scan within an explicit
+    # trust window of trust_hours since it was scanned, and only if its mtime is unchanged. By
+    # default every directory is listed again
+
+    # bump when the table layout changes, existing caches are then discarded
+    schema_version = 3
+
+    def __init__(self, cache_file: str, trust_hours: float = 0):
+        self.cache_file = cache_file
+        self.trust_hours = trust_hours
+        with self._connect() as conn:
+            if conn.execute("PRAGMA user_version").fetchone()[0] != self.schema_version:
+                conn.execute("DROP TABLE IF EXISTS directories")
+                conn.execute(f"PRAGMA user_version = {self.schema_version}")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS directories ("
+                "path TEXT PRIMARY KEY, object TEXT, parent TEXT, mtime_ns INTEGER, "
+                "max_atime REAL, n_files INTEGER, n_dirs INTEGER, allocated_bytes INTEGER, "
+                "apparent_bytes INTEGER, scanned_at REAL, atime_months TEXT)")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS directories_object ON directories (object)")
+
+    @contextlib.contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # connections can not be shared between threads so open a new one for each operation
+        conn = sqlite3.connect(self.cache_file, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def cached_dirs(self, obj_path: str) -> Dict[str, DirectoryScan]:
+        with self._connect() as conn:
+            return {
+                row[0]: DirectoryScan(
+                    *row[1:-1],
+                    {int(month): n for month, n in json.loads(row[-1]).items()})
+                for row in conn.execute(
+                    "SELECT path, parent, mtime_ns, max_atime, n_files, n_dirs, "
+                    "allocated_bytes, apparent_bytes, scanned_at, atime_months "
+                    "FROM directories WHERE object = ?", (obj_path,))}
+
+    def reusable_dirs(self, obj_path: str) -> Dict[str, DirectoryScan]:
+        # the cached directories whose access times may be reused by a scan, those scanned within
+        # the trust window
+        if self.trust_hours <= 0:
+            return {}
+        oldest = time.time() - self.trust_hours * 3600
+        return {
+            dpath: dscan for dpath, dscan in self.cached_dirs(obj_path).items()
+            if dscan.scanned_at >= oldest}
+
+    def update(self, obj_path: str, scanned_dirs: Dict[str, DirectoryScan]) -> None:
+        # replace the cached results for an object, which drops directories no longer on disk
+        with self._connect() as conn:
+            conn.execute("DELETE FROM directories WHERE object = ?", (obj_path,))
+            conn.executemany(
+                "INSERT INTO directories VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(dpath, obj_path, *dscan[:-1], json.dumps(dscan.atime_months))
+                 for dpath, dscan in scanned_dirs.items()])
+
+    def file_counts(self) -> Dict[str, int]:
+        # the number of files under each cached object, from a single grouped query
+        with self._connect() as conn:
+            return dict(conn.execute(
+                "SELECT object, SUM(n_files) FROM directories GROUP BY object"))
+
+    def import_objects(self, cache_file: str, obj_paths: List[str]) -> None:
+        # replace the cached results for the objects with the results cached in another file
+        if not os.path.exists(cache_file):
+            return
+        conn = sqlite3.connect(self.cache_file, timeout=60)
+        try:
+            conn.execute("ATTACH DATABASE ? AS other", (cache_file,))
+            if conn.execute("PRAGMA other.user_version").fetchone()[0] != self.schema_version:
+                # a cache with another table layout is discarded
+                return
+            with conn:
+                for obj_path in obj_paths:
+                    conn.execute("DELETE FROM directories WHERE object = ?", (obj_path,))
+                    conn.execute(
+                        "INSERT INTO directories SELECT * FROM other.directories WHERE object = ?",
+                        (obj_path,))
+        finally:
+            conn.close()
+
+    def object_stats(self, obj_path: str) -> ObjectStats:
+        # aggregate the cached results for an object. Objects that are files are not cached and
+        # are stat'ed instead, and objects without cached results, e.g. with a date taken from
+        # elsewhere, are scanned so that their stats are not written as zeros
+        if os.path.isfile(obj_path):
+            st = os.stat(obj_path, follow_symlinks=False)
+            return ObjectStats(
+                datetime.datetime.fromtimestamp(st.st_atime),
+                st.st_blocks * 512,
+                st.st_size,
+                1,
+                0,
+                {_atime_month(st.st_atime): 1})
+        cached_dirs = self.cached_dirs(obj_path)
+        if not cached_dirs:
+            cached_dirs = scan_object(obj_path)[1]
+            if cached_dirs:
+                self.update(obj_path, cached_dirs)
+        return aggregate_object_stats(cached_dirs.values())
+
+
+def aggregate_object_stats(scanned_dirs: Iterable[DirectoryScan]) -> ObjectStats:
+    last_access = min_access_time.timestamp()
+    allocated_bytes, apparent_bytes, n_files, n_dirs = 0, 0, 0, 0
+    atime_months = {}
+    for dscan in scanned_dirs:
+        last_access = max(last_access, dscan.max_atime)
+        allocated_bytes += dscan.allocated_bytes
+        apparent_bytes += dscan.apparent_bytes
+        n_files += dscan.n_files
+        n_dirs += dscan.n_dirs
+        for month, n in dscan.atime_months.items():
+            atime_months[month] = atime_months.get(month, 0) + n
+    return ObjectStats(
+        datetime.datetime.fromtimestamp(last_access),
+        allocated_bytes,
+        apparent_bytes,
+        n_files,
+        n_dirs,
+        atime_months)
+
+
+def _scan_directory(
+        dpath: str, parent: str, mtime_ns: int) -> Tuple[DirectoryScan, List[str]]:
+    # list a directory once and collect the last access time, sizes and access months of the
+    # files in it along with the subdirectories. As with os.walk on each subdirectory, symlinks
+    # to directories are descended into, while files and symlinks to files are stat'ed without
+    # following symlinks. Broken symlinks are counted but do not add an access time
+    max_atime = 0.0
+    n_files, allocated_bytes, apparent_bytes = 0, 0, 0
+    atime_months = {}
+    subdirs = []
+    with os.scandir(dpath) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                subdirs.append(entry.path)
+            elif entry.is_file(follow_symlinks=False) or entry.is_symlink():
+                st = entry.stat(follow_symlinks=False)
+                n_files += 1
+                allocated_bytes += st.st_blocks * 512
+                apparent_bytes += st.st_size
+                if entry.is_symlink() and not entry.is_file():
+                    continue
+                max_atime = max(max_atime, st.st_atime)
+                month = _atime_month(st.st_atime)
+                atime_months[month] = atime_months.get(month, 0) + 1
+    return DirectoryScan(
+        parent,
+        mtime_ns,
+        max_atime,
+        n_files,
+        len(subdirs),
+        allocated_bytes,
+        apparent_bytes,
+        time.time(),
+        atime_months), subdirs
+
+
+def scan_object(
+        fpath: str,
+        cached_dirs: Optional[Dict[str, DirectoryScan]] = None) \
+        -> Tuple[datetime.datetime, Dict[str, DirectoryScan]]:
+    # find the last access time for a file under a path, visiting each directory exactly once
+    # and keeping only the running maximum. Directories with the same mtime as in cached_dirs
+    # are not listed, their cached results are used instead. Only pass directories whose cached
+    # access times can be trusted, see AccessTimeCache.reusable_dirs
+    if os.path.isfile(fpath):
+        return datetime.datetime.fromtimestamp(
+            os.stat(fpath, follow_symlinks=False).st_atime), {}
+    cached_dirs = cached_dirs or {}
+    cached_subdirs = {}
+    for dpath, dscan in cached_dirs.items():
+        cached_subdirs.setdefault(dscan.parent, []).append(dpath)
+
+    last_access = min_access_time.timestamp()
+    scanned_dirs = {}
+    # directories are identified by device and inode, so that symlinks back up the tree or to
+    # an already visited directory do not scan it again
+    visited = set()
+    dirs_to_scan = [(fpath, "")]
+    while dirs_to_scan:
+        dpath, parent = dirs_to_scan.pop()
+        try:
+            st = os.stat(dpath)
+            if (st.st_dev, st.st_ino) in visited:
+                continue
+            visited.add((st.st_dev, st.st_ino))
+            mtime_ns = st.st_mtime_ns
+            cached = cached_dirs.get(dpath)
+            if cached is not None and cached.parent == parent and cached.mtime_ns == mtime_ns:
+                dscan, subdirs = cached, cached_subdirs.get(dpath, [])
+            else:
+                dscan, subdirs = _scan_directory(dpath, parent, mtime_ns)
+        except OSError:
+            # mimic os.walk, which silently skips directories that can not be listed
+            continue
+        scanned_dirs[dpath] = dscan
+        last_access = max(last_access, dscan.max_atime)
+        dirs_to_scan.extend((subdir, dpath) for subdir in subdirs)
+    return datetime.datetime.fromtimestamp(last_access), scanned_dirs
 
 
 def last_access_in_path(fpath: str) -> datetime.datetime:
-    # recursively find the last access time for a file under a path
-    a_times = [min_access_time]
-    if os.path.isfile(fpath):
-        return datetime.datetime.fromtimestamp(os.stat(fpath, follow_symlinks=False).st_atime)
-    for dirpath, dirnames, filenames in os.walk(fpath):
-        a_times.extend(
-            list(
-                filter(
-                    lambda x: x,
-                    [last_access_in_path(os.path.join(dirpath, dname)) for dname in dirnames] +
-                    [last_access_in_path(os.path.join(dirpath, fname)) for fname in filenames])))
-
-    return max(a_times)
+    # find the last access time for a file under a path
+    return scan_object(fpath)[0]
 
 
 def parse_path_and_date_file(path_and_date_file: str) -> List[Tuple[str, datetime.datetime]]:
@@ -48,13 +297,134 @@ def do_not_remove(fpath: str) -> bool:
     return "_do_not_remove" in fname.lower()
 
 
+def strip_do_not_remove(fname: str) -> str:
+    # strip the "_do_not_remove*" suffix from a name
+    return fname[0:fname.lower().index("_do_not_remove")]
+
+
+class DecisionLog:
+    # collects the include/exclude decision for each object and writes them in batches as JSON
+    # lines to log_file. A later decision for an object, e.g. a runfolder re-included because it
+    # contains an included project, supersedes the earlier one in the summary. What is printed
+    # depends on the verbosity: 0 prints nothing, 1 prints the number of objects per final
+    # decision and rule and 2 also prints every decision and scanned object
+
+    def __init__(
+            self,
+            log_file: Optional[str] = None,
+            verbosity: int = 1,
+            batch_size: int = 10000):
+        self.log_file = None
+        self.verbosity = verbosity
+        self.batch_size = batch_size
+        self._records = []
+        self._decisions = {}
+        self._fh = None
+        self.open(log_file, verbosity)
+
+    def open(self, log_file: Optional[str], verbosity: int) -> None:
+        # start logging to a new file, which is truncated
+        self.close()
+        self.log_file = log_file
+        self.verbosity = verbosity
+        self._decisions = {}
+        if log_file:
+            self._fh = open(log_file, "w", buffering=1024 * 1024)
+
+    def message(self, msg: str, level: int = 2) -> None:
+        if self.verbosity >= level:
+            print(msg)
+
+    def record(
+            self,
+            path: str,
+            action: str,
+            rule: str,
+            reason: str,
+            disk_date: Optional[datetime.datetime],
+            meta_date: Optional[datetime.datetime] = None,
+            flag_file: Optional[str] = None) -> None:
+        self.message(f"{path} is {action} because {reason}")
+        self._decisions[path] = (action, rule)
+        if self._fh is None:
+            return
+        self._records.append({
+            "path": path,
+            "action": action,
+            "rule": rule,
+            "reason": reason,
+            "disk_date": disk_date.isoformat() if disk_date else None,
+            "meta_date": meta_date.isoformat() if meta_date else None,
+            "flag_file": flag_file})
+        if len(self._records) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._fh is not None and self._records:
+            self._fh.write("".join(f"{json.dumps(record)}\n" for record in self._records))
+            self._fh.flush()
+        self._records = []
+
+    def close(self) -> None:
+        self.flush()
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def reset(self) -> None:
+        # forget the decisions summarized so far, e.g. before classifying the objects again
+        self._decisions = {}
+
+    def summary(self) -> Dict[Tuple[str, str], int]:
+        # the number of objects per action and rule of their last decision
+        counts = {}
+        for decision in self._decisions.values():
+            counts[decision] = counts.get(decision, 0) + 1
+        return counts
+
+    def print_summary(self) -> None:
+        for (action, rule), n in sorted(self.summary().items()):
+            self.message(f"{n}\t{action}\t{rule}", level=1)
+
+
+# the decisions made by do_exclude and include_runfolders_with_projects are recorded here
+decision_log = DecisionLog()
+
+
+class ExcludeIndex(NamedTuple):
+    # lookups needed to classify the objects in a directory, built once per directory. The
+    # do_not_remove_names map the flagged names to the name of the first flag found for them
+    meta_dates: Dict[str, datetime.datetime]
+    do_not_remove_names: Dict[str, str]
+
+
+def build_exclude_index(
+        fdir: str,
+        meta_path_and_dates: List[Tuple[str, datetime.datetime]]) -> ExcludeIndex:
+    # map the names in the meta data to their dates and collect the names that are flagged with
+    # a "_do_not_remove*" companion on disk in fdir or in the meta data
+    meta_dates = {}
+    for meta_path, meta_date in meta_path_and_dates:
+        # the first occurrence of a name in the meta data takes precedence
+        meta_dates.setdefault(os.path.basename(meta_path), meta_date)
+    disk_paths = os.listdir(fdir) if os.path.exists(fdir) else []
+    do_not_remove_names = {}
+    for p in disk_paths + list(meta_dates.keys()):
+        if do_not_remove(p):
+            do_not_remove_names.setdefault(strip_do_not_remove(p), p)
+    return ExcludeIndex(meta_dates, do_not_remove_names)
+
+
 def do_exclude(
         fpath: str,
         modification_date: datetime.datetime,
         date_cutoff: datetime.datetime,
-        meta_path_and_dates: List[Tuple[str, datetime.datetime]]) -> bool:
+        meta_path_and_dates: List[Tuple[str, datetime.datetime]],
+        exclude_index: Optional[ExcludeIndex] = None) -> bool:
+    # exclude_index can be supplied when classifying many objects in the same directory,
+    # otherwise it is built from meta_path_and_dates and the directory of fpath. The decision is
+    # recorded in the decision_log
 
-    msg = string.Template("${path} is ${action} because ${reason}")
     reasons = [
         f"{str(modification_date)} >= {str(date_cutoff)}",
         f"{str(modification_date)} in meta data >= {str(date_cutoff)}",
@@ -65,53 +435,38 @@ def do_exclude(
 
     # if disk modification date is after date_cutoff, return false
     if modification_date >= date_cutoff:
-        print(msg.substitute(
-            path=fpath,
-            action="included",
-            reason=reasons[0]))
+        decision_log.record(
+            fpath, "included", "recent_access", reasons[0], modification_date)
         return False
 
     fname = os.path.basename(fpath)
-    fdir = os.path.dirname(fpath)
-    meta_paths = [os.path.basename(p[0]) for p in meta_path_and_dates]
+    if exclude_index is None:
+        exclude_index = build_exclude_index(os.path.dirname(fpath), meta_path_and_dates)
     # if there is a modification date in the meta data after date cutoff, return false
-    try:
-        ix = meta_paths.index(fname)
-        if meta_path_and_dates[ix][1] >= date_cutoff:
-            print(msg.substitute(
-                path=fpath,
-                action="included",
-                reason=reasons[1]))
-            return False
-    except ValueError:
-        pass
+    meta_date = exclude_index.meta_dates.get(fname)
+    if meta_date is not None and meta_date >= date_cutoff:
+        decision_log.record(
+            fpath, "included", "recent_meta_date", reasons[1], modification_date, meta_date)
+        return False
 
     # if the path is labeled with "_do_not_remove*", return false
     if do_not_remove(fpath):
-        print(msg.substitute(
-            path=fpath,
-            action="included",
-            reason=reasons[2]))
+        decision_log.record(
+            fpath, "included", "do_not_remove_name", reasons[2], modification_date, meta_date,
+            fname)
         return False
 
     # if a path is accompanied with a "_do_not_remove*"-file on disk or in the meta data,
     # return false
-    disk_paths = os.listdir(fdir) if os.path.exists(fdir) else []
-    do_not_remove_flags = list(filter(lambda p: do_not_remove(p), disk_paths + meta_paths))
-    # strip the "_do_not_remove*" suffix from the names
-    do_not_remove_names = [p[0:p.lower().index("_do_not_remove")] for p in do_not_remove_flags]
-    if fname in do_not_remove_names:
-        print(msg.substitute(
-            path=fpath,
-            action="included",
-            reason=reasons[3]))
+    if fname in exclude_index.do_not_remove_names:
+        decision_log.record(
+            fpath, "included", "do_not_remove_companion", reasons[3], modification_date,
+            meta_date, exclude_index.do_not_remove_names[fname])
         return False
 
     # the path should not be kept because of date or "_do_not_remove*"-indicator, return True
-    print(msg.substitute(
-        path=fpath,
-        action="excluded",
-        reason=reasons[4]))
+    decision_log.record(
+        fpath, "excluded", "no_include_condition", reasons[4], modification_date, meta_date)
     return True
 
 
@@ -120,8 +475,12 @@ def include_exclude(
         path_and_dates: List[Tuple[str, datetime.datetime]],
         date_cutoff: datetime.datetime,
         meta_path_and_dates: List[Tuple[str, datetime.datetime]],
-        exclude_fn: Callable = do_exclude) -> List[List[str]]:
-    # determine what objects to include and exclude based on the exclude_fn
+        exclude_fn: Optional[Callable] = None) -> List[List[str]]:
+    # determine what objects to include and exclude based on the exclude_fn. By default, the
+    # objects are classified with do_exclude, using lookups built once for the search_path
+    if exclude_fn is None:
+        exclude_fn = functools.partial(
+            do_exclude, exclude_index=build_exclude_index(search_path, meta_path_and_dates))
     in_ex = [[], []]
     for obj, access_date in path_and_dates:
         in_ex[
@@ -136,59 +495,96 @@ def include_exclude(
 
 def get_path_and_dates(
         search_path: str,
-        cached_objects_and_dates: Optional[List[Tuple[str, datetime.datetime]]] = None)\
+        cached_objects_and_dates: Optional[List[Tuple[str, datetime.datetime]]] = None,
+        workers: int = scan_workers,
+        cache: Optional[AccessTimeCache] = None,
+        objs: Optional[List[str]] = None)\
         -> List[Tuple[str, datetime.datetime]]:
-    # list the objects in the search_path along with the last access time for files beneath it
-    path_and_dates = []
-    cached_obj_names = [obj_name for obj_name, obj_date in cached_objects_and_dates] \
-        if cached_objects_and_dates else []
-    for obj in os.listdir(search_path):
-        try:
-            path_and_dates.append((obj, cached_objects_and_dates[cached_obj_names.index(obj)][1]))
-            print(f"Using last access date for {os.path.join(search_path, obj)} from cache")
-        except ValueError:
-            print(f"Parsing last access date for {os.path.join(search_path, obj)}")
-            path_and_dates.append((obj, last_access_in_path(os.path.join(search_path, obj))))
-        print("\t".join(["", str(path_and_dates[-1][1])]))
+    # list the objects in the search_path (or the supplied objs) along with the last access time
+    # for files beneath it. Objects without a cached date are walked concurrently, one top-level
+    # object per task, and only the directories that changed since the scan stored in the cache
+    # are listed
+    cached_dates = dict(cached_objects_and_dates) if cached_objects_and_dates else {}
+
+    def _scan(obj_path: str) -> Tuple[datetime.datetime, Dict[str, DirectoryScan]]:
+        return scan_object(obj_path, cache.reusable_dirs(obj_path) if cache else None)
+
+    objs = os.listdir(search_path) if objs is None else objs
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        scans = {
+            obj: executor.submit(_scan, os.path.join(search_path, obj))
+            for obj in objs if obj not in cached_dates}
+        path_and_dates = []
+        for obj in objs:
+            obj_path = os.path.join(search_path, obj)
+            if obj in cached_dates:
+                path_and_dates.append((obj, cached_dates[obj]))
+                decision_log.message(f"Using last access date for {obj_path} from cache")
+            else:
+                decision_log.message(f"Parsing last access date for {obj_path}")
+                last_access, scanned_dirs = scans.pop(obj).result()
+                if cache:
+                    cache.update(obj_path, scanned_dirs)
+                path_and_dates.append((obj, last_access))
+            decision_log.message("\t".join(["", str(path_and_dates[-1][1])]))
     return path_and_dates
 
 
+def _cache_file(object_path: str) -> str:
+    cache_file = object_path.replace("/", "_")
+    return f"{cache_file}.cached.sqlite"
+
+
 def _sort_objects(
         object_path: str,
         object_date_file: str,
-        date_cutoff: datetime.datetime) -> List[List[str]]:
+        date_cutoff: datetime.datetime,
+        workers: int = scan_workers,
+        cached_objects_and_dates: Optional[List[Tuple[str, datetime.datetime]]] = None,
+        trust_cache_hours: float = 0) \
+        -> List[List[str]]:
     # sort objects to include and exclude under object_path based on object_date_file and disk
-    cached_object_date_file = object_path.replace("/", "_")
-    cached_object_date_file = f"{cached_object_date_file}.cached.txt"
-    cached_objects_and_dates = parse_path_and_date_file(cached_object_date_file) \
-        if os.path.exists(cached_object_date_file) else None
-    path_objects_and_dates = get_path_and_dates(object_path, cached_objects_and_dates)
-    with open(cached_object_date_file, "w") as fh:
-        for obj in path_objects_and_dates:
-            line = "\t".join([str(obj[0]), obj[1].strftime("%y%m%d")])
-            fh.write(f"{line}\n")
+    path_objects_and_dates = get_path_and_dates(
+        object_path,
+        cached_objects_and_dates,
+        workers=workers,
+        cache=AccessTimeCache(_cache_file(object_path), trust_cache_hours))
 
     meta_objects_and_dates = parse_path_and_date_file(object_date_file)
     in_ex = include_exclude(
         object_path, path_objects_and_dates, date_cutoff, meta_objects_and_dates)
-    # if a object is both in include and exclude, let include have precedence
-    return [in_ex[0], list(set(in_ex[1]).difference(set(in_ex[0])))]
+    # if a object is both in include and exclude, let include have precedence. The exclude list
+    # keeps the order from disk so that the output is reproducible
+    included = set(in_ex[0])
+    return [in_ex[0], list(dict.fromkeys(obj for obj in in_ex[1] if obj not in included))]
 
 
 def sort_projects(
         project_path: str,
         project_date_file: str,
-        date_cutoff: datetime.datetime) -> List[List[str]]:
+        date_cutoff: datetime.datetime,
+        workers: int = scan_workers,
+        cached_objects_and_dates: Optional[List[Tuple[str, datetime.datetime]]] = None,
+        trust_cache_hours: float = 0) \
+        -> List[List[str]]:
     return _sort_objects(
-        object_path=project_path, object_date_file=project_date_file, date_cutoff=date_cutoff)
+        object_path=project_path, object_date_file=project_date_file, date_cutoff=date_cutoff,
+        workers=workers, cached_objects_and_dates=cached_objects_and_dates,
+        trust_cache_hours=trust_cache_hours)
 
 
 def sort_runfolders(
         runfolder_path: str,
         runfolder_date_file: str,
-        date_cutoff: datetime.datetime) -> List[List[str]]:
+        date_cutoff: datetime.datetime,
+        workers: int = scan_workers,
+        cached_objects_and_dates: Optional[List[Tuple[str, datetime.datetime]]] = None,
+        trust_cache_hours: float = 0) \
+        -> List[List[str]]:
     return _sort_objects(
-        object_path=runfolder_path, object_date_file=runfolder_date_file, date_cutoff=date_cutoff)
+        object_path=runfolder_path, object_date_file=runfolder_date_file, date_cutoff=date_cutoff,
+        workers=workers, cached_objects_and_dates=cached_objects_and_dates,
+        trust_cache_hours=trust_cache_hours)
 
 
 def list_projects_in_runfolder(
@@ -210,62 +606,572 @@ def include_runfolders_with_projects(
     # the included runfolders list
     in_ex = [runfolders_in, []]
     projects_in_strip_do_not_remove = [
-        p[0:p.lower().index("_do_not_remove")]
-        for p in filter(lambda p: do_not_remove(p), projects_in)]
+        strip_do_not_remove(p) for p in filter(lambda p: do_not_remove(p), projects_in)]
+    projects_to_keep = set(projects_in + projects_in_strip_do_not_remove)
     for runfolder_name in runfolders_ex:
-        in_ex[int(
-          set(projects_in + projects_in_strip_do_not_remove).isdisjoint(
-            set(list(map(
-                lambda p: p,
-                list_projects_in_runfolder(
-                    os.path.join(runfolder_path, runfolder_name)))))))].append(runfolder_name)
+        runfolder_projects_to_keep = projects_to_keep.intersection(
+            list_projects_in_runfolder(os.path.join(runfolder_path, runfolder_name)))
+        in_ex[int(not runfolder_projects_to_keep)].append(runfolder_name)
+        if runfolder_projects_to_keep:
+            decision_log.record(
+                os.path.join(runfolder_path, runfolder_name),
+                "included",
+                "contains_included_project",
+                f"it contains included projects {', '.join(sorted(runfolder_projects_to_keep))}",
+                None)
     return in_ex
 
 
 def get_include_and_exclude(
         runfolder_path: str, project_path: str, runfolder_date_file: str, project_date_file: str,
-        date_cutoff: datetime.datetime) -> List[List[List[str]]]:
-    in_ex = [sort_projects(project_path, project_date_file, date_cutoff)]
-    runfolders_in_ex = sort_runfolders(runfolder_path, runfolder_date_file, date_cutoff)
+        date_cutoff: datetime.datetime, workers: int = scan_workers,
+        cached_path_and_dates: Optional[Dict[str, List[Tuple[str, datetime.datetime]]]] = None,
+        trust_cache_hours: float = 0) \
+        -> List[List[List[str]]]:
+    # cached_path_and_dates can hold already known object dates for the project_path and
+    # runfolder_path, e.g. as collected by scan shards
+    cached_path_and_dates = cached_path_and_dates or {}
+    in_ex = [sort_projects(
+        project_path, project_date_file, date_cutoff, workers=workers,
+        cached_objects_and_dates=cached_path_and_dates.get(project_path),
+        trust_cache_hours=trust_cache_hours)]
+    runfolders_in_ex = sort_runfolders(
+        runfolder_path, runfolder_date_file, date_cutoff, workers=workers,
+        cached_objects_and_dates=cached_path_and_dates.get(runfolder_path),
+        trust_cache_hours=trust_cache_hours)
     in_ex.append(
       include_runfolders_with_projects(
         runfolder_path, runfolders_in_ex[0], runfolders_in_ex[1], in_ex[0][0]))
     return in_ex
 
 
+def atime_age_histogram(
+        atime_months: Dict[int, int], reference_date: datetime.datetime) -> List[int]:
+    # bin the number of files accessed per month by their age in months at the reference date
+    reference_month = reference_date.year * 12 + reference_date.month - 1
+    histogram = [0] * len(atime_age_bins)
+    for month, n in atime_months.items():
+        age = max(0, reference_month - month)
+        for k, (lower, upper) in enumerate(atime_age_bins):
+            if upper is None or lower <= age < upper:
+                histogram[k] += n
+                break
+    return histogram
+
+
+def _object_stats_headers() -> List[str]:
+    age_headers = [
+        f"atime_age_{lower}-{upper}m" if upper is not None else f"atime_age_{lower}m+"
+        for lower, upper in atime_age_bins]
+    return [
+        "path",
+        "last_access",
+        "allocated_bytes",
+        "apparent_bytes",
+        "files",
+        "directories"] + age_headers
+
+
+def _write_stats_table(rows: List[List], outfile: str) -> None:
+    # write rows with a path, a last access date and numeric values as a tab-separated table,
+    # along with a row with the totals of the numeric values
+    headers = _object_stats_headers()
+    totals = [0] * (len(headers) - 2)
+    with open(outfile, "w") as fh:
+        fh.write("\t".join(headers) + "\n")
+        for row in rows:
+            totals = [total + value for total, value in zip(totals, row[2:])]
+            fh.write("\t".join(map(str, row)) + "\n")
+        fh.write("\t".join(["total", ""] + list(map(str, totals))) + "\n")
+
+
+def read_stats_table(stats_file: str) -> Dict[str, List]:
+    # read the rows of a table written by write_object_stats, keyed by path
+    rows = {}
+    with open(stats_file) as fh:
+        next(fh)
+        for line in fh:
+            row = line.rstrip("\n").split("\t")
+            if row[0] != "total":
+                rows[row[0]] = row[0:2] + list(map(int, row[2:]))
+    return rows
+
+
+def write_object_stats(
+        obj_paths: List[str],
+        stats_fn: Callable[[str], ObjectStats],
+        outfile: str,
+        reference_date: Optional[datetime.datetime] = None) -> None:
+    # write the size, file count and access age histogram for each object and the totals for
+    # all objects as a tab-separated table
+    reference_date = reference_date or datetime.datetime.now()
+    rows = []
+    for obj_path in obj_paths:
+        stats = stats_fn(obj_path)
+        rows.append([
+            obj_path,
+            stats.last_access.strftime("%y%m%d"),
+            stats.allocated_bytes,
+            stats.apparent_bytes,
+            stats.n_files,
+            stats.n_dirs] + atime_age_histogram(stats.atime_months, reference_date))
+    _write_stats_table(rows, outfile)
+
+
+def diff_snapshots(old_dir: str, new_dir: str) -> List[Tuple[str, str]]:
+    # compare the include and exclude stats tables written by two runs and list the objects that
+    # are newly included, newly excluded and included in both runs but with a changed last
+    # access date. Each group is written as a path list and a stats table with its totals
+    suffixes = {typ: f".{typ}.stats.tsv" for typ in ["include", "exclude"]}
+    prefixes = sorted(set(
+        os.path.basename(stats_file)[0:-len(suffixes["include"])]
+        for stats_dir in [old_dir, new_dir]
+        for stats_file in glob.glob(os.path.join(stats_dir, f"*{suffixes['include']}"))))
+
+    def _read(stats_dir: str, prefix: str, typ: str) -> Dict[str, List]:
+        stats_file = os.path.join(stats_dir, f"{prefix}{suffixes[typ]}")
+        return read_stats_table(stats_file) if os.path.exists(stats_file) else {}
+
+    delta_files = []
+    for prefix in prefixes:
+        old_in, new_in = _read(old_dir, prefix, "include"), _read(new_dir, prefix, "include")
+        old_ex, new_ex = _read(old_dir, prefix, "exclude"), _read(new_dir, prefix, "exclude")
+        groups = {
+            "newly_included": [row for path, row in new_in.items() if path not in old_in],
+            "newly_excluded": [row for path, row in new_ex.items() if path not in old_ex],
+            "changed_access": [
+                row for path, row in new_in.items()
+                if path in old_in and old_in[path][1] != row[1]],
+        }
+        for group, rows in groups.items():
+            outfile = f"{prefix}.{group}.txt"
+            with open(outfile, "w") as fh:
+                fh.writelines(f"{row[0]}\n" for row in rows)
+            _write_stats_table(rows, f"{prefix}.{group}.stats.tsv")
+            delta_files.append((outfile, f"{prefix}.{group}.stats.tsv"))
+    return delta_files
+
+
 def sort_projects_and_runfolders(
         project_date_file: str,
         runfolder_date_file: str,
         irma_end_date: datetime.datetime,
         grace_period: int,
         runfolder_path: str = "/proj/ngi2016001/incoming",
-        project_path: str = "/proj/ngi2016001/nobackup/NGI/ANALYSIS") -> List[Tuple[str, str]]:
+        project_path: str = "/proj/ngi2016001/nobackup/NGI/ANALYSIS",
+        workers: int = scan_workers,
+        cached_path_and_dates: Optional[Dict[str, List[Tuple[str, datetime.datetime]]]] = None,
+        object_stats: Optional[Dict[str, ObjectStats]] = None,
+        trust_cache_hours: float = 0) \
+        -> List[Tuple[str, str]]:
+    # object_stats can hold already known stats for the objects, stats for other objects are
+    # taken from the scan cache
+    object_stats = object_stats or {}
+    # the summary is of this run only when the module is used as a library
+    decision_log.reset()
     date_cutoff = determine_date_cutoff(irma_end_date, grace_period)
     in_ex = get_include_and_exclude(
-      runfolder_path, project_path, runfolder_date_file, project_date_file, date_cutoff)
+      runfolder_path, project_path, runfolder_date_file, project_date_file, date_cutoff,
+      workers=workers, cached_path_and_dates=cached_path_and_dates,
+      trust_cache_hours=trust_cache_hours)
     in_ex_files = []
     for i, search_path in enumerate([project_path, runfolder_path]):
         prefix = search_path.replace("/", "_")
+        cache = AccessTimeCache(_cache_file(search_path))
+
+        def _stats(obj_path: str) -> ObjectStats:
+            return object_stats[obj_path] if obj_path in object_stats \
+                else cache.object_stats(obj_path)
+
         tf = []
         for j, typ in enumerate(["include", "exclude"]):
             outfile = f"{prefix}.{typ}.txt"
             with open(outfile, "w") as fh:
                 fh.writelines(map(lambda obj: f"{os.path.join(search_path, obj)}\n", in_ex[i][j]))
+            write_object_stats(
+                [os.path.join(search_path, obj) for obj in in_ex[i][j]],
+                _stats,
+                f"{prefix}.{typ}.stats.tsv")
             tf.append(outfile)
         in_ex_files.append((tf[0], tf[1]))
     return in_ex_files
 
 
+def parse_listing_line(line: str) -> Tuple[float, int, Optional[int], Optional[str], str]:
+    # parse a line from a file listing with the access time, the size, optionally the number of
+    # 512-byte blocks and the file type and finally the path, separated by spaces, e.g. as
+    # produced by find -printf '%A@ %s %b %y %p\n' or find -printf '%A@ %s %p\n'
+    atime, size, path = line.rstrip("\n").split(" ", 2)
+    blocks, ftype = None, None
+    field, _, rest = path.partition(" ")
+    if field.isdigit() and rest:
+        blocks = int(field)
+        path = rest
+        field, _, rest = path.partition(" ")
+    if len(field) == 1 and rest:
+        ftype = field
+        path = rest
+    return float(atime), int(size), blocks, ftype, path
+
+
+class ListingAggregator:
+    # aggregates the last access time, sizes and access months of the entries in a file listing
+    # per top-level object under a set of root paths. Only one aggregate per object is kept in
+    # memory, and since listings are typically grouped by directory, the prefix of the last
+    # matched object is checked first
+
+    def __init__(self, roots: List[str]):
+        self.roots = [root.rstrip("/") for root in roots]
+        # [max atime, allocated bytes, apparent bytes, files, directories, atime months,
+        #  is a file]
+        self.objects = {root: {} for root in self.roots}
+        self._last_prefix = None
+        self._last_obj = None
+        self._hour_months = {}
+
+    def _atime_month(self, atime: float) -> int:
+        hour = int(atime // 3600)
+        if hour not in self._hour_months:
+            self._hour_months[hour] = _atime_month(atime)
+        return self._hour_months[hour]
+
+    def add(
+            self,
+            atime: float,
+            size: int,
+            blocks: Optional[int],
+            ftype: Optional[str],
+            path: str) -> None:
+        if self._last_prefix is not None and path.startswith(self._last_prefix):
+            obj = self._last_obj
+        else:
+            for root in self.roots:
+                if not path.startswith(root) or path[len(root):len(root) + 1] != "/":
+                    continue
+                name, sep, _ = path[len(root) + 1:].partition("/")
+                if not name:
+                    return
+                obj = self.objects[root].setdefault(name, [0.0, 0, 0, 0, 0, {}, False])
+                if not sep:
+                    # this is the entry for the object itself
+                    obj[6] = ftype is not None and ftype != "d"
+                    if ftype == "d":
+                        return
+                    break
+                self._last_prefix = f"{root}/{name}/"
+                self._last_obj = obj
+                break
+            else:
+                return
+        if ftype == "d":
+            obj[4] += 1
+            return
+        obj[0] = max(obj[0], atime)
+        obj[1] += blocks * 512 if blocks is not None else size
+        obj[2] += size
+        obj[3] += 1
+        month = self._atime_month(atime)
+        obj[5][month] = obj[5].get(month, 0) + 1
+
+    def object_stats(self, root: str) -> Dict[str, ObjectStats]:
+        # the stats for the objects under a root, keyed by object path. Objects that are
+        # directories have their last access time limited to min_access_time, as when walking them
+        stats = {}
+        for name, obj in self.objects[root.rstrip("/")].items():
+            last_access = obj[0] if obj[6] else max(obj[0], min_access_time.timestamp())
+            stats[os.path.join(root, name)] = ObjectStats(
+                datetime.datetime.fromtimestamp(last_access), *obj[1:6])
+        return stats
+
+
+def aggregate_listing(listing_file: str, roots: List[str]) -> ListingAggregator:
+    # stream a, possibly gzipped, file listing and aggregate the entries per object under roots
+    aggregator = ListingAggregator(roots)
+    opener = gzip.open if listing_file.endswith(".gz") else open
+    with opener(listing_file, "rt", errors="surrogateescape") as fh:
+        for line in fh:
+            try:
+                aggregator.add(*parse_listing_line(line))
+            except ValueError:
+                print(f"Skipping unparseable line in {listing_file}: {line.rstrip()}")
+    return aggregator
+
+
+def sort_projects_and_runfolders_from_listing(
+        listing_file: str,
+        project_date_file: str,
+        runfolder_date_file: str,
+        irma_end_date: datetime.datetime,
+        grace_period: int,
+        runfolder_path: str = "/proj/ngi2016001/incoming",
+        project_path: str = "/proj/ngi2016001/nobackup/NGI/ANALYSIS",
+        workers: int = scan_workers,
+        trust_cache_hours: float = 0) -> List[Tuple[str, str]]:
+    # sort the projects and runfolders using the access times and sizes from a pre-generated
+    # file listing instead of walking the file system. Only objects that are on disk but missing
+    # from the listing, i.e. that were created after it, are walked
+    aggregator = aggregate_listing(listing_file, [project_path, runfolder_path])
+    cached_path_and_dates = {}
+    object_stats = {}
+    for search_path in [project_path, runfolder_path]:
+        search_path_stats = aggregator.object_stats(search_path)
+        cached_path_and_dates[search_path] = [
+            (os.path.basename(obj_path), stats.last_access)
+            for obj_path, stats in search_path_stats.items()]
+        object_stats.update(search_path_stats)
+    return sort_projects_and_runfolders(
+        project_date_file,
+        runfolder_date_file,
+        irma_end_date,
+        grace_period,
+        runfolder_path=runfolder_path,
+        project_path=project_path,
+        workers=workers,
+        cached_path_and_dates=cached_path_and_dates,
+        object_stats=object_stats,
+        trust_cache_hours=trust_cache_hours)
+
+
+def _shard_file(shard_index: int) -> str:
+    return f"irma_to_miarka.shard_{shard_index}.tsv"
+
+
+def _shard_cache_file(shard_index: int) -> str:
+    return f"irma_to_miarka.shard_{shard_index}.cached.sqlite"
+
+
+def plan_shards(
+        search_paths: List[str],
+        n_shards: int,
+        plan_file: str = shard_plan_file) -> List[List[Tuple[str, str]]]:
+    # assign the objects under the search paths to shards, balanced on the number of files
+    # in each object according to the cache. Objects that are not cached are assumed to have the
+    # mean number of files of the cached objects. The objects are assigned largest first to the
+    # shard with the least files so far, and the plan is written as shard index, search path and
+    # object name
+    objects = []
+    for search_path in search_paths:
+        file_counts = AccessTimeCache(_cache_file(search_path)).file_counts()
+        for obj in os.listdir(search_path):
+            objects.append((search_path, obj, file_counts.get(os.path.join(search_path, obj))))
+    known_counts = [n for _, _, n in objects if n is not None]
+    default_count = sum(known_counts) / len(known_counts) if known_counts else 1
+
+    shards = [[] for _ in range(n_shards)]
+    shard_loads = [(0, shard_index) for shard_index in range(n_shards)]
+    for search_path, obj, n in sorted(
+            objects, key=lambda o: o[2] if o[2] is not None else default_count, reverse=True):
+        load, shard_index = heapq.heappop(shard_loads)
+        shards[shard_index].append((search_path, obj))
+        heapq.heappush(
+            shard_loads, (load + (n if n is not None else default_count), shard_index))
+
+    with open(plan_file, "w") as fh:
+        for shard_index, shard in enumerate(shards):
+            fh.writelines(
+                f"{shard_index}\t{search_path}\t{obj}\n" for search_path, obj in shard)
+    return shards
+
+
+def read_shard_plan(plan_file: str = shard_plan_file) -> List[List[Tuple[str, str]]]:
+    shards = []
+    with open(plan_file) as fh:
+        for line in fh:
+            shard_index, search_path, obj = line.rstrip("\n").split("\t")
+            while len(shards) <= int(shard_index):
+                shards.append([])
+            shards[int(shard_index)].append((search_path, obj))
+    return shards
+
+
+def scan_shard(
+        shard_index: int,
+        plan_file: str = shard_plan_file,
+        workers: int = scan_workers,
+        trust_cache_hours: float = 0) -> str:
+    # scan the objects assigned to a shard and write their last access dates to the shard file.
+    # The shard reads the shared caches but writes its directory results to its own cache file,
+    # which is imported into the shared caches when the shards are merged
+    shards = read_shard_plan(plan_file)
+    # shards that got no objects are not in the plan and give an empty shard file
+    shard = shards[shard_index] if shard_index < len(shards) else []
+    if os.path.exists(_shard_cache_file(shard_index)):
+        os.unlink(_shard_cache_file(shard_index))
+    shard_cache = AccessTimeCache(_shard_cache_file(shard_index), trust_cache_hours)
+    with open(_shard_file(shard_index), "w") as fh:
+        for search_path in dict.fromkeys(search_path for search_path, _ in shard):
+            objs = [obj for obj_search_path, obj in shard if obj_search_path == search_path]
+            shard_cache.import_objects(
+                _cache_file(search_path), [os.path.join(search_path, obj) for obj in objs])
+            for obj, last_access in get_path_and_dates(
+                    search_path, workers=workers, cache=shard_cache, objs=objs):
+                fh.write(f"{search_path}\t{obj}\t{last_access.isoformat()}\n")
+    return _shard_file(shard_index)
+
+
+def merge_shards(
+        project_date_file: str,
+        runfolder_date_file: str,
+        irma_end_date: datetime.datetime,
+        grace_period: int,
+        runfolder_path: str = "/proj/ngi2016001/incoming",
+        project_path: str = "/proj/ngi2016001/nobackup/NGI/ANALYSIS",
+        plan_file: str = shard_plan_file,
+        workers: int = scan_workers) -> List[Tuple[str, str]]:
+    # combine the shard results into the shared caches and sort the objects as a single
+    # process run would, using the dates from the shards
+    cached_path_and_dates = {}
+    for shard_index, shard in enumerate(read_shard_plan(plan_file)):
+        if not os.path.exists(_shard_file(shard_index)):
+            raise FileNotFoundError(
+                f"Results for shard {shard_index} not found in {_shard_file(shard_index)}")
+        with open(_shard_file(shard_index)) as fh:
+            for line in fh:
+                search_path, obj, last_access = line.rstrip("\n").split("\t")
+                cached_path_and_dates.setdefault(search_path, []).append(
+                    (obj, datetime.datetime.fromisoformat(last_access)))
+        for search_path in dict.fromkeys(search_path for search_path, _ in shard):
+            AccessTimeCache(_cache_file(search_path)).import_objects(
+                _shard_cache_file(shard_index),
+                [os.path.join(search_path, obj) for obj_search_path, obj in shard
+                 if obj_search_path == search_path])
+    return sort_projects_and_runfolders(
+        project_date_file,
+        runfolder_date_file,
+        irma_end_date,
+        grace_period,
+        runfolder_path=runfolder_path,
+        project_path=project_path,
+        workers=workers,
+        cached_path_and_dates=cached_path_and_dates)
+
+
+class TransferItem(NamedTuple):
+    path: str
+    n_bytes: int
+    n_files: int
+
+
+def split_transfer_item(item: TransferItem) -> List[TransferItem]:
+    # split an object at its first directory level, using the sizes from the scan cache for the
+    # subdirectories. The files directly in the object become items of their own. Objects that
+    # are not in the cache are not split
+    cache_file = _cache_file(os.path.dirname(item.path))
+    if not os.path.isdir(item.path) or not os.path.exists(cache_file):
+        return [item]
+    subdir_sizes = {}
+    for dpath, dscan in AccessTimeCache(cache_file).cached_dirs(item.path).items():
+        if dpath == item.path:
+            continue
+        subdir = os.path.join(item.path, os.path.relpath(dpath, item.path).split(os.sep)[0])
+        n_bytes, n_files = subdir_sizes.get(subdir, (0, 0))
+        subdir_sizes[subdir] = (n_bytes + dscan.apparent_bytes, n_files + dscan.n_files)
+    if not subdir_sizes:
+        return [item]
+    items = [TransferItem(subdir, *sizes) for subdir, sizes in subdir_sizes.items()]
+    with os.scandir(item.path) as entries:
+        for entry in entries:
+            if not entry.is_dir(follow_symlinks=False):
+                items.append(
+                    TransferItem(entry.path, entry.stat(follow_symlinks=False).st_size, 1))
+    return items
+
+
+def plan_transfer_batches(stats_files: List[str], n_batches: int) -> List[List[TransferItem]]:
+    # distribute the objects in the stats tables over n_batches batches, balanced on both the
+    # number of bytes and files. Objects larger than a balanced batch are split at their first
+    # directory level. The items are then assigned, largest first, to the batch where the larger
+    # of its relative byte and file loads grows the least
+    items = []
+    for stats_file in stats_files:
+        for path, row in read_stats_table(stats_file).items():
+            items.append(TransferItem(path, row[3], row[4]))
+    total_bytes = max(1, sum(item.n_bytes for item in items))
+    total_files = max(1, sum(item.n_files for item in items))
+    split_items = []
+    for item in items:
+        if item.n_bytes > total_bytes / n_batches or item.n_files > total_files / n_batches:
+            split_items.extend(split_transfer_item(item))
+        else:
+            split_items.append(item)
+
+    def _load(item: TransferItem) -> Tuple[float, float]:
+        return item.n_bytes / total_bytes, item.n_files / total_files
+
+    batches = [[] for _ in range(n_batches)]
+    batch_loads = [(0.0, 0.0)] * n_batches
+    for item in sorted(split_items, key=lambda i: (-max(_load(i)), i.path)):
+        byte_load, file_load = _load(item)
+        k = min(
+            range(n_batches),
+            key=lambda b: (
+                max(batch_loads[b][0] + byte_load, batch_loads[b][1] + file_load),
+                sum(batch_loads[b]),
+                b))
+        batches[k].append(item)
+        batch_loads[k] = (batch_loads[k][0] + byte_load, batch_loads[k][1] + file_load)
+    return batches
+
+
+def write_transfer_batches(
+        batches: List[List[TransferItem]],
+        destination: str,
+        prefix: str = "irma_to_miarka") -> List[str]:
+    # write one rsync --files-from list per batch, a summary of the batch sizes and a SLURM array
+    # job script that transfers one batch per array task
+    batch_files = []
+    with open(f"{prefix}.batches.tsv", "w") as fh:
+        fh.write("\t".join(["batch", "list", "objects", "apparent_bytes", "files"]) + "\n")
+        for k, batch in enumerate(batches):
+            batch_file = f"{prefix}.batch_{k}.txt"
+            with open(batch_file, "w") as bfh:
+                bfh.writelines(f"{item.path}\n" for item in batch)
+            fh.write("\t".join(map(str, [
+                k,
+                batch_file,
+                len(batch),
+                sum(item.n_bytes for item in batch),
+                sum(item.n_files for item in batch)])) + "\n")
+            batch_files.append(batch_file)
+
+    sbatch_file = f"{prefix}.batches.sbatch"
+    with open(sbatch_file, "w") as fh:
+        fh.write(f"""#! /bin/bash -l
+
+#SBATCH -A ngi2016001
+#SBATCH -n 2
+#SBATCH -J {prefix}_transfer
+#SBATCH -t 10-00:00:00
+#SBATCH --array=0-{len(batches) - 1}
+#SBATCH -o {prefix}_transfer.%A_%a.out
+
+#
+# Transfer one batch of {prefix}.batch_<n>.txt per array task, submit with sbatch from
+# {os.getcwd()}
+#
+
+rsync -a -r --files-from="{prefix}.batch_${{SLURM_ARRAY_TASK_ID}}.txt" / "{destination}"
+""")
+    return batch_files + [f"{prefix}.batches.tsv", sbatch_file]
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Compile include and exclude lists of files for migration from Irma to Miarka, '
-                    'based on grace period and indicator files')
+                    'based on grace period and indicator files',
+        epilog='The scan can be split across SLURM array tasks: run once with --shard-step plan '
+               '--shards N, then submit --shard-step scan as an array job with --array=0-<N-1> '
+               'and finally run --shard-step merge, all from the same working directory. '
+               'Scan results are cached per directory in <path>.cached.sqlite files in the '
+               'working directory, for the stats tables, shard plans and transfer batches.')
     parser.add_argument(
         'projects',
+        nargs='?',
         help='Two-column, tab-separated file with delivered projects and delivery dates, e.g. '
              'extracted from arteria')
     parser.add_argument(
         'runfolders',
+        nargs='?',
         help='Two-column, tab-separated file with delivered runfolders and delivery dates, e.g. '
              'extracted from arteria')
     parser.add_argument(
@@ -290,22 +1196,166 @@ if __name__ == '__main__':
         required=False,
         default=90,
         help='The grace period in days to keep data after delivery (default: %(default)s days).')
+    parser.add_argument(
+        '--workers',
+        required=False,
+        type=int,
+        default=scan_workers,
+        help='The number of top-level objects to scan for access times in parallel '
+             '(default: %(default)s).')
+    parser.add_argument(
+        '--trust-cache',
+        required=False,
+        type=float,
+        default=0,
+        metavar='HOURS',
+        help='Reuse the cached access times of a directory whose mtime is unchanged if it was '
+             'scanned less than HOURS ago, instead of listing it again. Reads and rewrites of '
+             'existing files do not change the mtime of their directory, so accesses within the '
+             'window can be missed. By default every directory is listed again '
+             '(default: %(default)s).')
+    parser.add_argument(
+        '--shard-step',
+        required=False,
+        choices=['plan', 'scan', 'merge'],
+        help='Run one step of a sharded scan instead of a single process scan. The plan step '
+             f'writes the objects assigned to each shard to {shard_plan_file}, the scan step '
+             'scans the objects of one shard and the merge step writes the include and exclude '
+             'lists from the shard results.')
+    parser.add_argument(
+        '--shards',
+        required=False,
+        type=int,
+        default=1,
+        help='The number of shards to split the scan into in the plan step '
+             '(default: %(default)s).')
+    parser.add_argument(
+        '--shard-index',
+        required=False,
+        type=int,
+        default=os.environ.get("SLURM_ARRAY_TASK_ID"),
+        help='The shard to scan in the scan step (default: $SLURM_ARRAY_TASK_ID).')
+    parser.add_argument(
+        '--listing',
+        required=False,
+        help='Take the access times and sizes from a, possibly gzipped, file listing instead of '
+             'walking the file system. Each line should hold the access time, size, optionally '
+             'the number of blocks and the file type and finally the path, separated by spaces, '
+             "e.g. as produced by find <path> -printf '%%A@ %%s %%b %%y %%p\\n'. Without the "
+             'file type, directory access times are counted as well.')
+
+    parser.add_argument(
+        '--decision-log',
+        required=False,
+        default="irma_to_miarka.decisions.jsonl",
+        help='Write the include/exclude decision for each object as JSON lines to this file, '
+             'an empty string disables it (default: %(default)s).')
+    parser.add_argument(
+        '--verbosity',
+        required=False,
+        type=int,
+        choices=[0, 1, 2],
+        default=1,
+        help='0 prints nothing, 1 prints the number of decisions per rule and 2 also prints each '
+             'decision and scanned object (default: %(default)s).')
+    parser.add_argument(
+        '--diff',
+        required=False,
+        nargs=2,
+        metavar=('OLD_DIR', 'NEW_DIR'),
+        help='Instead of sorting, compare the include and exclude stats tables written by two '
+             'previous runs to the directories OLD_DIR and NEW_DIR and write lists of the '
+             'objects that are newly included, newly excluded or included with a changed last '
+             'access date, along with their totals. The projects and runfolders arguments are '
+             'not needed in this mode.')
+    parser.add_argument(
+        '--transfer-batches',
+        required=False,
+        type=int,
+        metavar='K',
+        help='Instead of sorting, split the objects in the stats tables given by --batch-stats '
+             'into K transfer batches balanced on bytes and files, and write one rsync '
+             '--files-from list per batch along with a SLURM array job script. The projects and '
+             'runfolders arguments are not needed in this mode.')
+    parser.add_argument(
+        '--batch-stats',
+        required=False,
+        nargs='+',
+        help='The stats tables with the objects to transfer (default: the include stats tables '
+             'for --project-path and --runfolder-path in the working directory).')
+    parser.add_argument(
+        '--destination',
+        required=False,
+        help='The rsync destination for the transfer batches, e.g. <host>:/path/')
 
     args = parser.parse_args()
+    if args.diff:
+        pprint.pprint(diff_snapshots(*args.diff))
+        sys.exit(0)
+    if args.transfer_batches:
+        if not args.destination:
+            parser.error("--destination is required with --transfer-batches")
+        batch_stats = args.batch_stats or [
+            f"{search_path.replace('/', '_')}.include.stats.tsv"
+            for search_path in [args.project_path, args.runfolder_path]]
+        pprint.pprint(write_transfer_batches(
+            plan_transfer_batches(batch_stats, args.transfer_batches), args.destination))
+        sys.exit(0)
+    if not (args.projects and args.runfolders):
+        parser.error("the projects and runfolders arguments are required")
     project_date_file = args.projects
     runfolder_date_file = args.runfolders
     project_path = args.project_path
     runfolder_path = args.runfolder_path
     irma_end_date = datetime.datetime.strptime(args.irma_end_date, "%y%m%d")
     grace_period = int(args.grace_period)
-    file_lists = sort_projects_and_runfolders(
-        project_date_file,
-        runfolder_date_file,
-        irma_end_date,
-        grace_period,
-        project_path=project_path,
-        runfolder_path=runfolder_path)
-    pprint.pprint(file_lists)
+    workers = args.workers
+    decision_log.open(None, args.verbosity)
+    if args.shard_step == "plan":
+        plan_shards([project_path, runfolder_path], args.shards)
+        pprint.pprint(shard_plan_file)
+    elif args.shard_step == "scan":
+        if args.shard_index is None:
+            parser.error("--shard-index is required for the scan step")
+        pprint.pprint(scan_shard(
+            int(args.shard_index), workers=workers, trust_cache_hours=args.trust_cache))
+    elif args.listing:
+        decision_log.open(args.decision_log, args.verbosity)
+        file_lists = sort_projects_and_runfolders_from_listing(
+            args.listing,
+            project_date_file,
+            runfolder_date_file,
+            irma_end_date,
+            grace_period,
+            project_path=project_path,
+            runfolder_path=runfolder_path,
+            workers=workers,
+            trust_cache_hours=args.trust_cache)
+        pprint.pprint(file_lists)
+    else:
+        decision_log.open(args.decision_log, args.verbosity)
+        if args.shard_step == "merge":
+            file_lists = merge_shards(
+                project_date_file,
+                runfolder_date_file,
+                irma_end_date,
+                grace_period,
+                project_path=project_path,
+                runfolder_path=runfolder_path,
+                workers=workers)
+        else:
+            file_lists = sort_projects_and_runfolders(
+                project_date_file,
+                runfolder_date_file,
+                irma_end_date,
+                grace_period,
+                project_path=project_path,
+                runfolder_path=runfolder_path,
+                workers=workers,
+                trust_cache_hours=args.trust_cache)
+        pprint.pprint(file_lists)
+    decision_log.print_summary()
+    decision_log.close()
 
 
 class TestScript:
@@ -543,6 +1593,115 @@ class TestScript:
         pprint.pp(last_access_in_path(workdir.name))
         assert last_access_in_path(workdir.name) == maxtime
 
+    def test_last_access_in_path_symlinks(
+            self,
+            workdir: tempfile.TemporaryDirectory,
+            before_date_cutoff: datetime.datetime,
+            after_date_cutoff: datetime.datetime) -> None:
+        # assert that symlinked directories are descended into, as os.walk on each subdirectory
+        # did, and that a symlink back up the tree does not loop
+        objdir = os.path.join(workdir.name, "object")
+        self.touch_file_with_atime(objdir, before_date_cutoff)
+        linked_dir = os.path.join(workdir.name, "linked")
+        self.touch_file_with_atime(linked_dir, after_date_cutoff)
+        os.symlink(linked_dir, os.path.join(objdir, "link"))
+        os.symlink(objdir, os.path.join(linked_dir, "loop"))
+        os.utime(
+            os.path.join(objdir, "link"),
+            times=(before_date_cutoff.timestamp(), before_date_cutoff.timestamp()),
+            follow_symlinks=False)
+        assert last_access_in_path(objdir) == after_date_cutoff
+
+        # assert that a broken symlink does not add an access time
+        brokendir = os.path.join(workdir.name, "broken")
+        self.touch_file_with_atime(brokendir, before_date_cutoff)
+        os.symlink(os.path.join(workdir.name, "missing"), os.path.join(brokendir, "dangling"))
+        os.utime(
+            os.path.join(brokendir, "dangling"),
+            times=(after_date_cutoff.timestamp(), after_date_cutoff.timestamp()),
+            follow_symlinks=False)
+        assert last_access_in_path(brokendir) == before_date_cutoff
+
+        # assert that an empty directory gets the minimum access time
+        os.mkdir(os.path.join(workdir.name, "empty"))
+        assert last_access_in_path(os.path.join(workdir.name, "empty")) == min_access_time
+
+    def test_access_time_cache(
+            self,
+            workdir: tempfile.TemporaryDirectory,
+            before_date_cutoff: datetime.datetime,
+            after_date_cutoff: datetime.datetime) -> None:
+        objdir = os.path.join(workdir.name, "object")
+        subdir = os.path.join(objdir, "sub")
+        self.touch_file_with_atime(objdir, before_date_cutoff)
+        tfile = self.touch_file_with_atime(subdir, before_date_cutoff)
+        cache = AccessTimeCache(os.path.join(workdir.name, "cache.sqlite"))
+        last_access, scanned_dirs = scan_object(objdir, cache.cached_dirs(objdir))
+        cache.update(objdir, scanned_dirs)
+        assert last_access == before_date_cutoff
+        assert sorted(cache.cached_dirs(objdir).keys()) == sorted([objdir, subdir])
+
+        # assert that a read of an existing file, which changes its atime but not the mtime of
+        # its directory, shows up on a rerun with the cache
+        with open(tfile) as fh:
+            fh.read()
+        os.utime(tfile, times=(after_date_cutoff.timestamp(), os.stat(tfile).st_mtime))
+        assert get_path_and_dates(workdir.name, cache=cache, objs=["object"]) == [
+            ("object", after_date_cutoff)]
+
+        # assert that within an explicit trust window, directories with unchanged mtime reuse
+        # their cached results
+        trusted_cache = AccessTimeCache(os.path.join(workdir.name, "cache.sqlite"), trust_hours=1)
+        os.utime(tfile, times=(before_date_cutoff.timestamp(), os.stat(tfile).st_mtime))
+        cached_dirs = trusted_cache.reusable_dirs(objdir)
+        assert sorted(cached_dirs.keys()) == sorted([objdir, subdir])
+        assert scan_object(objdir, cached_dirs) == (after_date_cutoff, cached_dirs)
+        assert AccessTimeCache(
+            os.path.join(workdir.name, "cache.sqlite")).reusable_dirs(objdir) == {}
+
+        # assert that a changed directory is rescanned and that removed directories are dropped
+        os.unlink(tfile)
+        os.rmdir(subdir)
+        self.touch_file_with_atime(objdir, after_date_cutoff)
+        last_access, scanned_dirs = scan_object(objdir, cache.cached_dirs(objdir))
+        cache.update(objdir, scanned_dirs)
+        assert last_access == after_date_cutoff
+        assert list(cache.cached_dirs(objdir).keys()) == [objdir]
+
+    def test_write_object_stats(
+            self,
+            workdir: tempfile.TemporaryDirectory,
+            end_date: datetime.datetime) -> None:
+        objdir = os.path.join(workdir.name, "object")
+        for months in [0, 4, 4, 40]:
+            tfile = self.touch_file_with_atime(
+                os.path.join(objdir, str(months)), end_date - datetime.timedelta(days=31 * months))
+            with open(tfile, "w") as fh:
+                fh.write("a" * 10)
+            os.utime(tfile, times=(
+                (end_date - datetime.timedelta(days=31 * months)).timestamp(),
+                end_date.timestamp()))
+        cache = AccessTimeCache(os.path.join(workdir.name, "cache.sqlite"))
+        cache.update(objdir, scan_object(objdir)[1])
+        outfile = os.path.join(workdir.name, "stats.tsv")
+        write_object_stats(
+            [objdir, objdir], cache.object_stats, outfile, reference_date=end_date)
+        with open(outfile) as fh:
+            rows = [line.rstrip("\n").split("\t") for line in fh]
+        assert rows[0][:6] == [
+            "path", "last_access", "allocated_bytes", "apparent_bytes", "files", "directories"]
+        assert rows[1][0] == objdir
+        assert rows[1][1] == end_date.strftime("%y%m%d")
+        assert rows[1][3:] == ["40", "4", "3", "1", "2", "0", "0", "0", "1"]
+        assert rows[-1][0] == "total"
+        assert rows[-1][3:] == ["80", "8", "6", "2", "4", "0", "0", "0", "2"]
+
+        # assert that an object without cached results is scanned instead of given zero stats
+        uncached = AccessTimeCache(os.path.join(workdir.name, "uncached.sqlite"))
+        stats = uncached.object_stats(objdir)
+        assert (stats.apparent_bytes, stats.n_files, stats.last_access) == (40, 4, end_date)
+        assert uncached.cached_dirs(objdir)
+
     def test_do_exclude(
             self,
             workdir: tempfile.TemporaryDirectory,
@@ -624,6 +1783,54 @@ class TestScript:
             date_cutoff,
             [(os.path.basename(fpath), date_cutoff)])
 
+    def test_decision_log(
+            self,
+            workdir: tempfile.TemporaryDirectory,
+            date_cutoff: datetime.datetime,
+            before_date_cutoff: datetime.datetime,
+            after_date_cutoff: datetime.datetime) -> None:
+        log_file = os.path.join(workdir.name, "decisions.jsonl")
+        decision_log.open(log_file, 0)
+        decision_log.batch_size = 2
+        try:
+            open(os.path.join(workdir.name, "a-path_do_not_remove"), "w").close()
+            assert not do_exclude(
+                os.path.join(workdir.name, "a-path"), before_date_cutoff, date_cutoff, [])
+            assert not do_exclude(
+                os.path.join(workdir.name, "b-path"),
+                before_date_cutoff,
+                date_cutoff,
+                [("b-path", after_date_cutoff)])
+            assert do_exclude(
+                os.path.join(workdir.name, "c-path"), before_date_cutoff, date_cutoff, [])
+            assert decision_log.summary() == {
+                ("included", "do_not_remove_companion"): 1,
+                ("included", "recent_meta_date"): 1,
+                ("excluded", "no_include_condition"): 1}
+            # a later decision for the same object supersedes the earlier one in the summary
+            decision_log.record(
+                os.path.join(workdir.name, "c-path"),
+                "included",
+                "contains_included_project",
+                "it contains an included project",
+                None)
+            assert decision_log.summary() == {
+                ("included", "do_not_remove_companion"): 1,
+                ("included", "recent_meta_date"): 1,
+                ("included", "contains_included_project"): 1}
+        finally:
+            decision_log.close()
+            decision_log.batch_size = 10000
+            decision_log.open(None, 1)
+        with open(log_file) as fh:
+            records = [json.loads(line) for line in fh]
+        assert [record["rule"] for record in records] == [
+            "do_not_remove_companion", "recent_meta_date", "no_include_condition",
+            "contains_included_project"]
+        assert records[0]["flag_file"] == "a-path_do_not_remove"
+        assert records[1]["meta_date"] == after_date_cutoff.isoformat()
+        assert records[2]["reason"] == "no condition to include file is met"
+
     def test_get_path_and_dates(
             self,
             create_projects: None,
@@ -757,6 +1964,7 @@ class TestScript:
             expected_excluded_runfolders: List[str],
             project_include_exclude_files: Tuple[str, str],
             runfolder_include_exclude_files: Tuple[str, str],
+            monkeypatch: pytest.MonkeyPatch,
             workdir: tempfile.TemporaryDirectory,
             runfolder_path: str,
             project_path: str,
@@ -764,7 +1972,7 @@ class TestScript:
             project_date_file: str,
             end_date: datetime.datetime,
             grace_period: int) -> None:
-        os.chdir(workdir.name)
+        monkeypatch.chdir(workdir.name)
         inc_ex_files = sort_projects_and_runfolders(
             project_date_file=project_date_file,
             runfolder_date_file=runfolder_date_file,
@@ -785,6 +1993,200 @@ class TestScript:
                 obs_objs = [line.strip() for line in fh]
                 assert sorted(obs_objs) == sorted(exp_objs)
 
+    def test_sharded_scan(
+            self,
+            create_projects: None,
+            create_runfolders: None,
+            monkeypatch: pytest.MonkeyPatch,
+            workdir: tempfile.TemporaryDirectory,
+            runfolder_path: str,
+            project_path: str,
+            runfolder_date_file: str,
+            project_date_file: str,
+            end_date: datetime.datetime,
+            grace_period: int) -> None:
+        import subprocess
+
+        monkeypatch.chdir(workdir.name)
+        args = [project_date_file, runfolder_date_file,
+                "--project-path", project_path, "--runfolder-path", runfolder_path,
+                "--irma-end-date", end_date.strftime("%y%m%d"),
+                "--grace-period", str(grace_period)]
+        in_ex_files = sort_projects_and_runfolders(
+            project_date_file=project_date_file,
+            runfolder_date_file=runfolder_date_file,
+            irma_end_date=end_date,
+            grace_period=grace_period,
+            project_path=project_path,
+            runfolder_path=runfolder_path)
+        outfiles = [f for files in in_ex_files for f in files] + [
+            f.replace(".txt", ".stats.tsv") for files in in_ex_files for f in files]
+        expected = {}
+        for outfile in outfiles:
+            with open(outfile) as fh:
+                expected[outfile] = fh.read()
+            os.unlink(outfile)
+        for cache_file in [_cache_file(project_path), _cache_file(runfolder_path)]:
+            os.unlink(cache_file)
+
+        # run the shard steps as separate processes and assert that the merged output is the
+        # same as for a single process run
+        n_shards = 3
+        subprocess.run(
+            [sys.executable, __file__] + args + ["--shard-step", "plan", "--shards", str(n_shards)],
+            check=True)
+        shards = read_shard_plan()
+        assert len(shards) == n_shards
+        assert sorted(obj for shard in shards for _, obj in shard) == sorted(
+            os.listdir(project_path) + os.listdir(runfolder_path))
+        for shard_index in range(n_shards):
+            subprocess.run(
+                [sys.executable, __file__] + args + [
+                    "--shard-step", "scan", "--shard-index", str(shard_index)],
+                check=True)
+        subprocess.run(
+            [sys.executable, __file__] + args + ["--shard-step", "merge"], check=True)
+        for outfile in outfiles:
+            with open(outfile) as fh:
+                assert fh.read() == expected[outfile]
+
+        # a shard that got no objects is not in the plan and scans nothing
+        with open(scan_shard(n_shards)) as fh:
+            assert fh.read() == ""
+
+    def test_sort_projects_and_runfolders_from_listing(
+            self,
+            create_projects: None,
+            create_runfolders: None,
+            monkeypatch: pytest.MonkeyPatch,
+            workdir: tempfile.TemporaryDirectory,
+            runfolder_path: str,
+            project_path: str,
+            runfolder_date_file: str,
+            project_date_file: str,
+            end_date: datetime.datetime,
+            grace_period: int) -> None:
+        monkeypatch.chdir(workdir.name)
+        kwargs = {
+            "project_date_file": project_date_file,
+            "runfolder_date_file": runfolder_date_file,
+            "irma_end_date": end_date,
+            "grace_period": grace_period,
+            "project_path": project_path,
+            "runfolder_path": runfolder_path}
+        in_ex_files = sort_projects_and_runfolders(**kwargs)
+        outfiles = [f for files in in_ex_files for f in files] + [
+            f.replace(".txt", ".stats.tsv") for files in in_ex_files for f in files]
+        expected = {}
+        for outfile in outfiles:
+            with open(outfile) as fh:
+                expected[outfile] = fh.read()
+            os.unlink(outfile)
+
+        # write a listing as produced by find -printf '%A@ %s %b %y %p\n' and assert that the
+        # output is the same as when walking the file system
+        listing_file = os.path.join(workdir.name, "listing.txt.gz")
+        with gzip.open(listing_file, "wt") as fh:
+            for root in [project_path, runfolder_path]:
+                for dirpath, dirnames, filenames in os.walk(root):
+                    for name in dirnames + filenames:
+                        path = os.path.join(dirpath, name)
+                        st = os.stat(path, follow_symlinks=False)
+                        ftype = "d" if name in dirnames else "f"
+                        fh.write(f"{st.st_atime} {st.st_size} {st.st_blocks} {ftype} {path}\n")
+            fh.write(f"1600000000.0 10 {os.path.join(workdir.name, 'elsewhere')}\n")
+        decision_log.record(
+            os.path.join(workdir.name, "elsewhere"), "excluded", "no_include_condition", "", None)
+        assert sort_projects_and_runfolders_from_listing(listing_file, **kwargs) == in_ex_files
+        # assert that the decision summary only counts the objects of the last run
+        assert sum(decision_log.summary().values()) == len(
+            os.listdir(project_path) + os.listdir(runfolder_path))
+        for outfile in outfiles:
+            with open(outfile) as fh:
+                assert fh.read() == expected[outfile]
+
+    def test_diff_snapshots(
+            self,
+            monkeypatch: pytest.MonkeyPatch,
+            workdir: tempfile.TemporaryDirectory) -> None:
+        monkeypatch.chdir(workdir.name)
+        snapshots = {}
+        for snapshot, in_ex in {
+                "old": [
+                    [("/p/A", "220101", 10), ("/p/B", "220101", 20)],
+                    [("/p/C", "220101", 30), ("/p/D", "220101", 40)]],
+                "new": [
+                    [("/p/A", "220101", 10), ("/p/B", "220201", 25), ("/p/C", "220201", 30)],
+                    [("/p/D", "220101", 40), ("/p/E", "220101", 50)]]}.items():
+            snapshots[snapshot] = os.path.join(workdir.name, snapshot)
+            os.mkdir(snapshots[snapshot])
+            for typ, objs in zip(["include", "exclude"], in_ex):
+                stats = {
+                    obj_path: ObjectStats(
+                        datetime.datetime.strptime(obj_date, "%y%m%d"), size, size, 1, 0, {})
+                    for obj_path, obj_date, size in objs}
+                write_object_stats(
+                    list(stats.keys()),
+                    stats.get,
+                    os.path.join(snapshots[snapshot], f"_p.{typ}.stats.tsv"))
+
+        delta_files = diff_snapshots(snapshots["old"], snapshots["new"])
+        observed = {}
+        for list_file, stats_file in delta_files:
+            with open(list_file) as fh:
+                paths = [line.strip() for line in fh]
+            with open(stats_file) as fh:
+                total = fh.readlines()[-1].split("\t")
+            observed[list_file] = (paths, int(total[2]))
+        assert observed == {
+            "_p.newly_included.txt": (["/p/C"], 30),
+            "_p.newly_excluded.txt": (["/p/E"], 50),
+            "_p.changed_access.txt": (["/p/B"], 25)}
+
+    def test_plan_transfer_batches(
+            self,
+            monkeypatch: pytest.MonkeyPatch,
+            workdir: tempfile.TemporaryDirectory,
+            project_path: str) -> None:
+        monkeypatch.chdir(workdir.name)
+        # a large object with two subdirectories and a file, and two small objects
+        for subdir, n_bytes in [("big/sub1", 400), ("big/sub2", 400), ("big", 100),
+                                ("small1", 300), ("small2", 300)]:
+            tfile = self.touch_file_with_atime(
+                os.path.join(project_path, subdir), datetime.datetime.now())
+            with open(tfile, "w") as fh:
+                fh.write("a" * n_bytes)
+        cache = AccessTimeCache(_cache_file(project_path))
+        for obj in os.listdir(project_path):
+            cache.update(os.path.join(project_path, obj), scan_object(
+                os.path.join(project_path, obj))[1])
+        stats_file = os.path.join(workdir.name, "stats.tsv")
+        write_object_stats(
+            [os.path.join(project_path, obj) for obj in os.listdir(project_path)],
+            cache.object_stats,
+            stats_file)
+
+        batches = plan_transfer_batches([stats_file], 3)
+        # each item holds one file, so the batches should be balanced on file count
+        assert sorted(len(batch) for batch in batches) == [1, 2, 2]
+        assert sum(item.n_bytes for batch in batches for item in batch) == 1500
+        assert sorted(os.path.relpath(item.path, project_path)
+                      for batch in batches for item in batch) == sorted(
+            ["big/sub1", "big/sub2", os.path.relpath(
+                glob.glob(os.path.join(project_path, "big", "tmp*"))[0], project_path),
+             "small1", "small2"])
+
+        outfiles = write_transfer_batches(batches, "miarka:/dest/")
+        assert len(outfiles) == 5
+        with open(outfiles[-1]) as fh:
+            assert "#SBATCH --array=0-2" in fh.read()
+
+    def test_parse_listing_line(self) -> None:
+        assert parse_listing_line("1600000000.5 10 /a path/with spaces\n") == \
+               (1600000000.5, 10, None, None, "/a path/with spaces")
+        assert parse_listing_line("1600000000.5 10 8 f /a path\n") == \
+               (1600000000.5, 10, 8, "f", "/a path")
+
     #Transfer:
 #GENOTYPING
 #DELIVERY
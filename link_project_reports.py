@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""
+Link the reports from the runfolders to the ANALYSIS/<project>/seqreports/<runfolder> folders.
+
+The runfolders of a project are found from their sample sheets in incoming, read through the
+shared sample sheet cache. Without --run, the planned folders and links are only printed.
+
+Usage:
+    link_project_reports.py P1234 [P5678 ...]          # dry-run, print the plan
+    link_project_reports.py P1234 [P5678 ...] --run    # create the links
+"""
+
+import argparse
+import fnmatch
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple
+
+from samplesheet import SampleSheetCache, find_samplesheets
+
+analysis_dir = "/proj/ngi2016001/nobackup/NGI/ANALYSIS"
+runfolder_dir = "/proj/ngi2016001/incoming"
+excluded_reports = ["Sample_*", "*fastq.gz", "checksums.md5", "SampleSheet.csv", "Undetermined"]
+link_workers = 16
+
+
+class ReportLink(NamedTuple):
+    target_dir: str
+    report: str
+
+    @property
+    def link(self) -> str:
+        return os.path.join(self.target_dir, os.path.basename(self.report))
+
+
+def project_runfolders(projects: List[str], search_dir: str = runfolder_dir) -> dict:
+    """
+    Names of the runfolders with each project in their sample sheet, from a single scan.
+
+    Returns:
+        {project: [runfolder names]}
+    """
+    runfolders = {project: set() for project in projects}
+    for row in SampleSheetCache().project_rows(projects, find_samplesheets(search_dir)):
+        runfolders[row.project].add(os.path.basename(row.runfolder))
+    return {project: sorted(names) for project, names in runfolders.items()}
+
+
+def plan_links(project: str, runfolders: List[str]) -> List[ReportLink]:
+    """
+    The report links for a project, in the same places as link_project_reports.sh.
+
+    Returns:
+        List of ReportLink
+    """
+    links = []
+    for runfolder in runfolders:
+        # get the canonical path to the runfolder
+        rf = os.path.realpath(os.path.join(runfolder_dir, runfolder))
+        report_dir = os.path.join(rf, "Projects", project, runfolder)
+        # skip if the folder containing reports does not exist
+        if not os.path.isdir(report_dir):
+            continue
+        target_dir = os.path.join(analysis_dir, project, "seqreports", runfolder)
+        for name in sorted(os.listdir(report_dir)):
+            if any(fnmatch.fnmatch(name, pattern) for pattern in excluded_reports):
+                continue
+            links.append(ReportLink(target_dir, os.path.join(report_dir, name)))
+    return links
+
+
+def link_status(report_link: ReportLink) -> str:
+    # "new", "ok" if the link exists and points to the report, "wrong" if something else is there
+    link = report_link.link
+    if not os.path.lexists(link):
+        return "new"
+    if os.path.islink(link) and os.readlink(link) == report_link.report:
+        return "ok"
+    return "wrong"
+
+
+def create_link(report_link: ReportLink, replace: bool = False) -> bool:
+    link = report_link.link
+    if replace:
+        # replace the existing link atomically, through a hidden temporary link
+        tmp_link = os.path.join(
+            report_link.target_dir, f".{os.path.basename(report_link.report)}.tmp")
+        try:
+            # left behind by an interrupted run
+            os.unlink(tmp_link)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Error creating link {link}: {e}", file=sys.stderr)
+            return False
+        try:
+            os.symlink(report_link.report, tmp_link)
+            os.replace(tmp_link, link)
+        except OSError as e:
+            print(f"Error creating link {link}: {e}", file=sys.stderr)
+            try:
+                os.unlink(tmp_link)
+            except OSError:
+                pass
+            return False
+        return True
+    try:
+        os.symlink(report_link.report, link)
+    except OSError as e:
+        print(f"Error creating link {link}: {e}", file=sys.stderr)
+        return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Link runfolder reports for projects into the ANALYSIS/<project>/seqreports folders.")
+    parser.add_argument("projects", nargs="+", help="Project ID(s)")
+    parser.add_argument(
+        "--run", action="store_true",
+        help="Create the folders and links. Without it, the plan is only printed.")
+    parser.add_argument(
+        "--force", action="store_true",
+        help="Replace existing links that point elsewhere (default: leave them and report)")
+    parser.add_argument(
+        "--workers", type=int, default=link_workers,
+        help="Number of threads creating links (default: %(default)s)")
+    args = parser.parse_args()
+
+    runfolders = project_runfolders(args.projects)
+    links = [link for project in args.projects for link in plan_links(project, runfolders[project])]
+    status = {link: link_status(link) for link in links}
+    new = [link for link in links if status[link] == "new"]
+    wrong = [link for link in links if status[link] == "wrong"]
+    replace = set(wrong)
+    to_create = new + (wrong if args.force else [])
+
+    target_dirs = sorted({link.target_dir for link in to_create if not os.path.isdir(link.target_dir)})
+    if not args.run:
+        for target_dir in target_dirs:
+            print(f'DRYRUN: mkdir -p "{target_dir}"')
+        for link in to_create:
+            print(f'DRYRUN: ln -s{"f" if link in replace else ""} -t "{link.target_dir}" "{link.report}"')
+    else:
+        for target_dir in target_dirs:
+            os.makedirs(target_dir, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            created = list(executor.map(lambda link: create_link(link, link in replace), to_create))
+        if not all(created):
+            print(f"{created.count(False)} links could not be created", file=sys.stderr)
+
+    if wrong and not args.force:
+        for link in wrong:
+            print(f"Existing {link.link} does not point to {link.report}, use --force to replace it",
+                  file=sys.stderr)
+    print(f"{len(links)} report links for {len(args.projects)} project(s): {len(new)} new, "
+          f"{len(links) - len(new) - len(wrong)} already correct, {len(wrong)} pointing elsewhere",
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
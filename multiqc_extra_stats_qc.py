@@ -2,6 +2,14 @@ import sys
 import os
 import csv
 import argparse
+import concurrent.futures
+import datetime
+import fcntl
+import functools
+import gzip
+import json
+import tempfile
+import zlib
 import yaml
 from glob import glob
 
@@ -70,11 +78,55 @@ def parse_arguments():
     )
     parser.add_argument(
         "--analysis_dir",
-        required=True,
-        help="Path to sarek analysis result folder is located",
+        help="Path to sarek analysis result folder is located (required unless --query)",
+    )
+    parser.add_argument("--project", help="Project name (required unless --query)")
+    parser.add_argument(
+        "--coverage_thresholds",
+        default=",".join(str(coverage) for coverage in coverage_thresholds),
+        help="Comma separated coverages to report the percentage of the reference covered at (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=len(os.sched_getaffinity(0)),
+        help="Number of processes parsing reports (default: the number of available cores, %(default)s)",
+    )
+    parser.add_argument(
+        "--metrics_store",
+        default=default_metrics_store,
+        help="Folder of the cross-project metrics store, empty to not use it (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--store_metrics",
+        action="store_true",
+        help="Add the metrics of this project to the metrics store (default: only compare against it)",
+    )
+    parser.add_argument(
+        "--cohort_projects",
+        type=int,
+        default=20,
+        help="Number of recent projects in the store that samples are compared against (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--outlier_threshold",
+        type=float,
+        default=3.5,
+        help="Robust z-score above which a sample is listed as an outlier (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--query",
+        nargs="*",
+        metavar="METRIC",
+        help="Print percentiles of the given metrics (all if none) across the store and exit",
+    )
+    parser.add_argument(
+        "--since",
+        help="With --query, only use projects stored on or after this date (YYYY-MM-DD)",
     )
-    parser.add_argument("--project", required=True, help="Project name")
     args = parser.parse_args()
+    if args.query is None and not (args.analysis_dir and args.project):
+        parser.error("--analysis_dir and --project are required")
     return args
 
 
@@ -99,22 +151,503 @@ def find_reports(analysis_dir):
         "samstat": os.path.join(report_folder, "samtools/*/*.md.cram.stats"),
         "snpeff": os.path.join(report_folder, "snpeff/haplotypecaller/*/*_snpEff.csv")
     }
+    # Used when found, but not required
+    optional_paths = {
+        "mosdepth_regions": os.path.join(report_folder, "mosdepth/*/*.md.regions.bed.gz"),
+        "vcf": os.path.join(analysis_dir, "results/variant_calling/haplotypecaller/*/*.haplotypecaller.vcf.gz"),
+        "joint_vcf": os.path.join(
+            analysis_dir, "results/variant_calling/haplotypecaller/joint_variant_calling/*.vcf.gz"),
+    }
     
     report_paths = {
         report_type: glob(path) for report_type, path in search_paths.items()
     }
     
     missing_reports = [report_type for report_type, paths in report_paths.items() if len(paths) == 0]
+    report_paths.update(
+        {report_type: glob(path) for report_type, path in optional_paths.items()})
     
     if 0 <= len(missing_reports) < 4:
         print(f"Using reports in {os.path.dirname(report_folder)}")
         for report in missing_reports:
+            if report == "snpeff" and (report_paths["vcf"] or report_paths["joint_vcf"]):
+                # variants are counted from the VCFs instead
+                continue
             print(f"Warning! No reports found in {search_paths[report]}")
         return report_paths
     else:
         print(f"No reports found in {report_folder}")
         return None
 
+coverage_thresholds = [10, 30]
+default_metrics_store = "/proj/ngi2016001/nobackup/NGI/qc_metrics_store"
+# Bimodal by sex, so not compared against the whole cohort. The sex is checked by "Sex check" instead
+outlier_excluded_metrics = ["chrX ratio", "chrY ratio"]
+
+def sample_name(report):
+    return os.path.basename(os.path.dirname(report))
+
+auto_chroms = {f"chr{x}" for x in range(1, 23)}
+# Pseudoautosomal regions of GRCh38, 0-based half-open
+par_regions = {
+    "chrX": [(10000, 2781479), (155701382, 156030895)],
+    "chrY": [(10000, 2781479), (56887902, 57217415)],
+}
+# chrX/autosome ratio above which two X copies are assumed, and chrY/autosome
+# ratio above which a Y is assumed
+x_ratio_two_copies = 0.75
+y_ratio_present = 0.1
+
+def infer_sex(x_ratio, y_ratio):
+    """
+    Infers sex from the chrX/autosome and chrY/autosome coverage ratios.
+
+    Args:
+        x_ratio (float): chrX/autosome coverage ratio
+        y_ratio (float): chrY/autosome coverage ratio
+
+    Returns:
+        dict: Metric(s) (key), value (value), where "Sex check" is "pass" for XX or
+        XY and "check" for anything else (e.g. X0 or XXY)
+    """
+    two_x = x_ratio >= x_ratio_two_copies
+    has_y = y_ratio >= y_ratio_present
+    if two_x and not has_y:
+        sex, check = "female", "pass"
+    elif has_y and not two_x:
+        sex, check = "male", "pass"
+    else:
+        sex, check = "ambiguous", "check"
+    return {
+        "chrX ratio": round(x_ratio, 3),
+        "chrY ratio": round(y_ratio, 3),
+        "Inferred sex": sex,
+        "Sex check": check,
+    }
+
+def read_mosdepth_summary(report):
+    """
+    Calculates average autosomal coverage, chrX/autosome and chrY/autosome
+    coverage ratios and the inferred sex from a Mosdepth summary report.
+
+    Args:
+        report (str): Path to Mosdepth summary report
+
+    Returns:
+        dict: Metric(s) (key), value (value)
+    """
+    bases = 0
+    length = 0
+    sex_chroms = {}
+    with open(report) as fin:
+        cov = csv.reader(fin, delimiter="\t")
+        header = next(cov)
+        chrom_index = header.index("chrom")
+        length_index = header.index("length")
+        bases_index = header.index("bases")
+        for row in cov:
+            if row[chrom_index] in auto_chroms:
+                bases += int(row[bases_index])
+                length += int(row[length_index])
+            elif row[chrom_index] in par_regions:
+                sex_chroms[row[chrom_index]] = int(row[bases_index]) / int(row[length_index])
+    auto_cov = bases / length
+    metrics = {"Autosomal coverage": round(auto_cov)}
+    if auto_cov > 0:
+        metrics.update(infer_sex(
+            sex_chroms.get("chrX", 0) / auto_cov, sex_chroms.get("chrY", 0) / auto_cov))
+    return metrics
+
+def read_mosdepth_regions(report):
+    """
+    Calculates chrX/autosome and chrY/autosome coverage ratios and the inferred
+    sex from a Mosdepth regions.bed.gz report, leaving out the pseudoautosomal
+    regions. The report is streamed, so memory use does not grow with its size.
+
+    Args:
+        report (str): Path to Mosdepth regions.bed.gz report
+
+    Returns:
+        dict: Metric(s) (key), value (value)
+    """
+    bases = {"auto": 0.0, "chrX": 0.0, "chrY": 0.0}
+    length = {"auto": 0, "chrX": 0, "chrY": 0}
+    with gzip.open(report, "rt") as fin:
+        for line in fin:
+            fields = line.rstrip("\n").split("\t")
+            chrom = fields[0]
+            if chrom in auto_chroms:
+                key = "auto"
+            elif chrom in par_regions:
+                start, end = int(fields[1]), int(fields[2])
+                if any(start < par_end and end > par_start for par_start, par_end in par_regions[chrom]):
+                    continue
+                key = chrom
+            else:
+                continue
+            start, end, mean = int(fields[1]), int(fields[2]), float(fields[-1])
+            bases[key] += (end - start) * mean
+            length[key] += end - start
+    if not length["auto"] or not bases["auto"]:
+        return {}
+    auto_cov = bases["auto"] / length["auto"]
+    return infer_sex(*[
+        bases[chrom] / length[chrom] / auto_cov if length[chrom] else 0.0
+        for chrom in ["chrX", "chrY"]])
+
+def read_mosdepth_dist(report, thresholds=coverage_thresholds):
+    """
+    Parse the proportion of the reference with at least each of the coverage
+    thresholds from a mosdepth region.dist report, in a single pass. The
+    proportions are converted to percentages.
+
+    Args:
+        report (str): Path to mosdepth region.dist report
+        thresholds (list): Coverages of interest
+
+    Returns:
+        dict: Metric(s) (key), percentage (value)
+    """
+    wanted = set(thresholds)
+    data = {}
+    with open(report) as fin:
+        for line in fin:
+            cov_region, cov_x, proportion = line.rstrip("\n").split("\t")
+            if cov_region == "total" and int(cov_x) in wanted:
+                data[f"Coverage ≥{int(cov_x)} X"] = float(proportion) * 100
+    return data
+
+def _number(value):
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+def read_samtools_stats(report):
+    """
+    Reads all SN fields and the GCF, GCL, IS and COV histograms of a Samtools
+    stats report in a single pass.
+
+    Args:
+        report (str): Path to Samtools stats report
+
+    Returns:
+        dict: "SN" (dict of field: value) and one list of rows per histogram
+    """
+    stats = {"SN": {}, "GCF": [], "GCL": [], "IS": [], "COV": []}
+    with open(report) as fin:
+        for line in fin:
+            identifier, _, rest = line.partition("\t")
+            if identifier == "SN":
+                field, value = rest.split("\t")[:2]
+                stats["SN"][field.rstrip(":")] = _number(value.strip())
+            elif identifier in ("GCF", "GCL", "IS"):
+                stats[identifier].append([_number(value) for value in rest.split("\t")])
+            elif identifier == "COV":
+                # COV rows start with a range like [1-1]
+                _, cov, count = rest.rstrip("\n").split("\t")
+                stats["COV"].append([int(cov), int(count)])
+    return stats
+
+def histogram_percentile(histogram, percentile):
+    """
+    Value at a percentile of a histogram given as (value, count) rows.
+
+    Args:
+        histogram (list): Rows sorted by value
+        percentile (float): Percentile, 0-100
+
+    Returns:
+        The value at the percentile, None if the histogram is empty
+    """
+    total = sum(row[1] for row in histogram)
+    if total == 0:
+        return None
+    cumulative = 0
+    for row in histogram:
+        cumulative += row[1]
+        if cumulative >= total * percentile / 100:
+            return row[0]
+    return histogram[-1][0]
+
+def read_samstats(report):
+    """
+    Collect the precalculated average insert size and calculates average GC %,
+    % mapped reads and the median insert size from a Samtools stats report.
+
+    Args:
+        report (str): Path to Samtools stats report
+
+    Returns:
+        dict: Metric(s) (key), value (value)
+    """
+    stats = read_samtools_stats(report)
+    gc_rows = stats["GCF"] + stats["GCL"]
+    total_reads = float(sum(num_reads for gc_percentage, num_reads in gc_rows))
+    total_gc_percentage = sum(gc_percentage * num_reads for gc_percentage, num_reads in gc_rows)
+    # IS rows are insert size, pairs total, inward, outward, other
+    insert_histogram = [(row[0], row[1]) for row in stats["IS"]]
+    return {
+        "Average GC %": round(total_gc_percentage / total_reads),
+        "% Mapped": round(stats["SN"]["reads mapped"] / total_reads * 100, 1),
+        "Average insert size": round(float(stats["SN"]["insert size average"])),
+        "Median insert size": histogram_percentile(insert_histogram, 50),
+    }
+
+def read_snpeff(report):
+    """
+    Parse the precalculated number of unfiltered variants from a snpEff report,
+    reading only until it is found.
+
+    Args:
+        report (str): Path to snpEff report
+
+    Returns:
+        dict: Metric(s) (key), value (value)
+    """
+    with open(report) as fin:
+        for line in fin:
+            if line.startswith("Number_of_variants_before_filter,"):
+                return {"Unfiltered variants": int(line.strip().split(", ")[1])}
+    return {}
+
+transitions = {("A", "G"), ("G", "A"), ("C", "T"), ("T", "C")}
+vcf_counters = ["variants", "snv", "indel", "ts", "tv", "het", "hom"]
+
+def vcf_samples(report):
+    """
+    Args:
+        report (str): Path to bgzipped VCF
+
+    Returns:
+        list: Sample names in the #CHROM header line
+    """
+    with gzip.open(report, "rt") as fin:
+        for line in fin:
+            if line.startswith("#CHROM"):
+                return line.rstrip("\n").split("\t")[9:]
+            if not line.startswith("#"):
+                break
+    return []
+
+def count_vcf_line(line, counts):
+    """
+    Adds the genotypes of a VCF record to per-sample counters. A sample counts
+    a variant when its genotype has a non-reference allele.
+
+    Args:
+        line (str): VCF record
+        counts (list): One dict of counters (vcf_counters) per sample
+    """
+    if not line or line.startswith("#"):
+        return
+    fields = line.rstrip("\n").split("\t")
+    ref = fields[3]
+    alts = fields[4].split(",")
+    fmt = fields[8].split(":")
+    if "GT" not in fmt:
+        return
+    gt_index = fmt.index("GT")
+    for sample_counts, sample_field in zip(counts, fields[9:]):
+        values = sample_field.split(":")
+        if gt_index >= len(values):
+            continue
+        alleles = values[gt_index].replace("|", "/").split("/")
+        carried = [int(allele) for allele in alleles if allele not in ("0", ".")]
+        if not carried:
+            continue
+        sample_counts["variants"] += 1
+        alt = alts[carried[0] - 1]
+        if len(ref) == 1 and len(alt) == 1 and alt != "*":
+            sample_counts["snv"] += 1
+            sample_counts["ts" if (ref.upper(), alt.upper()) in transitions else "tv"] += 1
+        elif len(ref) != len(alt) and not alt.startswith("<"):
+            sample_counts["indel"] += 1
+        if len(set(alleles)) > 1:
+            sample_counts["het"] += 1
+        else:
+            sample_counts["hom"] += 1
+
+def bgzf_blocks(report):
+    """
+    Lists the BGZF blocks of a file from their headers, without decompressing.
+
+    Args:
+        report (str): Path to BGZF compressed file
+
+    Returns:
+        list: Offset of each block, and the file size as the last item
+        None: If the file is not BGZF compressed
+    """
+    offsets = []
+    size = os.path.getsize(report)
+    with open(report, "rb") as fin:
+        offset = 0
+        while offset < size:
+            fin.seek(offset)
+            header = fin.read(18)
+            # gzip magic, deflate, FEXTRA set and a BC subfield holding the block size
+            if len(header) < 18 or header[:4] != b"\x1f\x8b\x08\x04" or header[12:14] != b"BC":
+                return None
+            offsets.append(offset)
+            offset += int.from_bytes(header[16:18], "little") + 1
+    offsets.append(size)
+    return offsets
+
+def count_vcf_chunk(report, start, end, n_samples):
+    """
+    Decompresses and counts the BGZF blocks between two block offsets. Lines cut
+    by the chunk boundaries are returned, to be joined with the neighbouring chunks.
+
+    Args:
+        report (str): Path to bgzipped VCF
+        start (int): Offset of the first block
+        end (int): Offset after the last block
+        n_samples (int): Number of samples in the VCF
+
+    Returns:
+        tuple: Bytes before the first newline (None if the chunk has no newline),
+        counts per sample, bytes after the last newline
+    """
+    counts = [dict.fromkeys(vcf_counters, 0) for _ in range(n_samples)]
+    head, carry = None, b""
+    with open(report, "rb") as fin:
+        fin.seek(start)
+        offset = start
+        while offset < end:
+            header = fin.read(18)
+            block_size = int.from_bytes(header[16:18], "little") + 1
+            data = zlib.decompress(header + fin.read(block_size - 18), 31)
+            offset += block_size
+            # split on bytes, a multi-byte character may be cut by a block boundary
+            lines = (carry + data).split(b"\n")
+            carry = lines.pop()
+            if head is None and lines:
+                head = lines.pop(0)
+            for line in lines:
+                count_vcf_line(line.decode(), counts)
+    return head, counts, carry
+
+def read_vcf_stats(report, workers=1):
+    """
+    Counts variants, SNVs and indels, transitions/transversions and
+    heterozygous/homozygous genotypes per sample in a single streaming pass over
+    a bgzipped VCF. The BGZF blocks are split into chunks that are decompressed
+    and counted in parallel processes.
+
+    Args:
+        report (str): Path to bgzipped VCF
+        workers (int): Number of processes
+
+    Returns:
+        dict: Sample(s) (key), dict of metric(s) and value(s) (value)
+    """
+    samples = vcf_samples(report)
+    offsets = bgzf_blocks(report)
+    if offsets is None:
+        # plain gzip, read it in one stream
+        counts = [dict.fromkeys(vcf_counters, 0) for _ in samples]
+        with gzip.open(report, "rt") as fin:
+            for line in fin:
+                count_vcf_line(line, counts)
+    else:
+        n_chunks = max(1, min(workers * 4, len(offsets) - 1))
+        n_blocks = len(offsets) - 1
+        bounds = [offsets[n_blocks * i // n_chunks] for i in range(n_chunks)] + [offsets[-1]]
+        chunks = [(report, start, end, len(samples)) for start, end in zip(bounds, bounds[1:]) if start < end]
+        if workers > 1 and len(chunks) > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(count_vcf_chunk, *zip(*chunks)))
+        else:
+            results = [count_vcf_chunk(*chunk) for chunk in chunks]
+        counts = [dict.fromkeys(vcf_counters, 0) for _ in samples]
+        carry = b""
+        for head, chunk_counts, tail in results:
+            if head is None:
+                # the chunk is all inside one line
+                carry += tail
+                continue
+            # the line cut by the chunk boundary
+            count_vcf_line((carry + head).decode(), counts)
+            carry = tail
+            for sample_counts, sample_chunk_counts in zip(counts, chunk_counts):
+                for counter, value in sample_chunk_counts.items():
+                    sample_counts[counter] += value
+        count_vcf_line(carry.decode(), counts)
+
+    return {
+        sample: {
+            "Unfiltered variants": sample_counts["variants"],
+            "SNVs": sample_counts["snv"],
+            "Indels": sample_counts["indel"],
+            "Ti/Tv": round(sample_counts["ts"] / sample_counts["tv"], 2) if sample_counts["tv"] else None,
+            "Het/Hom": round(sample_counts["het"] / sample_counts["hom"], 2) if sample_counts["hom"] else None,
+        }
+        for sample, sample_counts in zip(samples, counts)}
+
+def read_vcf(report):
+    """
+    Variant metrics of a single sample VCF, see read_vcf_stats.
+
+    Args:
+        report (str): Path to bgzipped VCF
+
+    Returns:
+        dict: Metric(s) (key), value (value)
+    """
+    stats = read_vcf_stats(report)
+    sample = sample_name(report)
+    if sample in stats:
+        return stats[sample]
+    if len(stats) == 1:
+        return next(iter(stats.values()))
+    return {}
+
+def pick_joint_vcf(reports):
+    """
+    Picks the joint VCF to count. Sarek writes joint_germline.vcf.gz and, after
+    variant recalibration, joint_germline_recalibrated.vcf.gz with the same
+    variants, so only one of them is read.
+
+    Args:
+        reports (list): Paths to joint VCFs
+
+    Returns:
+        str: Path to the recalibrated VCF if there is one, else the first VCF
+        None: If there are no joint VCFs
+    """
+    if not reports:
+        return None
+    reports = sorted(reports, key=lambda report: (not report.endswith("_recalibrated.vcf.gz"), report))
+    if len(reports) > 1:
+        print(f"Using {reports[0]} of {len(reports)} joint VCFs")
+    return reports[0]
+
+report_readers = {
+    "mosdepth_sum": read_mosdepth_summary,
+    "mosdepth_reg": read_mosdepth_dist,
+    "samstat": read_samstats,
+    "snpeff": read_snpeff,
+    "mosdepth_regions": read_mosdepth_regions,
+    "vcf": read_vcf,
+}
+
+def read_report(report_type, report, thresholds=coverage_thresholds):
+    """
+    Reads every metric of interest from a report with the reader for its type.
+
+    Args:
+        report_type (str): Type of report, a key in find_reports
+        report (str): Path to report
+        thresholds (list): Coverage thresholds for mosdepth region.dist reports
+
+    Returns:
+        dict: Metric(s) (key), value (value)
+    """
+    if report_type == "mosdepth_reg":
+        return read_mosdepth_dist(report, thresholds)
+    return report_readers[report_type](report)
+
 def calculate_avg_coverage(reports):
     """
     Calculates average autosomal coverage for each sample.
@@ -125,25 +658,9 @@ def calculate_avg_coverage(reports):
     Returns:
         dict: Sample(s) (key), average_coverage (value)
     """
-    auto_chroms = [f"chr{x}" for x in range(1, 23)]
-
-    avg_cov = {}
-    for report in reports:
-        sample = os.path.basename(os.path.dirname(report))
-        bases = 0
-        length = 0
-        with open(report) as fin:
-            cov = csv.reader(fin, delimiter="\t")
-            header = next(cov)
-            chrom_index = header.index("chrom")
-            length_index = header.index("length")
-            bases_index = header.index("bases")
-            for row in cov:
-                if row[chrom_index] in auto_chroms:
-                    bases += int(row[bases_index])
-                    length += int(row[length_index])
-            avg_cov[sample] = round(bases / length)
-    return avg_cov
+    return {
+        sample_name(report): read_mosdepth_summary(report)["Autosomal coverage"]
+        for report in reports}
 
 def get_samstats(reports):
     """
@@ -158,23 +675,11 @@ def get_samstats(reports):
     """
     gc_avg, aln_percent, insert_sizes = {}, {}, {}
     for report in reports:
-        sample = os.path.basename(os.path.dirname(report))    
-        total_gc_percentage = 0.0
-        total_reads = 0.0
-        with open(report) as fin:
-            for line in fin:
-                if line.startswith('GCF') or line.startswith('GCL'):
-                    identifier, gc_percentage, num_reads = line.strip().split('\t')
-                    total_gc_percentage += float(gc_percentage) * float(num_reads)
-                    total_reads += float(num_reads)
-                elif line.startswith('SN\tinsert size average:'):
-                    insert_avg = round(float(line.strip().split('\t')[2]))
-                    insert_sizes[sample] = insert_avg
-                elif line.startswith('SN\treads mapped:'):
-                    total_mapped = float(line.strip().split('\t')[2])
-        
-        gc_avg[sample] = round(total_gc_percentage / total_reads)
-        aln_percent[sample]= round(total_mapped / total_reads * 100, 1)
+        sample = sample_name(report)
+        metrics = read_samstats(report)
+        gc_avg[sample] = metrics["Average GC %"]
+        aln_percent[sample] = metrics["% Mapped"]
+        insert_sizes[sample] = metrics["Average insert size"]
     return gc_avg, aln_percent, insert_sizes
 
 def extra_genstats_out(sample_data):
@@ -195,26 +700,36 @@ def extra_genstats_out(sample_data):
             "headers": {
                     "Average_insert_size": {"max": 800, "min": 0, "suffix": "nt"},
                     "Average_GC_%": {"max": 100, "min": 0, "suffix": "%"},
-                    "Autosomal_coverage": {"suffix": "X"}
+                    "Autosomal_coverage": {"suffix": "X"},
+                    "chrX_ratio": {"description": "chrX/autosome coverage ratio", "format": "{:,.2f}"},
+                    "chrY_ratio": {"description": "chrY/autosome coverage ratio", "format": "{:,.2f}"},
+                    "Inferred_sex": {"description": "Sex inferred from the chrX and chrY coverage ratios"},
+                    "Sex_check": {"description": "'check' if the sex chromosomes are neither XX nor XY"},
+                    "Ti/Tv": {"description": "Transition/transversion ratio of the SNVs", "format": "{:,.2f}"},
+                    "Het/Hom": {"description": "Heterozygous/homozygous alternative genotype ratio", "format": "{:,.2f}"},
                 },
             "data": {}
         }                
     }}
-    metrics = ["Average insert size", "Average GC %", "Autosomal coverage"]
+    metrics = [
+        "Average insert size", "Average GC %", "Autosomal coverage",
+        "chrX ratio", "chrY ratio", "Inferred sex", "Sex check", "Ti/Tv", "Het/Hom"]
     for metric in metrics:
-        for sample, value in sample_data[metric].items():
+        for sample, value in sample_data.get(metric, {}).items():
             header = "_".join(metric.split())
             data["custom_data"]["extra_stats"]["data"].setdefault(sample, {})[header] = value
     return data
 
-def QC_out(qc_fail, qc):
+def QC_out(qc_fail, qc, outliers=None):
     """
     Collects samples that failed QC and format it to enable yaml output.
+    Cohort outliers are listed after the samples that failed QC, if given.
 
 
     Args:
         qc_fail (dict): Metric information for samples that failed QC
         qc (QC object): QC thresholds and functions for pretty formatting
+        outliers (dict): Samples that are robust z-score outliers, from check_outliers
 
     Returns:
        dict: QC information ready for yaml.dump
@@ -241,6 +756,14 @@ def QC_out(qc_fail, qc):
     else:
         yaml_out["data"] += "<li>All sample passed QC!</li>\n"
     yaml_out["data"] += "</ul>"
+    if outliers:
+        yaml_out["data"] += "\n<p>Outliers compared to recent projects (robust z-score):</p>\n<ul>\n"
+        for metric in outliers:
+            yaml_out["data"] += f"<li>{metric}</li>\n<ul>\n"
+            for sample, value, z_score in outliers[metric]:
+                yaml_out["data"] += f"<li>{sample} ({qc.pretty_val(metric, value)}, z = {z_score:.1f})</li>\n"
+            yaml_out["data"] += "</ul>\n"
+        yaml_out["data"] += "</ul>"
 
     return yaml_out 
 
@@ -280,15 +803,9 @@ def get_x_cov(reports, coverage):
     """
     data = {}
     for report in reports:
-        sample = os.path.basename(os.path.dirname(report))
-        with open(report) as fin:
-            cov = csv.reader(fin, delimiter="\t")
-            for row in cov:
-                cov_region = row[0]
-                cov_x = int(row[1])
-                proportion = float(row[2])
-                if cov_region == "total" and cov_x == coverage:
-                    data[sample] = proportion * 100
+        metrics = read_mosdepth_dist(report, [coverage])
+        if metrics:
+            data[sample_name(report)] = metrics[f"Coverage ≥{coverage} X"]
     return data
 
 def get_number_variants(reports):
@@ -303,40 +820,359 @@ def get_number_variants(reports):
         dict: Number of unfiltered variants per sample
     """
     data = {}
-
     for report in reports:
-        sample = os.path.basename(os.path.dirname(report))
-        with open(report) as fin:
-            for line in fin:
-                if line.startswith("Number_of_variants_before_filter,"):
-                    data[sample] = int(line.strip().split(", ")[1])
+        metrics = read_snpeff(report)
+        if metrics:
+            data[sample_name(report)] = metrics["Unfiltered variants"]
     return data
 
-def collect_data(reports):
+def reports_by_sample(reports):
     """
-    Function to parse and collect all metrics.
+    Groups the report paths per sample.
 
     Args:
         reports (dict): Paths to reports by report type
 
+    Returns:
+        dict: Sample(s) (key), list of (report type, path) (value), sorted by sample
+    """
+    samples = {}
+    # regions reports come after the summaries, so their sex check replaces the
+    # one calculated from the summary
+    # vcf comes after snpeff, so variants counted in the VCF replace the snpEff count
+    for report_type in ["samstat", "mosdepth_sum", "mosdepth_regions", "mosdepth_reg", "snpeff", "vcf"]:
+        for report in reports.get(report_type, []):
+            samples.setdefault(sample_name(report), []).append((report_type, report))
+    return dict(sorted(samples.items()))
+
+def read_sample_reports(sample_reports, thresholds=coverage_thresholds):
+    """
+    Reads the given reports of one sample.
+
+    Args:
+        sample_reports (list): (report type, path) of the reports of the sample
+        thresholds (list): Coverage thresholds for mosdepth region.dist reports
+
+    Returns:
+        list: One dict of metric(s) (key), value (value) per report
+    """
+    return [
+        read_report(report_type, report, thresholds)
+        for report_type, report in sample_reports]
+
+# Bump when the readers change what they return, so older caches are not used
+metrics_cache_version = 2
+
+class MetricsCache:
+    """
+    Parsed metrics per report, keyed by report path, size and mtime, stored as
+    JSON in the analysis directory. Reports that changed since they were
+    parsed are not found in the cache.
+    """
+    def __init__(self, cache_file=None):
+        self.cache_file = cache_file
+        self.entries = {}
+        self.used = set()
+        if cache_file and os.path.exists(cache_file):
+            try:
+                with open(cache_file) as fin:
+                    cached = json.load(fin)
+                if isinstance(cached, dict) and cached.get("version") == metrics_cache_version:
+                    self.entries = cached["entries"]
+            except ValueError:
+                print(f"Warning! Ignoring unreadable metrics cache {cache_file}")
+
+    @staticmethod
+    def key(report_type, report, thresholds):
+        st = os.stat(report)
+        params = list(thresholds) if report_type == "mosdepth_reg" else None
+        return [st.st_size, st.st_mtime_ns, params]
+
+    def get(self, report_type, report, thresholds):
+        self.used.add(report)
+        entry = self.entries.get(report)
+        if entry and entry["key"] == self.key(report_type, report, thresholds):
+            return entry["metrics"]
+        return None
+
+    def put(self, report_type, report, thresholds, metrics):
+        self.used.add(report)
+        self.entries[report] = {"key": self.key(report_type, report, thresholds), "metrics": metrics}
+
+    def save(self):
+        # Reports no longer found are dropped from the cache
+        if not self.cache_file:
+            return
+        entries = {report: entry for report, entry in self.entries.items() if report in self.used}
+        write_atomic(
+            self.cache_file,
+            lambda fout: json.dump({"version": metrics_cache_version, "entries": entries}, fout))
+
+def write_atomic(path, write):
+    """
+    Writes a file through a temporary file in the same folder that is renamed
+    into place, so readers never see a partly written file.
+
+    Args:
+        path (str): Path to the file
+        write (function): Called with the open temporary file
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".tmp.")
+    try:
+        with os.fdopen(fd, "w") as fout:
+            write(fout)
+        os.chmod(tmp_path, 0o666 & ~current_umask())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def current_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+def collect_data(reports, thresholds=coverage_thresholds, workers=1, cache=None):
+    """
+    Function to parse and collect all metrics. Each report is read once, and
+    with workers > 1 the samples are parsed in a process pool. Reports found
+    unchanged in the cache are not parsed again. Samples are collected in
+    sorted order, so the output does not depend on workers.
+
+    Args:
+        reports (dict): Paths to reports by report type
+        thresholds (list): Coverage thresholds to collect from the mosdepth reports
+        workers (int): Number of processes parsing reports
+        cache (MetricsCache): Metrics parsed in earlier runs
+
     Returns:
        dict: All parsed metrics for each sample
     """
-    gc_avg, aln_percent, insert_sizes = get_samstats(reports["samstat"])
     data = {
-        "Autosomal coverage": calculate_avg_coverage(reports["mosdepth_sum"]),
-        "Coverage ≥10 X": get_x_cov(reports["mosdepth_reg"], 10),
-        "Coverage ≥30 X": get_x_cov(reports["mosdepth_reg"], 30),
-        "Unfiltered variants": get_number_variants(reports["snpeff"]),
-        "Average GC %": gc_avg,
-        "% Mapped": aln_percent,
-        "Average insert size": insert_sizes
+        "Autosomal coverage": {},
+        "chrX ratio": {},
+        "chrY ratio": {},
+        "Inferred sex": {},
+        "Sex check": {},
+        **{f"Coverage ≥{coverage} X": {} for coverage in thresholds},
+        "Unfiltered variants": {},
+        "SNVs": {},
+        "Indels": {},
+        "Ti/Tv": {},
+        "Het/Hom": {},
+        "Average GC %": {},
+        "% Mapped": {},
+        "Average insert size": {},
+        "Median insert size": {},
     }
+    cache = cache or MetricsCache()
+    samples = reports_by_sample(reports)
+    cached = {
+        report: cache.get(report_type, report, thresholds)
+        for sample_reports in samples.values() for report_type, report in sample_reports}
+    to_parse = {
+        sample: [(report_type, report) for report_type, report in sample_reports if cached[report] is None]
+        for sample, sample_reports in samples.items()}
+    to_parse = {sample: sample_reports for sample, sample_reports in to_parse.items() if sample_reports}
+
+    read = functools.partial(read_sample_reports, thresholds=thresholds)
+    if workers > 1 and len(to_parse) > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        # results are streamed back in sample order, only the parsed metrics are kept
+        parsed = executor.map(
+            read, to_parse.values(), chunksize=max(1, len(to_parse) // (workers * 4)))
+    else:
+        executor = None
+        parsed = map(read, to_parse.values())
+    try:
+        for sample_reports, report_metrics in zip(to_parse.values(), parsed):
+            for (report_type, report), metrics in zip(sample_reports, report_metrics):
+                cache.put(report_type, report, thresholds, metrics)
+                cached[report] = metrics
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    for sample, sample_reports in samples.items():
+        for report_type, report in sample_reports:
+            for metric, value in cached[report].items():
+                data.setdefault(metric, {})[sample] = value
     return data
 
+class QCStore:
+    """
+    Cross-project store of per-sample metrics. Each project is one TSV partition
+    with one column per metric, and index.tsv lists the projects with the date
+    they were stored, so cohort queries only read the partitions they need.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.index_file = os.path.join(path, "index.tsv")
+
+    def index(self):
+        """
+        Returns:
+            list: One dict per stored project (project, date, samples), oldest first
+        """
+        if not os.path.exists(self.index_file):
+            return []
+        with open(self.index_file) as fin:
+            return sorted(csv.DictReader(fin, delimiter="\t"), key=lambda row: row["date"])
+
+    def partition(self, project):
+        return os.path.join(self.path, f"{project}.tsv")
+
+    def append(self, project, data, date=None):
+        """
+        Stores the metrics of a project, replacing what was stored for it before.
+
+        Args:
+            project (str): Project name
+            data (dict): All parsed metrics for each sample, from collect_data
+            date (str): Date of the run, default today
+        """
+        os.makedirs(self.path, exist_ok=True)
+        metrics = list(data)
+        samples = sorted({sample for values in data.values() for sample in values})
+
+        def write_partition(fout):
+            writer = csv.writer(fout, delimiter="\t", lineterminator="\n")
+            writer.writerow(["sample"] + metrics)
+            for sample in samples:
+                writer.writerow([sample] + [
+                    "" if data[metric].get(sample) is None else data[metric][sample] for metric in metrics])
+        write_atomic(self.partition(project), write_partition)
+
+        # the index is read, changed and replaced under a lock, so projects stored at the
+        # same time do not drop each other's rows
+        with open(os.path.join(self.path, ".index.lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            index = [row for row in self.index() if row["project"] != project]
+            index.append({
+                "project": project,
+                "date": date or datetime.date.today().isoformat(),
+                "samples": len(samples)})
+
+            def write_index(fout):
+                writer = csv.DictWriter(fout, ["project", "date", "samples"], delimiter="\t", lineterminator="\n")
+                writer.writeheader()
+                writer.writerows(index)
+            write_atomic(self.index_file, write_index)
+
+    def recent_projects(self, n, exclude=None):
+        """
+        Returns:
+            list: The n most recently stored projects, other than exclude
+        """
+        projects = [row["project"] for row in self.index() if row["project"] != exclude]
+        return projects[-n:] if n else []
+
+    def values(self, projects, metrics=None, since=None):
+        """
+        Reads the values of metrics from the partitions of the given projects.
+
+        Args:
+            projects (list): Projects to read, None for all stored projects
+            metrics (list): Metrics to read, None for all
+            since (str): Only projects stored on or after this date (YYYY-MM-DD)
+
+        Returns:
+            dict: Metric(s) (key), list of values (value)
+        """
+        index = self.index()
+        if since:
+            index = [row for row in index if row["date"] >= since]
+        stored = [row["project"] for row in index]
+        projects = stored if projects is None else [project for project in projects if project in stored]
+        values = {}
+        for project in projects:
+            try:
+                fin = open(self.partition(project))
+            except FileNotFoundError:
+                # e.g. removed by hand, the rest of the store is still usable
+                print(f"Warning! Metrics of {project} listed in {self.index_file} but not stored",
+                      file=sys.stderr)
+                continue
+            with fin:
+                reader = csv.reader(fin, delimiter="\t")
+                header = next(reader)
+                columns = [
+                    (i, metric) for i, metric in enumerate(header[1:], 1)
+                    if metrics is None or metric in metrics]
+                for row in reader:
+                    for i, metric in columns:
+                        try:
+                            value = float(row[i])
+                        except ValueError:
+                            # empty, or not a number like "Inferred sex"
+                            continue
+                        values.setdefault(metric, []).append(value)
+        return values
+
+def median(values):
+    ordered = sorted(values)
+    mid = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[mid]
+    return (ordered[mid - 1] + ordered[mid]) / 2
+
+def check_outliers(data, cohort, threshold=3.5, min_cohort=20):
+    """
+    Flags samples whose robust z-score against the cohort is above the threshold.
+    The robust z-score is 0.6745 * (value - median) / MAD of the cohort values.
+    The sex chromosome ratios are not checked.
+
+    Args:
+        data (dict): Dictionary containing all parsed metrics
+        cohort (dict): Metric(s) (key), list of cohort values (value)
+        threshold (float): Largest accepted absolute robust z-score
+        min_cohort (int): Metrics with fewer cohort values are not checked
+
+    Returns:
+        dict: Metric(s), sample(s), value(s) and z-score(s) of the outliers
+    """
+    outliers = {}
+    for metric, samples in data.items():
+        values = cohort.get(metric, [])
+        if metric in outlier_excluded_metrics or len(values) < min_cohort:
+            continue
+        center = median(values)
+        mad = median([abs(value - center) for value in values])
+        if mad == 0:
+            continue
+        for sample, value in samples.items():
+            if not isinstance(value, (int, float)):
+                continue
+            z_score = 0.6745 * (value - center) / mad
+            if abs(z_score) > threshold:
+                outliers.setdefault(metric, []).append((sample, value, z_score))
+    return outliers
+
+def cohort_summary(values, percentiles=(5, 25, 50, 75, 95)):
+    """
+    Args:
+        values (dict): Metric(s) (key), list of values (value), from QCStore.values
+
+    Returns:
+        dict: Metric(s) (key), dict with n and the percentiles (value)
+    """
+    summary = {}
+    for metric, metric_values in values.items():
+        ordered = sorted(metric_values)
+        summary[metric] = {"n": len(ordered)}
+        for percentile in percentiles:
+            summary[metric][f"p{percentile}"] = ordered[min(len(ordered) - 1, len(ordered) * percentile // 100)]
+    return summary
+
 def main():
 
     args = parse_arguments()
+    if args.query is not None:
+        store = QCStore(args.metrics_store)
+        values = store.values(None, args.query or None, args.since)
+        yaml.dump(cohort_summary(values), sys.stdout, allow_unicode=True)
+        return
+
     analysis_dir = args.analysis_dir
     project = args.project
     qc = QC()
@@ -344,17 +1180,39 @@ def main():
     if not reports:
         sys.exit(1)
     
-    all_data = collect_data(reports)
+    thresholds = [int(coverage) for coverage in args.coverage_thresholds.split(",")]
+    cache = MetricsCache(os.path.join(analysis_dir, ".multiqc_extra_stats_cache.json"))
+    all_data = collect_data(reports, thresholds, args.workers, cache)
+    # A joint VCF holds all samples, its blocks are counted in parallel instead
+    joint_vcf = pick_joint_vcf(reports.get("joint_vcf", []))
+    if joint_vcf:
+        joint_stats = cache.get("joint_vcf", joint_vcf, thresholds)
+        if joint_stats is None:
+            joint_stats = read_vcf_stats(joint_vcf, args.workers)
+            cache.put("joint_vcf", joint_vcf, thresholds, joint_stats)
+        for sample, metrics in joint_stats.items():
+            for metric, value in metrics.items():
+                all_data.setdefault(metric, {})[sample] = value
+    cache.save()
     qc_fail = check_qc(all_data, qc) 
-    qc_out = QC_out(qc_fail, qc)
+
+    outliers = None
+    if args.metrics_store:
+        store = QCStore(args.metrics_store)
+        try:
+            cohort = store.values(store.recent_projects(args.cohort_projects, exclude=project))
+            outliers = check_outliers(all_data, cohort, args.outlier_threshold)
+            if args.store_metrics:
+                store.append(project, all_data)
+        except OSError as e:
+            print(f"Warning! Metrics store {args.metrics_store} not available: {e}")
+    qc_out = QC_out(qc_fail, qc, outliers)
     extra_genstats = extra_genstats_out(all_data)
     
     outdir = os.path.join(analysis_dir, "multiqc_qc_check")
-    os.mkdir(outdir)
-    with open(os.path.join(outdir, "QC_list_mqc.yaml"), "w") as fout:
-        yaml.dump(qc_out, fout)
-    with open(os.path.join(outdir, "extra_stats.yaml"), "w") as fout:
-        yaml.dump(extra_genstats, fout)
+    os.makedirs(outdir, exist_ok=True)
+    write_atomic(os.path.join(outdir, "QC_list_mqc.yaml"), lambda fout: yaml.dump(qc_out, fout))
+    write_atomic(os.path.join(outdir, "extra_stats.yaml"), lambda fout: yaml.dump(extra_genstats, fout))
 
 if __name__ == "__main__":
     main()
@@ -3,20 +3,27 @@
 import os
 import sys
 import argparse
-import shutil
 import csv
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 
+from samplesheet import SampleSheetCache
+
 
 def parse_arguments():
     parser = argparse.ArgumentParser(
-        description="Organize flowcell for a specific project"
+        description="Organize flowcell for a specific project. Several runfolders and projects "
+        "can be given to organize all projects in all runfolders in one go."
     )
     parser.add_argument(
-        "--runfolder", type=str, required=True, help="Path to runfolder (required)"
+        "--runfolder",
+        type=str,
+        nargs="+",
+        required=True,
+        help="Path to runfolder(s) (required)",
     )
     parser.add_argument(
-        "--project", type=str, required=True, help="Project name (required)"
+        "--project", type=str, nargs="+", required=True, help="Project name(s) (required)"
     )
     parser.add_argument(
         "--base_data_path",
@@ -56,7 +63,15 @@ def parse_arguments():
         "--force",
         required=False,
         action="store_true",
-        help="Force organization of runfolder. Previous runfolder organization will be removed.",
+        help="Force organization of runfolder. Links of the previous runfolder organization "
+        "that no longer match the sample sheet are removed or updated.",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        required=False,
+        default=16,
+        help="Number of threads used to create folders and symlinks (default: %(default)s)",
     )
     return parser.parse_args()
 
@@ -64,79 +79,213 @@ def parse_arguments():
 def parse_samplesheet(
     samplesheet, project, exclude_lane, exclude_sample, exclude_sampleID
 ):
-    sample_info = {}
+    return parse_samplesheet_projects(
+        samplesheet, [project], exclude_lane, exclude_sample, exclude_sampleID
+    )[project]
 
-    lane_i, sample_id_i, sample_name_i, description_i = None, None, None, None
+
+def parse_samplesheet_projects(
+    samplesheet, projects, exclude_lane, exclude_sample, exclude_sampleID
+):
+    # {project: {sample_id: {sample_name: [lane, library_name]}}} from a single read
+    sample_info = {project: {} for project in projects}
 
     try:
-        with open(samplesheet) as fin:
-            samplesheet = csv.reader(fin)
-
-            for row in samplesheet:
-                if "[Data]" in row:
-                    header = next(samplesheet)
-                    lane_i = header.index("Lane")
-                    sample_id_i = header.index("Sample_ID")
-                    sample_name_i = header.index("Sample_Name")
-                    description_i = header.index("Description")
-                    continue
+        rows = SampleSheetCache().rows(samplesheet)
+    except (OSError, UnicodeDecodeError, csv.Error) as e:
+        print(f"Error parsing SampleSheet.csv: {e}")
+        rows = []
+
+    for row in rows:
+        if row.project not in sample_info:
+            continue
+        include = not (
+            row.lane in exclude_lane
+            or row.sample_id in exclude_sampleID
+            or row.sample_name in exclude_sample
+        )
+
+        if include:
+            if row.library_name is None:
+                print(f"No LIBRARY_NAME in the description of {row.sample_id}")
+                continue
+            sample_info[row.project].setdefault(row.sample_id, {})[row.sample_name] = [
+                row.lane,
+                row.library_name,
+            ]
 
-                if project not in row:
-                    continue
+    return sample_info
 
-                lane, sample_id, sample_name = (
-                    row[lane_i],
-                    row[sample_id_i],
-                    row[sample_name_i],
-                )
-                include = not (
-                    lane in exclude_lane
-                    or sample_id in exclude_sampleID
-                    or sample_name in exclude_sample
-                )
 
-                if include:
-                    description = dict(
-                        item.split(":") for item in row[description_i].split(";")
-                    )
-                    library_name = description["LIBRARY_NAME"]
-                    sample_info.setdefault(sample_id, {})[sample_name] = [
-                        lane,
-                        library_name,
-                    ]
+def list_fastqs(fq_folder):
+    # equivalent to glob(os.path.join(fq_folder, "*fastq.gz"))
+    try:
+        with os.scandir(fq_folder) as entries:
+            return [
+                entry.path
+                for entry in entries
+                if entry.name.endswith("fastq.gz") and not entry.name.startswith(".")
+            ]
+    except OSError:
+        return []
 
-    except csv.Error as e:
-        print(f"Error parsing SampleSheet.csv: {e}")
 
-    return sample_info
+def _map(executor, fn, items):
+    if executor is None:
+        return [fn(*item) for item in items]
+    return [future.result() for future in [executor.submit(fn, *item) for item in items]]
 
 
-def organize_files(sample_info, runfolder_path, project, data_path):
+def collect_links(sample_info, runfolder_path, project, data_path, executor=None):
+    # {symlink path: fastq} for every link the organized runfolder should contain
     runfolder = os.path.basename(runfolder_path)
-    for sample_id, samples in sample_info.items():
-        for sample_name, (lane, library_name) in samples.items():
-            fq_folder = os.path.join(runfolder_path, "Unaligned", project, sample_id)
-            src_path = glob(os.path.join(fq_folder, "*fastq.gz"))
-            if src_path:
-                dst_path = os.path.join(data_path, sample_name, library_name, runfolder)
-                os.makedirs(dst_path, exist_ok=True)
-                for fastq in src_path:
-                    symlink(dst_path, fastq)
-            else:
-                print(f"No fastq.gz files found in {fq_folder}")
+    fastq_path = os.path.join(runfolder_path, "Unaligned", project)
+    # list the sample folders once, so that missing samples need no lookup of their own
+    with os.scandir(fastq_path) as entries:
+        sample_folders = {entry.name for entry in entries if entry.is_dir()}
+
+    def sample_links(sample_id, sample_name, library_name):
+        fq_folder = os.path.join(fastq_path, sample_id)
+        src_path = list_fastqs(fq_folder) if sample_id in sample_folders else []
+        if not src_path:
+            print(f"No fastq.gz files found in {fq_folder}")
+        dst_path = os.path.join(data_path, sample_name, library_name, runfolder)
+        return {os.path.join(dst_path, os.path.basename(fq)): fq for fq in src_path}
+
+    samples = [
+        (sample_id, sample_name, library_name)
+        for sample_id, sample_names in sample_info.items()
+        for sample_name, (lane, library_name) in sample_names.items()
+    ]
+    links = {}
+    for sample in _map(executor, sample_links, samples):
+        links.update(sample)
+    return links
+
+
+def manifest_file(data_path, runfolder_path):
+    return os.path.join(data_path, f".{os.path.basename(runfolder_path)}.links.tsv")
+
+
+def read_manifest(data_path, runfolder_path):
+    # Links recorded by the previous run, None if there is no manifest
+    manifest = manifest_file(data_path, runfolder_path)
+    if not os.path.exists(manifest):
+        return None
+    links = {}
+    with open(manifest) as fin:
+        for line in fin:
+            dst_file, fastq = line.rstrip("\n").split("\t")
+            links[os.path.join(data_path, dst_file)] = fastq
+    return links
+
+
+def write_manifest(data_path, runfolder_path, links):
+    manifest = manifest_file(data_path, runfolder_path)
+    if not links:
+        if os.path.exists(manifest):
+            os.remove(manifest)
+        return
+    tmp_file = f"{manifest}.tmp"
+    with open(tmp_file, "w") as fout:
+        for dst_file, fastq in sorted(links.items()):
+            fout.write(f"{os.path.relpath(dst_file, data_path)}\t{fastq}\n")
+    os.replace(tmp_file, manifest)
+
+
+def read_organized(organized_data):
+    # Links of an organization made without a manifest, read back from disk
+    links = {}
+    for path in organized_data:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                links[entry.path] = (
+                    os.readlink(entry.path) if entry.is_symlink() else None
+                )
+    return links
+
+
+def organize_files(
+    sample_info, runfolder_path, project, data_path, executor=None, previous=None
+):
+    links = collect_links(sample_info, runfolder_path, project, data_path, executor)
+    previous = previous or {}
+
+    # Only links that differ from the previous organization, or are missing on disk
+    # (e.g. removed by hand), are touched
+    removed = [(dst_file,) for dst_file in previous if dst_file not in links]
+    changed = [
+        (os.path.dirname(dst_file), fastq)
+        for dst_file, fastq in links.items()
+        if previous.get(dst_file) != fastq or not os.path.islink(dst_file)
+    ]
+
+    _map(executor, remove_link, removed)
+    for dst_path in sorted({os.path.dirname(dst_file) for (dst_file,) in removed}):
+        if os.path.isdir(dst_path) and not os.listdir(dst_path):
+            os.rmdir(dst_path)
+            clean_empty_parent_dirs(dst_path)
+
+    for dst_path in {dst_path for dst_path, fastq in changed}:
+        os.makedirs(dst_path, exist_ok=True)
+    created = _map(executor, symlink, changed)
+
+    # Links that could not be created are left out of the manifest, so the next run retries them
+    failed = {
+        os.path.join(dst_path, os.path.basename(fastq))
+        for (dst_path, fastq), ok in zip(changed, created)
+        if not ok
+    }
+    write_manifest(
+        data_path,
+        runfolder_path,
+        {dst_file: fastq for dst_file, fastq in links.items() if dst_file not in failed},
+    )
+    print(
+        f"{project}: {len(changed) - len(failed)} links added or updated, {len(removed)} removed, "
+        f"{len(links) - len(changed)} unchanged"
+        + (f", {len(failed)} could not be created" if failed else "")
+    )
+
+
+def remove_link(dst_file):
+    try:
+        os.remove(dst_file)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"Error removing symlink: {e}")
 
 
 def symlink(dst_path, fastq):
     if os.path.exists(fastq):
         fq_name = os.path.basename(fastq)
         dst_file = os.path.join(dst_path, fq_name)
+        # Create the link under a temporary name and rename it into place, so that
+        # an existing link is replaced atomically
+        tmp_file = os.path.join(dst_path, f".{fq_name}.tmp")
         try:
-            os.symlink(fastq, dst_file)
+            # left behind by an interrupted run
+            os.unlink(tmp_file)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Error creating symlink: {e}")
+            return False
+        try:
+            os.symlink(fastq, tmp_file)
+            os.replace(tmp_file, dst_file)
         # Should catch possible permission issues
         except OSError as e:
             print(f"Error creating symlink: {e}")
-    else:
-        print(f"No symlink created for {fastq}. File not found.")
+            try:
+                os.unlink(tmp_file)
+            except OSError:
+                pass
+            return False
+        return True
+    print(f"No symlink created for {fastq}. File not found.")
+    return False
 
 
 def check_paths(runfolder_path, fastq_path, samplesheet, data_path, project, force):
@@ -150,18 +299,14 @@ def check_paths(runfolder_path, fastq_path, samplesheet, data_path, project, for
     organized_data = glob(
         os.path.join(data_path, "*/*", os.path.basename(runfolder_path))
     )
-    if organized_data:
-        if force:
-            remove_organized(organized_data)
-        else:
-            raise Exception("Flowcell already organized for this project.")
+    if organized_data and not force:
+        raise Exception("Flowcell already organized for this project.")
 
-
-def remove_organized(organized_data):
-    for path in organized_data:
-        # Remove folder and symlinks
-        shutil.rmtree(path)
-        clean_empty_parent_dirs(path)
+    # The previous organization that a forced run is compared against
+    previous = read_manifest(data_path, runfolder_path)
+    if previous is None:
+        previous = read_organized(organized_data)
+    return previous
 
 
 def clean_empty_parent_dirs(path):
@@ -175,8 +320,6 @@ def clean_empty_parent_dirs(path):
 
 def main():
     args = parse_arguments()
-    runfolder_path = args.runfolder
-    project = args.project
     exclude_lane = args.exclude_lane.split(",")
     exclude_sample = args.exclude_sample.split(",")
     exclude_sampleID = args.exclude_sampleID.split(",")
@@ -184,24 +327,63 @@ def main():
     suffix = args.suffix
     force = args.force
 
-    outdir = project
-    if suffix:
-        outdir += f"_{suffix}"
-    data_path = os.path.join(base_data_path, outdir)
-    fastq_path = os.path.join(runfolder_path, "Unaligned", project)
-    samplesheet = os.path.join(runfolder_path, "SampleSheet.csv")
+    failed = False
+    found_projects = set()
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        for runfolder_path in args.runfolder:
+            samplesheet = os.path.join(runfolder_path, "SampleSheet.csv")
+
+            projects = []
+            for project in args.project:
+                outdir = project
+                if suffix:
+                    outdir += f"_{suffix}"
+                data_path = os.path.join(base_data_path, outdir)
+                fastq_path = os.path.join(runfolder_path, "Unaligned", project)
+                if os.path.exists(runfolder_path) and not os.path.exists(fastq_path):
+                    # not every runfolder in a batch holds every project
+                    print(f"Project {project} not found in {runfolder_path}, skipping.")
+                    continue
+                found_projects.add(project)
 
-    try:
-        check_paths(runfolder_path, fastq_path, samplesheet, data_path, project, force)
-    except (FileNotFoundError, Exception) as e:
-        print(f"Something went wrong: {e}")
-        sys.exit(1)
+                try:
+                    previous = check_paths(
+                        runfolder_path, fastq_path, samplesheet, data_path, project, force
+                    )
+                except Exception as e:
+                    print(f"Something went wrong: {e}")
+                    failed = True
+                    continue
+                projects.append((project, data_path, previous))
+
+            if not projects:
+                continue
+
+            sample_info = parse_samplesheet_projects(
+                samplesheet,
+                [project for project, _, _ in projects],
+                exclude_lane,
+                exclude_sample,
+                exclude_sampleID,
+            )
+
+            for project, data_path, previous in projects:
+                organize_files(
+                    sample_info[project],
+                    runfolder_path,
+                    project,
+                    data_path,
+                    executor,
+                    previous,
+                )
 
-    sample_info = parse_samplesheet(
-        samplesheet, project, exclude_lane, exclude_sample, exclude_sampleID
-    )
+    for project in args.project:
+        if project not in found_projects:
+            print(f"Something went wrong: Project {project} not found in any of the runfolders.")
+            failed = True
 
-    organize_files(sample_info, runfolder_path, project, data_path)
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -2,72 +2,308 @@
 
 import os
 import argparse
-import csv
+import hashlib
+import json
+import re
+import sqlite3
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
 from glob import glob
 
-def find_runfolders_with_project(project_id):
+from samplesheet import SampleSheetCache
+
+incoming_dir = "/proj/ngi2016001/incoming"
+default_index_file = "/proj/ngi2016001/nobackup/NGI/.incoming_index.sqlite"
+index_schema_version = 3
+scan_workers = 16
+
+
+class IncomingIndex:
+    """
+    SQLite index of runfolder -> project -> sample ID -> fastq files in incoming.
+    A runfolder is only rescanned when the mtime of the runfolder or its Unaligned
+    folder has changed. The projects that are searched for are also rescanned when
+    the mtime of their project folder or of any sample folder in it has changed, so
+    fastqs written into existing sample folders are picked up. The index location
+    can be set with the PROJECT_SEARCH_INDEX environment variable.
+    """
+
+    def __init__(self, index_file=None):
+        self.index_file = index_file or os.environ.get("PROJECT_SEARCH_INDEX", default_index_file)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.index_file, timeout=60)
+        if conn.execute("PRAGMA user_version").fetchone()[0] != index_schema_version:
+            with conn:
+                for table in ["runfolders", "projects", "samples", "fastqs"]:
+                    conn.execute(f"DROP TABLE IF EXISTS {table}")
+                conn.execute(
+                    "CREATE TABLE runfolders "
+                    "(runfolder TEXT PRIMARY KEY, mtime_ns INTEGER, unaligned_mtime_ns INTEGER)")
+                conn.execute(
+                    "CREATE TABLE projects (runfolder TEXT, project TEXT, folders_key TEXT)")
+                conn.execute(
+                    "CREATE TABLE samples (runfolder TEXT, project TEXT, sample_id TEXT)")
+                conn.execute(
+                    "CREATE TABLE fastqs (runfolder TEXT, project TEXT, sample_id TEXT, "
+                    "name TEXT, is_r1 INTEGER, is_r2 INTEGER, lane TEXT)")
+                conn.execute("CREATE INDEX projects_project ON projects (project)")
+                conn.execute("CREATE INDEX samples_project ON samples (project)")
+                conn.execute("CREATE INDEX fastqs_project ON fastqs (project)")
+                conn.execute(f"PRAGMA user_version = {index_schema_version}")
+        return conn
+
+    def refresh(self, search_dir=incoming_dir, rescan=False, projects=None):
+        """
+        Rescan the runfolders in search_dir that are new or changed, and drop
+        runfolders that are gone. In the other runfolders, the given projects
+        are rescanned if their project or sample folders have changed.
+
+        Returns:
+            Number of runfolders and projects that were scanned
+        """
+        with os.scandir(search_dir) as entries:
+            runfolders = [entry.path for entry in entries]
+        with ThreadPoolExecutor(max_workers=scan_workers) as executor:
+            keys = executor.map(runfolder_key, runfolders)
+            current = {
+                runfolder: key for runfolder, key in zip(runfolders, keys) if key is not None}
+
+            with self._connect() as conn:
+                indexed = {
+                    runfolder: (mtime_ns, unaligned_mtime_ns)
+                    for runfolder, mtime_ns, unaligned_mtime_ns in conn.execute(
+                        "SELECT * FROM runfolders")}
+                indexed_projects = [
+                    row for project in projects or [] for row in conn.execute(
+                        "SELECT runfolder, project, folders_key FROM projects WHERE project = ?",
+                        (project,))]
+            changed = [
+                runfolder for runfolder, key in current.items()
+                if rescan or indexed.get(runfolder) != key]
+            gone = [runfolder for runfolder in indexed if runfolder not in current]
+
+            # only the searched projects are checked in the runfolders that are not rescanned
+            unchanged = [
+                (runfolder, project, folders_key)
+                for runfolder, project, folders_key in indexed_projects
+                if runfolder in current and runfolder not in changed]
+            project_keys = executor.map(
+                lambda row: project_key(os.path.join(row[0], "Unaligned", row[1])), unchanged)
+            changed_projects = [
+                (runfolder, project) for (runfolder, project, folders_key), key
+                in zip(unchanged, project_keys) if key != folders_key]
+
+            scanned = list(zip(changed, executor.map(scan_runfolder, changed)))
+            scanned_projects = list(zip(
+                changed_projects, executor.map(lambda row: scan_project(*row), changed_projects)))
+
+        with self._connect() as conn:
+            for runfolder in gone + changed:
+                for table in ["runfolders", "projects", "samples", "fastqs"]:
+                    conn.execute(f"DELETE FROM {table} WHERE runfolder = ?", (runfolder,))
+            for runfolder, project in changed_projects:
+                for table in ["projects", "samples", "fastqs"]:
+                    conn.execute(
+                        f"DELETE FROM {table} WHERE runfolder = ? AND project = ?",
+                        (runfolder, project))
+            scanned_all = [
+                (runfolder, project_scan) for runfolder, project_scans in scanned
+                for project_scan in project_scans]
+            scanned_all += [
+                (runfolder, project_scan) for (runfolder, _), project_scan in scanned_projects
+                if project_scan is not None]
+            for runfolder, (project, folders_key, samples, fastqs) in scanned_all:
+                conn.execute(
+                    "INSERT INTO projects VALUES (?, ?, ?)", (runfolder, project, folders_key))
+                conn.executemany(
+                    "INSERT INTO samples VALUES (?, ?, ?)",
+                    ((runfolder, project, sample_id) for sample_id in samples))
+                conn.executemany(
+                    "INSERT INTO fastqs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    ((runfolder, project) + fastq for fastq in fastqs))
+            conn.executemany(
+                "INSERT INTO runfolders VALUES (?, ?, ?)",
+                ((runfolder,) + current[runfolder] for runfolder in changed))
+        return len(changed) + len(changed_projects)
+
+    def runfolders_with_project(self, project_id):
+        """
+        Returns:
+            {"Path to runfolder": {Sample_ID1, Sample_ID2}}
+        """
+        runfolders_with_project = {}
+        with self._connect() as conn:
+            for runfolder, sample_id in conn.execute(
+                    "SELECT runfolder, sample_id FROM samples WHERE project = ?", (project_id,)):
+                samples = runfolders_with_project.setdefault(runfolder, set())
+                if sample_id is not None:
+                    samples.add(sample_id)
+        return runfolders_with_project
+
+    def fastqs(self, runfolders, project):
+        """
+        Returns:
+            {runfolder: {"R1": [fastq names], "R2": [fastq names]}, "Total": {"R1": n, "R2": n}}
+        """
+        fastqs = {runfolder: {"R1": [], "R2": []} for runfolder in runfolders}
+        fastqs["Total"] = {"R1": 0, "R2": 0}
+        with self._connect() as conn:
+            for runfolder, name, is_r1, is_r2 in conn.execute(
+                    "SELECT runfolder, name, is_r1, is_r2 FROM fastqs WHERE project = ? "
+                    "ORDER BY rowid", (project,)):
+                if runfolder not in fastqs:
+                    continue
+                for read, is_read in [("R1", is_r1), ("R2", is_r2)]:
+                    if is_read:
+                        fastqs[runfolder][read].append(name)
+                        fastqs["Total"][read] += 1
+        return fastqs
+
+
+def runfolder_key(runfolder_path):
+    """
+    Returns:
+        (mtime_ns of the runfolder, mtime_ns of its Unaligned folder),
+        None if the runfolder has no Unaligned folder
+    """
+    try:
+        return (
+            os.stat(runfolder_path).st_mtime_ns,
+            os.stat(os.path.join(runfolder_path, "Unaligned")).st_mtime_ns)
+    except OSError:
+        return None
+
+
+def project_key(project_path):
+    """
+    A key made from the mtimes of a project folder and the sample folders in it.
+
+    Returns:
+        sha1 hex digest, None if the project folder can not be read
+    """
+    try:
+        mtimes = [f"{os.stat(project_path).st_mtime_ns}"]
+        with os.scandir(project_path) as samples:
+            mtimes.extend(
+                f"{sample.name}:{sample.stat().st_mtime_ns}"
+                for sample in sorted(samples, key=lambda entry: entry.name)
+                if sample.is_dir())
+    except OSError:
+        return None
+    return hashlib.sha1("\n".join(mtimes).encode()).hexdigest()
+
+
+def scan_runfolder(runfolder_path):
+    """
+    Scans all project folders in the Unaligned folder of a runfolder.
+
+    Returns:
+        [(project, folders key, [sample_id], [(sample_id, fastq name, is_r1, is_r2, lane)])]
+    """
+    unaligned_dir = os.path.join(runfolder_path, "Unaligned")
+    try:
+        projects = [entry.name for entry in os.scandir(unaligned_dir) if entry.is_dir()]
+    except OSError:
+        return []
+    scans = (scan_project(runfolder_path, project) for project in projects)
+    return [scan for scan in scans if scan is not None]
+
+
+def scan_project(runfolder_path, project):
+    """
+    Lists the sample folders of a project folder in Unaligned and all fastq files
+    below it, the same files that get_fastqs finds with its recursive globs.
+
+    Returns:
+        (project, folders key, [sample_id], [(sample_id, fastq name, is_r1, is_r2, lane)]),
+        None if the project folder can not be read
+    """
+    project_path = os.path.join(runfolder_path, "Unaligned", project)
+    # taken before listing, so changes made during the scan are picked up next time
+    folders_key = project_key(project_path)
+    try:
+        sample_ids = os.listdir(project_path)
+    except OSError:
+        return None
+    fastqs = []
+    for dirpath, dirnames, filenames in os.walk(project_path, followlinks=True):
+        dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+        relpath = os.path.relpath(dirpath, project_path)
+        sample_id = None if relpath == "." else relpath.split(os.sep)[0]
+        for name in filenames:
+            if name.startswith(".") or not name.endswith("fastq.gz"):
+                continue
+            lane = re.search(r"_L(\d{3})_", name)
+            fastqs.append((
+                sample_id,
+                name,
+                fnmatch(name, "*R1*fastq.gz"),
+                fnmatch(name, "*R2*fastq.gz"),
+                lane.group(1).lstrip("0") if lane else None))
+    # an empty project folder is still recorded
+    return project, folders_key, sample_ids or [None], fastqs
+
+
+def find_runfolders_with_project(project_id, index=None):
     """
     Identifies project folders in the Unaligned directory in runfolders.
     If project_id is found, all sample folders (folder name == Sample ID) 
-    for the project are listed
+    for the project are listed. Answered from the index if one is given.
     
     Returns:
         {"Path to runfolder": {Sample_ID1, Sample_ID2}}
     """
-    incoming_dir = "/proj/ngi2016001/incoming"
-    runfolders_with_project = {}
+    return find_runfolders_with_projects([project_id], index)[project_id]
+
+def find_runfolders_with_projects(project_ids, index=None):
+    """
+    Like find_runfolders_with_project, for several projects in a single pass over incoming.
+
+    Returns:
+        {project_id: {"Path to runfolder": {Sample_ID1, Sample_ID2}}}
+    """
+    if index is not None:
+        return {project_id: index.runfolders_with_project(project_id) for project_id in project_ids}
+    runfolders_with_projects = {project_id: {} for project_id in project_ids}
     for runfolder_name in os.listdir(incoming_dir):
         runfolder_path = os.path.join(incoming_dir, runfolder_name)
         unaligned_dir = os.path.join(runfolder_path, "Unaligned")
         
         if os.path.isdir(unaligned_dir):
             for project_dir_name in os.listdir(unaligned_dir):
-                if project_dir_name == project_id:
+                if project_dir_name in runfolders_with_projects:
                     project_path = os.path.join(unaligned_dir, project_dir_name)
-                    runfolders_with_project[runfolder_path] = set(os.listdir(project_path))
-                    break
-    return runfolders_with_project
+                    runfolders_with_projects[project_dir_name][runfolder_path] = set(os.listdir(project_path))
+    return runfolders_with_projects
 
 def parse_samplesheet(runfolders, project):
     """
     Parse sample names and lanes from SampleSheet.csv of each runfolder.
+    The sample sheets are read through the shared sample sheet cache.
 
     Returns:
         {runfolder: {"lanes": set(), "sample_nms": set()}}
     """
     sample_info = {runfolder: {"lanes": set(), "sample_nms": set()} for runfolder in runfolders}
 
+    cache = SampleSheetCache()
+    cache.refresh(os.path.join(runfolder, "SampleSheet.csv") for runfolder in runfolders)
     for runfolder in runfolders:
         samplesheet_path = os.path.join(runfolder, "SampleSheet.csv")
         if os.path.exists(samplesheet_path):
             try:
-                with open(samplesheet_path, 'r', encoding='utf-8') as fin:
-                    reader = csv.reader(fin)
-                    sample_name_i = None
-                    header_found = False
-
-                    for row in reader:
-                        if "[Data]" in row:
-                            header_found = True
-                            header = next(reader)
-                            try:
-                                sample_name_i = header.index("Sample_Name")
-                                lane_i = header.index("Lane")
-                            except ValueError:
-                                print(f"Warning: Sample_Name column not found in {samplesheet_path}")
-                                return {}
-                            continue
-                        if project not in row: continue 
-                        sample_name = row[sample_name_i]
-                        lane = row[lane_i]
-                        sample_info[runfolder]["sample_nms"].add(sample_name)
-                        sample_info[runfolder]["lanes"].add(lane)
-                    if not header_found:
-                        print(f"No header found for {samplesheet_path}")
+                rows = cache.rows(samplesheet_path)
             except Exception as e:
                 print(f"Error reading {samplesheet_path}: {e}")
                 return {}
+            if not rows:
+                print(f"No header found for {samplesheet_path}")
+            for row in rows:
+                if row.project != project: continue
+                sample_info[runfolder]["sample_nms"].add(row.sample_name)
+                sample_info[runfolder]["lanes"].add(row.lane)
         else:
             print(f"Warning: SampleSheet.csv not found in {runfolder}")
             return {}
@@ -101,24 +337,127 @@ def print_result(runfolder, sample_info, fastqs):
         f"{len(all_sample_ids):^10} {len(all_sample_names):^15} "
         f"{r1_total:^10} {r2_total:^10}")
 
-def get_fastqs(runfolders, project):
-    fastqs = {runfolder: {"R1": [], "R2": []} for runfolder in runfolders}
-    fastqs["Total"] = {"R1": 0, "R2": 0}
-    for runfolder in runfolders:
+def project_summary(project, runfolder, sample_info, fastqs, not_org=None):
+    """
+    The numbers shown by print_result, and the fastq files not organized, as plain data.
+
+    Returns:
+        {"project": project, "runfolders": [{...}], "total": {...}, "not_organized": {...}}
+    """
+    runfolders = []
+    all_sample_ids = set()
+    all_sample_names = set()
+    all_sample_lanes = []
+    for runfolder_path, sample_ids in runfolder.items():
+        info = sample_info[runfolder_path]
+        all_sample_ids.update(sample_ids)
+        all_sample_names.update(info["sample_nms"])
+        all_sample_lanes += list(info["lanes"])
+        runfolders.append({
+            "runfolder": os.path.basename(runfolder_path),
+            "path": runfolder_path,
+            "lanes": sorted(info["lanes"]),
+            "sample_ids": sorted(sample_ids),
+            "sample_names": sorted(info["sample_nms"]),
+            "R1": len(fastqs[runfolder_path]["R1"]),
+            "R2": len(fastqs[runfolder_path]["R2"]),
+        })
+    return {
+        "project": project,
+        "runfolders": runfolders,
+        "total": {
+            "lanes": len(all_sample_lanes),
+            "sample_ids": len(all_sample_ids),
+            "sample_names": len(all_sample_names),
+            "R1": fastqs["Total"]["R1"],
+            "R2": fastqs["Total"]["R2"],
+        },
+        "not_organized": {
+            org_dir: [list(fq) for fq in fqs] for org_dir, fqs in (not_org or {}).items()},
+    }
+
+def write_tsv(summaries, fout=sys.stdout):
+    # One line per project and runfolder, and a total line per project.
+    # A project not found in any runfolder only gets a total line of zeros.
+    fields = ["project", "runfolder", "lanes", "sample_ids", "sample_names", "R1", "R2", "not_organized"]
+    fout.write("\t".join(fields) + "\n")
+    for summary in summaries:
+        if "runfolders" not in summary:
+            row = dict.fromkeys(fields, 0)
+            row.update(project=summary["project"], runfolder="Total (unique)")
+            fout.write("\t".join(str(row[field]) for field in fields) + "\n")
+            continue
+        rows = [
+            dict(row, lanes=len(row["lanes"]), sample_ids=len(row["sample_ids"]),
+                 sample_names=len(row["sample_names"]))
+            for row in summary["runfolders"]]
+        rows.append(dict(summary["total"], runfolder="Total (unique)"))
+        for row in rows:
+            not_organized = sum(
+                1 for fqs in summary["not_organized"].values() for fq in fqs
+                if row["runfolder"] in (fq[0], "Total (unique)"))
+            row = dict(row, project=summary["project"], not_organized=not_organized)
+            fout.write("\t".join(str(row[field]) for field in fields) + "\n")
+
+def get_fastqs(runfolders, project, index=None, workers=scan_workers):
+    if index is not None:
+        return index.fastqs(runfolders, project)
+
+    def runfolder_fastqs(runfolder):
         projpath = os.path.join(runfolder, "Unaligned", project)
-        for i in [1, 2]:
-            fq = glob(os.path.join(projpath, "**", f"*R{i}*fastq.gz"), recursive=True)
-            fastqs[runfolder][f"R{i}"] = [os.path.basename(path) for path in fq]
-            fastqs["Total"][f"R{i}"] += len(fq)
+        return {
+            f"R{i}": [
+                os.path.basename(path)
+                for path in glob(os.path.join(projpath, "**", f"*R{i}*fastq.gz"), recursive=True)]
+            for i in [1, 2]}
+
+    fastqs = {}
+    # The runfolders are scanned concurrently
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for runfolder, fq in zip(runfolders, executor.map(runfolder_fastqs, runfolders)):
+            fastqs[runfolder] = fq
+    fastqs["Total"] = {
+        read: sum(len(fastqs[runfolder][read]) for runfolder in runfolders)
+        for read in ["R1", "R2"]}
     return fastqs
 
-def check_organization(fastqs, org_paths):
+def organized_fastqs(org_path):
+    """
+    Walks an organized folder once, like a recursive glob for *fastq.gz.
+
+    Returns:
+        {(runfolder, fq_filename)}, where runfolder is the folder holding the fastq file
+    """
+    org_fq = set()
+    for dirpath, dirnames, filenames in os.walk(org_path, followlinks=True):
+        dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+        runfolder = os.path.basename(dirpath)
+        org_fq.update(
+            (runfolder, name) for name in filenames
+            if name.endswith("fastq.gz") and not name.startswith("."))
+    return org_fq
+
+def walk_organized(org_paths, workers=scan_workers):
+    """
+    Walks the organized folders concurrently, each once.
+
+    Returns:
+        {org_path: {(runfolder, fq_filename)}}
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(org_paths, executor.map(organized_fastqs, org_paths)))
+
+def check_organization(fastqs, org_paths, workers=scan_workers, org_fqs=None):
     """
     Identifies fastq files not organized in the given paths.
+    Each organized folder is walked once, unless already walked in org_fqs.
 
     Returns:
         {org_dir: (runfolder, fq_filename)}
     """
+    org_fqs = dict(org_fqs or {})
+    org_fqs.update(walk_organized([path for path in org_paths if path not in org_fqs], workers))
+
     not_organized = {}
     for runfolder_path, fq_filenames in fastqs.items():
         if runfolder_path == "Total":
@@ -126,20 +465,28 @@ def check_organization(fastqs, org_paths):
         runfolder = os.path.basename(runfolder_path)
         for org_path in org_paths:
             org_dir = os.path.basename(org_path)
+            org_fq = org_fqs[org_path]
             for i in [1, 2]:
-                org_fq_paths = glob(os.path.join(org_path, "**", f"*R{i}*fastq.gz"), recursive=True)
-                org_fq = {(os.path.basename(os.path.dirname(path)), os.path.basename(path)) for path in org_fq_paths}
-                for fq_filename in fq_filenames[f"R{i}"]:
-                    if (runfolder, fq_filename) not in org_fq:
-                        not_organized.setdefault(org_dir, [])
-                        not_organized[org_dir].append((runfolder, fq_filename))
+                missing = [
+                    (runfolder, fq_filename) for fq_filename in fq_filenames[f"R{i}"]
+                    if (runfolder, fq_filename) not in org_fq]
+                if missing:
+                    not_organized.setdefault(org_dir, []).extend(missing)
     return not_organized
 
+def read_projects(project_file):
+    # One project ID per line, empty lines and lines starting with # are ignored
+    with open(project_file) as fin:
+        return [line.strip() for line in fin if line.strip() and not line.startswith("#")]
+
 def main():
     parser = argparse.ArgumentParser(
         description="Find runfolders containing a specific project ID.")
     parser.add_argument(
-        "--project", required=True, help="The project ID to search for.")
+        "--project", nargs="+", default=[], help="The project ID(s) to search for.")
+    parser.add_argument(
+        "--project_file",
+        help="File with project IDs to search for, one per line.",)
     parser.add_argument(
         "--check_org",
         required=False,
@@ -152,45 +499,113 @@ def main():
         action="store_true",
         help="Disable listing of fastq files that are not organized in specified folder. "
         "Requires --check_org",)
+    parser.add_argument(
+        "--format",
+        choices=["table", "json", "tsv"],
+        default="table",
+        help="Output format (default: %(default)s)",)
+    parser.add_argument(
+        "--no_index",
+        action="store_true",
+        help="Scan incoming directly instead of using the incoming index.",)
+    parser.add_argument(
+        "--rescan",
+        action="store_true",
+        help="Rescan all runfolders in incoming when refreshing the index.",)
     args = parser.parse_args()
     
-    project = args.project
-    check_org = args.check_org
-    if check_org == "all":
-        check_org = f"{project}*"
+    projects = list(args.project)
+    if args.project_file:
+        projects += read_projects(args.project_file)
+    if not projects:
+        parser.error("give at least one project with --project or --project_file")
+    projects = list(dict.fromkeys(projects))
     summary_only = args.summary_only
-    
-    runfolders = find_runfolders_with_project(project)
-    if len(runfolders) == 0:
-        sys.exit(f"\n{project} could not be identified in any runfolder.")
+    table = args.format == "table"
 
-    sample_info = parse_samplesheet(runfolders, project)
-    
-    fastqs = get_fastqs(runfolders, project)
+    def check_org_pattern(project):
+        if args.check_org == "all":
+            return f"{project}*"
+        return args.check_org
     
-    print_result(runfolders, sample_info, fastqs)
+    index = None
+    if not args.no_index:
+        index = IncomingIndex()
+        try:
+            index.refresh(rescan=args.rescan, projects=projects)
+        except sqlite3.Error as e:
+            # e.g. an index file the user can not write, scan incoming directly instead
+            print(f"Warning: incoming index {index.index_file} not available: {e}", file=sys.stderr)
+            index = None
 
-    if check_org: 
-        org_paths = os.path.join(r"/proj/ngi2016001/nobackup/NGI/DATA/", f"{check_org}")
-        org_paths = glob(org_paths)
-        if len(org_paths) == 0:
-            sys.exit(f"\n{project} is not organized in /proj/ngi2016001/nobackup/NGI/DATA/{check_org}")
+    runfolders_with_projects = find_runfolders_with_projects(projects, index)
+
+    # Walk every organized folder of all projects once
+    org_paths = {
+        project: glob(os.path.join(r"/proj/ngi2016001/nobackup/NGI/DATA/", check_org_pattern(project)))
+        for project in projects} if args.check_org else {}
+    org_fqs = walk_organized(sorted({path for paths in org_paths.values() for path in paths}))
+
+    summaries = []
+    for project in projects:
+        if table and len(projects) > 1:
+            print(f"\n{project}")
+        runfolders = runfolders_with_projects[project]
+        if len(runfolders) == 0:
+            message = f"{project} could not be identified in any runfolder."
+            summaries.append({"project": project, "error": message})
+            if table:
+                if len(projects) == 1:
+                    sys.exit(f"\n{message}")
+                print(f"\n{message}")
+            continue
+
+        sample_info = parse_samplesheet(runfolders, project)
         
-        print("\nChecking organization in\n" + "\n".join(org_paths))
-        not_org = check_organization(fastqs, org_paths)
-        if len(not_org) == 0:
-            for org_path in org_paths:
-                org_dir = os.path.basename(org_path)
-                print(f"\nAll fastq files are organized for analysis in {org_dir}")
-        else:
-            print("")
-            for org_dir in not_org:
-                print(f"{len(not_org[org_dir])} fastq files (R1 + R2) are not organized in {org_dir}")
-                if not summary_only:
-                    for fq in not_org.get(org_dir, []):
-                        print(f"{fq[0]:<35} {fq[1]:<}")
+        fastqs = get_fastqs(runfolders, project, index)
+        
+        if table:
+            print_result(runfolders, sample_info, fastqs)
+
+        not_org = None
+        if args.check_org: 
+            if len(org_paths[project]) == 0:
+                message = f"{project} is not organized in /proj/ngi2016001/nobackup/NGI/DATA/{check_org_pattern(project)}"
+                summary = project_summary(project, runfolders, sample_info, fastqs)
+                summaries.append(dict(summary, error=message))
+                if table:
+                    if len(projects) == 1:
+                        sys.exit(f"\n{message}")
+                    print(f"\n{message}")
+                continue
+            
+            not_org = check_organization(fastqs, org_paths[project], org_fqs=org_fqs)
+            if table:
+                print("\nChecking organization in\n" + "\n".join(org_paths[project]))
+                if len(not_org) == 0:
+                    for org_path in org_paths[project]:
+                        org_dir = os.path.basename(org_path)
+                        print(f"\nAll fastq files are organized for analysis in {org_dir}")
+                else:
+                    print("")
+                    for org_dir in not_org:
+                        print(f"{len(not_org[org_dir])} fastq files (R1 + R2) are not organized in {org_dir}")
+                        if not summary_only:
+                            for fq in not_org.get(org_dir, []):
+                                print(f"{fq[0]:<35} {fq[1]:<}")
+        summaries.append(project_summary(project, runfolders, sample_info, fastqs, not_org))
     
-    print("")
+    if args.format == "json":
+        json.dump(summaries, sys.stdout, indent=2)
+        print("")
+    elif args.format == "tsv":
+        write_tsv(summaries)
+    else:
+        print("")
+
+    if not table and any("runfolders" not in summary for summary in summaries):
+        # like the table output, fail when a project could not be found
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
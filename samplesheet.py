@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+"""
+Shared, cached reader for the [Data] section of runfolder SampleSheet.csv files.
+
+Parsed rows are kept in an SQLite cache keyed by sample sheet path, mtime and size, so a
+sample sheet is only read again when it has changed. The cache location can be set with
+the SAMPLESHEET_CACHE environment variable.
+
+Usage:
+    samplesheet.py P1234 [P5678 ...]              # rows for the projects, as TSV
+    samplesheet.py --runfolders P1234             # names of runfolders with the project
+    samplesheet.py --runfolders --samples P1234_101  # ... or with a sample ID or name
+"""
+
+import argparse
+import concurrent.futures
+import contextlib
+import csv
+import os
+import sqlite3
+import sys
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+incoming_dir = "/proj/ngi2016001/incoming"
+default_cache_file = "/proj/ngi2016001/nobackup/NGI/.samplesheet_cache.sqlite"
+schema_version = 1
+parse_workers = 16
+lookup_batch = 500
+
+
+class SampleSheetRow(NamedTuple):
+    runfolder: str
+    lane: Optional[str]
+    sample_id: Optional[str]
+    sample_name: Optional[str]
+    project: Optional[str]
+    library_name: Optional[str]
+
+
+def find_samplesheets(search_dir: str = incoming_dir) -> List[str]:
+    """
+    Lists the csv files at most two folders down, like `find -L <dir> -maxdepth 2 -name "*.csv"`.
+
+    Returns:
+        List of paths to csv files
+    """
+    samplesheets = []
+    with os.scandir(search_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith(".csv") and entry.is_file():
+                samplesheets.append(entry.path)
+            elif entry.is_dir():
+                try:
+                    with os.scandir(entry.path) as sub_entries:
+                        samplesheets.extend(
+                            sub.path for sub in sub_entries
+                            if sub.name.endswith(".csv") and sub.is_file())
+                except OSError:
+                    continue
+    return sorted(samplesheets)
+
+
+def parse_description(description: str) -> Dict[str, str]:
+    # Description is a ;-separated list of KEY:VALUE pairs, e.g. LIBRARY_NAME:SX1234_A_B
+    return dict(
+        item.split(":", 1) for item in description.strip().split(";") if ":" in item)
+
+
+def parse_samplesheet(samplesheet: str) -> List[SampleSheetRow]:
+    """
+    Parse the [Data] section of a sample sheet.
+
+    Columns missing from the sample sheet give None in the returned rows.
+
+    Returns:
+        List of SampleSheetRow
+    """
+    runfolder = os.path.dirname(samplesheet)
+    rows = []
+    with open(samplesheet, newline="", encoding="utf-8") as fin:
+        reader = csv.reader(fin)
+        header = None
+        for row in reader:
+            if "[Data]" in row:
+                header = next(reader)
+                continue
+            if header is None or not row or not any(row):
+                continue
+            if row[0].startswith("["):
+                # next section
+                header = None
+                continue
+            fields = dict(zip(header, row))
+            description = parse_description(fields.get("Description", ""))
+            rows.append(SampleSheetRow(
+                runfolder,
+                fields.get("Lane"),
+                fields.get("Sample_ID"),
+                fields.get("Sample_Name"),
+                fields.get("Sample_Project"),
+                description.get("LIBRARY_NAME")))
+    return rows
+
+
+def parse_samplesheet_safe(samplesheet: str) -> Optional[List[SampleSheetRow]]:
+    # Like parse_samplesheet, but an unreadable sample sheet gives None instead of raising
+    try:
+        return parse_samplesheet(samplesheet)
+    except (OSError, UnicodeDecodeError, csv.Error) as e:
+        print(f"Error reading {samplesheet}: {e}", file=sys.stderr)
+        return None
+
+
+class SampleSheetCache:
+    """
+    SQLite cache of parsed sample sheets, refreshed when the mtime or size of a sample
+    sheet changes. A new connection is opened for each operation.
+    """
+
+    def __init__(self, cache_file: Optional[str] = None):
+        self.cache_file = cache_file or os.environ.get("SAMPLESHEET_CACHE", default_cache_file)
+        self.disabled = False
+        try:
+            with self._connect():
+                pass
+        except sqlite3.Error as e:
+            self._disable(e)
+
+    def _disable(self, error: sqlite3.Error) -> None:
+        # e.g. a read-only cache file, the sample sheets are then parsed without the cache
+        print(f"Warning: sample sheet cache {self.cache_file} not available: {error}",
+              file=sys.stderr)
+        self.disabled = True
+
+    @contextlib.contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.cache_file, timeout=60)
+        try:
+            with conn:
+                self._create_tables(conn)
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _create_tables(conn: sqlite3.Connection) -> None:
+        if conn.execute("PRAGMA user_version").fetchone()[0] != schema_version:
+            conn.execute("DROP TABLE IF EXISTS samplesheets")
+            conn.execute("DROP TABLE IF EXISTS samplesheet_rows")
+            conn.execute(
+                "CREATE TABLE samplesheets "
+                "(path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER)")
+            conn.execute(
+                "CREATE TABLE samplesheet_rows "
+                "(path TEXT, lane TEXT, sample_id TEXT, sample_name TEXT, "
+                "project TEXT, library_name TEXT)")
+            conn.execute("CREATE INDEX rows_path ON samplesheet_rows (path)")
+            conn.execute("CREATE INDEX rows_project ON samplesheet_rows (project)")
+            conn.execute(f"PRAGMA user_version = {schema_version}")
+
+    def refresh(self, samplesheets: Iterable[str], workers: int = parse_workers) -> None:
+        # Parse, concurrently, the sample sheets that are new or changed since they were cached
+        if self.disabled:
+            return
+        try:
+            self._refresh(samplesheets, workers)
+        except sqlite3.Error as e:
+            self._disable(e)
+
+    def _refresh(self, samplesheets: Iterable[str], workers: int) -> None:
+        stats = {}
+        for samplesheet in samplesheets:
+            try:
+                st = os.stat(samplesheet)
+            except OSError:
+                continue
+            stats[os.path.abspath(samplesheet)] = (st.st_mtime_ns, st.st_size)
+
+        # only look up the requested sample sheets, not the whole table
+        paths = list(stats)
+        cached = {}
+        with self._connect() as conn:
+            for i in range(0, len(paths), lookup_batch):
+                batch = paths[i:i + lookup_batch]
+                cached.update(
+                    (path, (mtime_ns, size)) for path, mtime_ns, size in conn.execute(
+                        "SELECT path, mtime_ns, size FROM samplesheets "
+                        f"WHERE path IN ({','.join('?' * len(batch))})", batch))
+        stale = [path for path, key in stats.items() if cached.get(path) != key]
+        if not stale:
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            parsed = list(zip(stale, executor.map(parse_samplesheet_safe, stale)))
+
+        with self._connect() as conn:
+            for path, rows in parsed:
+                conn.execute("DELETE FROM samplesheet_rows WHERE path = ?", (path,))
+                if rows is None:
+                    # left out of the cache, so an unreadable sample sheet is read again next time
+                    conn.execute("DELETE FROM samplesheets WHERE path = ?", (path,))
+                    continue
+                conn.executemany(
+                    "INSERT INTO samplesheet_rows VALUES (?, ?, ?, ?, ?, ?)",
+                    ((path,) + tuple(row[1:]) for row in rows))
+                conn.execute(
+                    "INSERT OR REPLACE INTO samplesheets VALUES (?, ?, ?)",
+                    (path,) + stats[path])
+
+    def rows(self, samplesheet: str) -> List[SampleSheetRow]:
+        """
+        Rows of one sample sheet, parsed again only if it changed since it was cached.
+
+        Returns:
+            List of SampleSheetRow
+        """
+        path = os.path.abspath(samplesheet)
+        self.refresh([path])
+        if self.disabled:
+            return parse_samplesheet(samplesheet)
+        runfolder = os.path.dirname(samplesheet)
+        try:
+            with self._connect() as conn:
+                if conn.execute(
+                        "SELECT 1 FROM samplesheets WHERE path = ?", (path,)).fetchone() is None:
+                    # could not be parsed when refreshed
+                    return parse_samplesheet(samplesheet)
+                return [
+                    SampleSheetRow(runfolder, *row) for row in conn.execute(
+                        "SELECT lane, sample_id, sample_name, project, library_name "
+                        "FROM samplesheet_rows WHERE path = ? ORDER BY rowid", (path,))]
+        except sqlite3.Error as e:
+            self._disable(e)
+            return parse_samplesheet(samplesheet)
+
+    def project_rows(self, projects: Iterable[str],
+                     samplesheets: Optional[Iterable[str]] = None) -> List[SampleSheetRow]:
+        """
+        Rows for the given projects in all sample sheets in incoming (or in samplesheets).
+
+        Returns:
+            List of SampleSheetRow
+        """
+        return self.find_rows(projects, ("project",), samplesheets)
+
+    def find_rows(self, values: Iterable[str], fields: Iterable[str] = ("project",),
+                  samplesheets: Optional[Iterable[str]] = None) -> List[SampleSheetRow]:
+        """
+        Rows where any of fields (project, sample_id, sample_name) is one of values.
+
+        Returns:
+            List of SampleSheetRow
+        """
+        values, fields = list(values), list(fields)
+        if samplesheets is None:
+            samplesheets = find_samplesheets()
+        samplesheets = [os.path.abspath(path) for path in samplesheets]
+        self.refresh(samplesheets)
+        if not self.disabled:
+            wanted = set(samplesheets)
+            marks = ",".join("?" * len(values))
+            where = " OR ".join(f"{field} IN ({marks})" for field in fields)
+            try:
+                with self._connect() as conn:
+                    return [
+                        SampleSheetRow(os.path.dirname(path), *row) for path, *row in conn.execute(
+                            "SELECT path, lane, sample_id, sample_name, project, library_name "
+                            f"FROM samplesheet_rows WHERE {where} ORDER BY path, rowid",
+                            values * len(fields))
+                        if path in wanted]
+            except sqlite3.Error as e:
+                self._disable(e)
+        return [
+            row for path in samplesheets for row in parse_samplesheet_safe(path) or []
+            if any(getattr(row, field) in values for field in fields)]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="List sample sheet rows for projects, from the cached sample sheets in incoming.")
+    parser.add_argument("projects", nargs="+", help="Project IDs to search for.")
+    parser.add_argument(
+        "--samples", action="store_true",
+        help="Also match the given IDs against the Sample_ID and Sample_Name columns.")
+    parser.add_argument(
+        "--incoming", default=incoming_dir,
+        help="Folder searched for sample sheets at most two folders down (default: %(default)s)")
+    parser.add_argument(
+        "--runfolders", action="store_true",
+        help="Only print the names of the runfolders with the projects.")
+    args = parser.parse_args()
+
+    fields = ("project", "sample_id", "sample_name") if args.samples else ("project",)
+    rows = SampleSheetCache().find_rows(args.projects, fields, find_samplesheets(args.incoming))
+    if args.runfolders:
+        for runfolder in sorted({os.path.basename(row.runfolder) for row in rows}):
+            print(runfolder)
+    else:
+        print("\t".join(SampleSheetRow._fields))
+        for row in rows:
+            print("\t".join(
+                os.path.basename(value) if field == "runfolder" else (value or "")
+                for field, value in zip(SampleSheetRow._fields, row)))
+
+
+if __name__ == "__main__":
+    main()
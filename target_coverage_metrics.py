@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+"""
+Target coverage metrics for exome projects, similar to those of GATK CollectHsMetrics,
+calculated from the mosdepth per-base output of Sarek and a target BED file (e.g. the
+Twist exome targets used for the Sarek intervals), instead of rereading every alignment.
+
+Usage:
+    target_coverage_metrics.py --analysis_dir /proj/ngi2016001/nobackup/NGI/ANALYSIS/<project> \
+        --targets <targets.bed> [--baits <baits.bed>] [--workers N]
+"""
+
+import argparse
+import concurrent.futures
+import gzip
+import os
+import sys
+import tempfile
+from glob import glob
+
+import yaml
+
+from multiqc_extra_stats_qc import write_atomic
+
+coverage_thresholds = [10, 20, 30]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Calculate target coverage metrics from mosdepth per-base output and write "
+        "MultiQC custom content"
+    )
+    parser.add_argument(
+        "--analysis_dir",
+        required=True,
+        help="Path to sarek analysis result folder is located",
+    )
+    parser.add_argument("--targets", required=True, help="BED file with the target intervals")
+    parser.add_argument("--baits", help="BED file with the bait intervals (optional)")
+    parser.add_argument(
+        "--outdir",
+        help="Folder for the MultiQC custom content (default: <analysis_dir>/multiqc_custom_content)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=len(os.sched_getaffinity(0)),
+        help="Number of samples processed in parallel (default: the number of available cores, %(default)s)",
+    )
+    return parser.parse_args()
+
+
+def read_bed(bed_file):
+    """
+    Reads a BED file into merged, sorted intervals per chromosome.
+
+    Args:
+        bed_file (str): Path to BED file, optionally gzipped
+
+    Returns:
+        dict: Chromosome (key), list of [start, end] intervals (value)
+    """
+    opener = gzip.open if bed_file.endswith(".gz") else open
+    intervals = {}
+    with opener(bed_file, "rt") as fin:
+        for line in fin:
+            if not line.strip() or line.startswith(("#", "track", "browser")):
+                continue
+            chrom, start, end = line.split("\t")[:3]
+            intervals.setdefault(chrom, []).append((int(start), int(end)))
+
+    merged = {}
+    for chrom, chrom_intervals in intervals.items():
+        merged[chrom] = []
+        for start, end in sorted(chrom_intervals):
+            if merged[chrom] and start <= merged[chrom][-1][1]:
+                merged[chrom][-1][1] = max(merged[chrom][-1][1], end)
+            else:
+                merged[chrom].append([start, end])
+    return merged
+
+
+def target_depths(per_base_file, *interval_sets):
+    """
+    Sweeps the coverage runs of a mosdepth per-base report over one or more sets
+    of intervals (e.g. targets and baits) in one streaming pass. Runs and intervals
+    are sorted by position within a chromosome, so each chromosome is a linear merge.
+
+    Args:
+        per_base_file (str): Path to mosdepth per-base.bed.gz
+        interval_sets (dict): Merged intervals, from read_bed
+
+    Returns:
+        list: For each interval set, a tuple of the histogram of bases per depth
+        (dict) and the highest depth of each interval (dict of chromosome: list)
+    """
+    results = [
+        ({}, {chrom: [0] * len(intervals) for chrom, intervals in intervals_.items()})
+        for intervals_ in interval_sets]
+    chrom, sweeps = None, []
+    with gzip.open(per_base_file, "rt") as fin:
+        for line in fin:
+            run_chrom, start, end, depth = line.split("\t")
+            if run_chrom != chrom:
+                chrom = run_chrom
+                # [intervals, first interval not done, histogram, highest depths]
+                sweeps = [
+                    [intervals_[chrom], 0, histogram, max_depth[chrom]]
+                    for intervals_, (histogram, max_depth) in zip(interval_sets, results)
+                    if chrom in intervals_]
+            if not sweeps:
+                continue
+            start, end, depth = int(start), int(end), int(depth)
+            for sweep in sweeps:
+                intervals, first, histogram, chrom_max = sweep
+                # intervals ending before this run are done
+                while first < len(intervals) and intervals[first][1] <= start:
+                    first += 1
+                sweep[1] = first
+                i = first
+                while i < len(intervals) and intervals[i][0] < end:
+                    overlap = min(end, intervals[i][1]) - max(start, intervals[i][0])
+                    histogram[depth] = histogram.get(depth, 0) + overlap
+                    if depth > chrom_max[i]:
+                        chrom_max[i] = depth
+                    i += 1
+    return results
+
+
+def coverage_metrics(histogram, max_depth, target_bases, thresholds=coverage_thresholds):
+    """
+    Calculates the target coverage metrics from the depth histogram.
+
+    Args:
+        histogram (dict): Target bases per depth, from target_depths
+        max_depth (dict): Highest depth per target interval, from target_depths
+        target_bases (int): Number of target bases
+        thresholds (list): Depths to report the percentage of target bases at
+
+    Returns:
+        dict: Metric(s) (key), value (value)
+    """
+    # target bases missing from the per-base report have no coverage
+    histogram = dict(histogram)
+    histogram[0] = histogram.get(0, 0) + target_bases - sum(histogram.values())
+    depths = sorted(histogram)
+
+    mean = sum(depth * bases for depth, bases in histogram.items()) / target_bases
+    # the depth that 80 % of the target bases reach
+    p20, cumulative = 0, 0
+    for depth in depths:
+        cumulative += histogram[depth]
+        if cumulative > target_bases * 0.2:
+            p20 = depth
+            break
+
+    n_targets = sum(len(depths_) for depths_ in max_depth.values())
+    zero_targets = sum(1 for depths_ in max_depth.values() for depth in depths_ if depth == 0)
+    metrics = {"Mean target coverage": round(mean, 1)}
+    for threshold in thresholds:
+        bases = sum(histogram[depth] for depth in depths if depth >= threshold)
+        metrics[f"% target bases ≥{threshold}X"] = round(bases / target_bases * 100, 2)
+    metrics["Fold-80 penalty"] = round(mean / p20, 2) if p20 else None
+    metrics["% zero coverage targets"] = round(zero_targets / n_targets * 100, 2)
+    return metrics
+
+
+def sample_metrics(per_base_file, targets, baits=None):
+    """
+    Target coverage metrics for one sample.
+
+    Args:
+        per_base_file (str): Path to mosdepth per-base.bed.gz
+        targets (dict): Merged target intervals
+        baits (dict): Merged bait intervals, or None
+
+    Returns:
+        dict: Metric(s) (key), value (value)
+    """
+    target_bases = sum(end - start for intervals in targets.values() for start, end in intervals)
+    # targets and baits are swept in the same pass over the per-base report
+    depths = target_depths(per_base_file, targets, *([baits] if baits else []))
+    metrics = coverage_metrics(*depths[0], target_bases)
+    if baits:
+        bait_bases = sum(end - start for intervals in baits.values() for start, end in intervals)
+        histogram, _ = depths[1]
+        metrics["Mean bait coverage"] = round(
+            sum(depth * bases for depth, bases in histogram.items()) / bait_bases, 1)
+    return metrics
+
+
+def custom_content(data):
+    """
+    Formats the metrics as MultiQC custom content.
+
+    Args:
+        data (dict): Sample(s) (key), metrics (value)
+
+    Returns:
+        dict: Custom content ready for yaml.dump
+    """
+    return {
+        "id": "target_coverage",
+        "section_name": "Target coverage",
+        "description": "Coverage of the target intervals, calculated from the mosdepth per-base output.",
+        "plot_type": "table",
+        "pconfig": {"id": "target_coverage_table", "title": "Target coverage"},
+        "data": data,
+    }
+
+
+def main():
+    args = parse_arguments()
+    per_base_files = sorted(glob(os.path.join(
+        args.analysis_dir, "results/reports/mosdepth/*/*.md.per-base.bed.gz")))
+    if not per_base_files:
+        sys.exit(f"No mosdepth per-base reports found in {args.analysis_dir}/results/reports/mosdepth")
+
+    targets = read_bed(args.targets)
+    baits = read_bed(args.baits) if args.baits else None
+
+    samples = [os.path.basename(os.path.dirname(path)) for path in per_base_files]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as executor:
+        results = executor.map(
+            sample_metrics, per_base_files, [targets] * len(samples), [baits] * len(samples))
+        data = dict(zip(samples, results))
+
+    outdir = args.outdir or os.path.join(args.analysis_dir, "multiqc_custom_content")
+    os.makedirs(outdir, exist_ok=True)
+    outfile = os.path.join(outdir, "target_coverage_mqc.yaml")
+    write_atomic(outfile, lambda fout: yaml.dump(custom_content(data), fout, allow_unicode=True))
+    print(f"Target coverage metrics for {len(data)} samples written to {outfile}")
+
+
+if __name__ == "__main__":
+    main()
+
+
+class TestScript:
+    import pytest
+    import random
+
+    @staticmethod
+    def _write_bed(path, intervals):
+        with open(path, "w") as fout:
+            for chrom, start, end in intervals:
+                fout.write(f"{chrom}\t{start}\t{end}\n")
+
+    @staticmethod
+    def _write_per_base(path, depths):
+        # runs of equal depth, like mosdepth writes them
+        with gzip.open(path, "wt") as fout:
+            for chrom, chrom_depths in depths.items():
+                start = 0
+                for pos in range(1, len(chrom_depths) + 1):
+                    if pos == len(chrom_depths) or chrom_depths[pos] != chrom_depths[start]:
+                        fout.write(f"{chrom}\t{start}\t{pos}\t{chrom_depths[start]}\n")
+                        start = pos
+
+    @staticmethod
+    def _brute_force(depths, intervals, thresholds=coverage_thresholds):
+        # every covered position once, overlapping intervals merged by the set
+        positions = sorted({
+            (chrom, pos) for chrom, start, end in intervals for pos in range(start, end)})
+        values = sorted(
+            depths[chrom][pos] if pos < len(depths.get(chrom, [])) else 0
+            for chrom, pos in positions)
+        mean = sum(values) / len(values)
+        p20 = values[int(len(values) * 0.2)]
+        # merged targets are the runs of consecutive target positions
+        merged = []
+        for chrom, pos in positions:
+            if merged and merged[-1][0] == chrom and merged[-1][-1] == pos - 1:
+                merged[-1].append(pos)
+            else:
+                merged.append([chrom, pos])
+        zero_targets = sum(
+            1 for chrom, *target in merged
+            if all(
+                (depths[chrom][pos] if pos < len(depths.get(chrom, [])) else 0) == 0
+                for pos in target))
+        metrics = {"Mean target coverage": round(mean, 1)}
+        for threshold in thresholds:
+            metrics[f"% target bases ≥{threshold}X"] = round(
+                sum(1 for value in values if value >= threshold) / len(values) * 100, 2)
+        metrics["Fold-80 penalty"] = round(mean / p20, 2) if p20 else None
+        metrics["% zero coverage targets"] = round(
+            zero_targets / len(merged) * 100, 2)
+        return metrics
+
+    @pytest.fixture
+    def workdir(self, dirname: str = "/tmp") -> tempfile.TemporaryDirectory:
+        return tempfile.TemporaryDirectory(dir=dirname)
+
+    def test_sample_metrics(self, workdir: tempfile.TemporaryDirectory) -> None:
+        rng = self.random.Random(1)
+        depths = {
+            chrom: [rng.choice([0, 0, 5, 12, 25, 40]) for _ in range(400)]
+            for chrom in ["chr1", "chr2"]}
+        targets = [
+            ("chr1", 10, 40), ("chr1", 30, 60),  # overlapping targets are merged
+            ("chr1", 60, 65),  # adjacent to the merged target
+            ("chr1", 390, 420),  # runs past the end of the per-base report
+            ("chr2", 100, 180), ("chr3", 0, 20)]  # chr3 has no coverage at all
+        for chrom, start, end in [("chr1", 200, 230), ("chr2", 300, 310)]:
+            depths[chrom][start:end] = [0] * (end - start)  # zero coverage targets
+            targets.append((chrom, start, end))
+        baits = [(chrom, max(0, start - 5), end + 5) for chrom, start, end in targets]
+
+        per_base_file = os.path.join(workdir.name, "sample.md.per-base.bed.gz")
+        targets_file = os.path.join(workdir.name, "targets.bed")
+        baits_file = os.path.join(workdir.name, "baits.bed")
+        self._write_per_base(per_base_file, depths)
+        self._write_bed(targets_file, rng.sample(targets, len(targets)))
+        self._write_bed(baits_file, baits)
+
+        metrics = sample_metrics(per_base_file, read_bed(targets_file), read_bed(baits_file))
+        expected = self._brute_force(depths, targets)
+        expected["Mean bait coverage"] = self._brute_force(depths, baits)["Mean target coverage"]
+        assert metrics == expected
+        assert metrics["% zero coverage targets"] > 0
+        assert sample_metrics(per_base_file, read_bed(targets_file)) == {
+            key: value for key, value in expected.items() if key != "Mean bait coverage"}
+
+    def test_read_bed(self, workdir: tempfile.TemporaryDirectory) -> None:
+        bed_file = os.path.join(workdir.name, "targets.bed")
+        self._write_bed(bed_file, [("chr1", 30, 60), ("chr1", 10, 40), ("chr1", 60, 70), ("chr2", 5, 6)])
+        assert read_bed(bed_file) == {"chr1": [[10, 70]], "chr2": [[5, 6]]}